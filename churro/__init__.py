@@ -1,21 +1,53 @@
 import acidfs
+import base64
+import bisect
+import collections
 import datetime
+import fcntl
+import hashlib
 import json
-import sys
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import transaction
+import weakref
+
+try:
+    import msgpack
+except ImportError: # pragma NO COVER
+    msgpack = None
+
+try:
+    import orjson
+except ImportError: # pragma NO COVER
+    orjson = None
+
+try:
+    string_types = basestring
+except NameError: # pragma NO COVER
+    string_types = str
+
+try:
+    number_types = (int, long, float)
+except NameError: # pragma NO COVER
+    number_types = (int, float)
 
 from .collection_wrappers import DictWrapper
 from .collection_wrappers import ListWrapper
 
 CHURRO_EXT = '.churro'
 CHURRO_FOLDER = '__folder__' + CHURRO_EXT
+CHURRO_INDEX = '__index__'
 
-if sys.version_info[0] == 2: # pragma NO COVER
-    DECODE_MODE = 'rb'
-    ENCODE_MODE = 'wb'
-else:  # pragma NO COVER
-    DECODE_MODE = 'r'
-    ENCODE_MODE = 'w'
+# Seconds to wait, at most, before the first retry of a conflicting
+# transaction.  Doubled for each retry after that.
+_RETRY_DELAY = 0.01
 
 
 class Churro(object):
@@ -49,24 +81,122 @@ class Churro(object):
        If the Git repository is to be created, create it as a bare repository.
        If the repository is already created or `create` is False, this argument
        has no effect.
+
+    ``cache_size``
+
+       The maximum number of decoded objects to keep in an in memory cache
+       which is shared by all transactions using this instance.  Objects are
+       cached by the id of the Git blob they were read from, so an object is
+       only decoded again once it has changed in the repository.  The default,
+       `0`, is not to use a cache unless `cache_bytes` is given.
+
+    ``cache_bytes``
+
+       The maximum total size, in bytes of serialized data, of the objects kept
+       in the cache.  The default, `None`, is to limit the cache by number of
+       objects only.
+
+    ``codec``
+
+       The codec used to write objects to the repository.  The default is an
+       instance of :class:`~churro.JsonCodec`, which writes indented,
+       human readable JSON.  Objects are always read with whichever codec
+       they were written with, so the codec for a repository may be changed
+       at any time.  See :meth:`reencode`.
+
+    ``pool_size``
+
+       The maximum number of idle handles on the repository to keep for reuse
+       by new threads.  The default is `8`.
+
+    ``group_commit``
+
+       If given, the number of seconds to wait for other threads to commit
+       before committing, so that their transactions can be written together
+       as a single Git commit.  See :ref:`group-commit`.  The default, `None`,
+       is for each transaction to make its own commit.
+
+    ``group_commit_size``
+
+       The maximum number of transactions to write in a single commit when
+       `group_commit` is used.  The default is `32`.
+
+    ``retries``
+
+       The number of times :meth:`run` tries a transaction again after it
+       fails with `ConflictError`.  The default is `3`.
+
+    An instance may be shared by any number of threads.  Each thread uses its
+    own session, which lasts for the thread's current transaction, and its
+    own handle on the repository, which it keeps from one transaction to the
+    next.  When a thread ends its handle is returned to a pool, to be reused
+    by another thread.  Objects must not be shared between threads.
     """
-    session = None
+    cache = None
+    group = None
 
     def __init__(self, repo, head='HEAD',
-                 factory=None, create=True, bare=False):
-        self.fs = acidfs.AcidFS(repo, head=head, create=create, bare=bare,
-                                name='Churro.AcidFS')
+                 factory=None, create=True, bare=False,
+                 cache_size=0, cache_bytes=None, codec=None, pool_size=8,
+                 group_commit=None, group_commit_size=32, retries=3):
+        def open_fs():
+            return acidfs.AcidFS(repo, head=head, create=False, bare=bare,
+                                 name='Churro.AcidFS')
+        fs = acidfs.AcidFS(repo, head=head, create=create, bare=bare,
+                           name='Churro.AcidFS')
+        self.db = fs.db
+        self.head = head
+        self.path_encoding = fs.path_encoding
+        self.snapshots = weakref.WeakValueDictionary()
+        self.snapshots_lock = threading.Lock()
+        self.pool = _HandlePool(open_fs, pool_size)
+        self.pool.put(fs, None)
+        self.local = threading.local()
         if factory is None:
             factory = PersistentFolder
         self.factory = factory
+        if cache_size or cache_bytes:
+            self.cache = ObjectCache(cache_size, cache_bytes)
+        if codec is None:
+            codec = JsonCodec()
+        self.codec = codec
+        if group_commit is not None:
+            self.group = _CommitGroup(
+                fs.db, fs.wd, head, codec, group_commit, group_commit_size)
+        self.retries = retries
+
+    @property
+    def session(self):
+        """
+        The current thread's session, or `None`.
+        """
+        return getattr(self.local, 'session', None)
+
+    @property
+    def fs(self):
+        """
+        The `AcidFS` filesystem used by the current thread.
+        """
+        return self._lease().fs
+
+    def _lease(self):
+        lease = getattr(self.local, 'lease', None)
+        if lease is None:
+            lease = self.local.lease = _Lease(self.pool)
+        return lease
 
     def _session(self):
         """
         Make sure we're in a session.
         """
-        if not self.session or self.session.closed:
-            self.session = _Session(self.fs)
-        return self.session
+        session = self.session
+        if not session or session.closed:
+            lease = self._lease()
+            blobs, lease.blobs = lease.blobs, None
+            session = self.local.session = _Session(
+                lease.fs, self.cache, self.codec, blobs, lease.release,
+                group=self.group)
+        return session
 
     def root(self):
         """
@@ -75,6 +205,73 @@ class Churro(object):
         """
         return self._session().get_root(self.factory)
 
+    def traverse(self, path):
+        """
+        Gets the object at `path`, an absolute path such as `/a/b/c`, starting
+        from the root folder.  Equivalent to `root['a']['b']['c']` but finds
+        the object by looking it up directly in the Git trees, without reading
+        the listings of the folders along the way or loading them.  See
+        :meth:`~churro.PersistentFolder.resolve`.  Raises `KeyError` if there
+        is no object at `path`.
+        """
+        return self.root().resolve(path)
+
+    def snapshot(self, ref=None):
+        """
+        Returns a :class:`~churro.Snapshot`, a read only view of the repository
+        as of the commit named by `ref`, which may be a commit id or the name of
+        a branch or other reference.  The default is this instance's head.
+        While a snapshot of a commit is in use, asking for another snapshot of
+        the same commit returns the same snapshot, so objects already loaded
+        by one user of the snapshot are loaded for all of them.  Raises
+        `ValueError` if `ref` doesn't name a commit.
+        """
+        if ref is None:
+            ref = self.head
+        commit = _rev_parse(self.db, ref + '^{commit}')
+        if commit is None:
+            raise ValueError("No such commit: %s" % ref)
+        with self.snapshots_lock:
+            snapshot = self.snapshots.get(commit)
+            if snapshot is None:
+                fs = _SnapshotFS(self.db, commit, self.path_encoding)
+                snapshot = self.snapshots[commit] = Snapshot(
+                    fs, self.cache, self.codec, self.factory)
+        return snapshot
+
+    def run(self, fn, retries=None):
+        """
+        Calls `fn` with the root folder in a new transaction and commits it,
+        returning the result of `fn`.  If the commit fails with
+        `ConflictError`, because another transaction changed the same objects
+        in a way that couldn't be reconciled, the transaction is aborted and
+        `fn` is called again, in a new transaction, up to `retries` more
+        times, waiting a little longer each time.  The default is this
+        instance's `retries`.  Anything done in the current transaction before
+        calling this is discarded.  If `fn` raises an exception the
+        transaction is aborted and the exception propagates.
+        """
+        if retries is None:
+            retries = self.retries
+        attempt = 0
+        while True:
+            transaction.begin()
+            try:
+                result = fn(self.root())
+                transaction.commit()
+                return result
+            except acidfs.ConflictError:
+                transaction.abort()
+                if attempt >= retries:
+                    raise
+            except:
+                transaction.abort()
+                raise
+            # Randomized, so that transactions which conflicted with each
+            # other are unlikely to retry at the same moment.
+            time.sleep(random.uniform(0, _RETRY_DELAY * 2 ** attempt))
+            attempt += 1
+
     def flush(self):
         """
         Writes any unsaved data to the underlying `AcidFS` filesystem without
@@ -82,9 +279,141 @@ class Churro(object):
         """
         self._session().flush()
 
+    def reencode(self):
+        """
+        Rewrites every object in the repository which is not already stored
+        exactly as this instance's codec would write it.  Changes are made in
+        the current transaction, which must then be committed.  Returns the
+        number of objects rewritten.  The `churro-reencode` command does the
+        same thing from the command line.
+        """
+        return self._session().reencode()
+
+
+class Snapshot(object):
+    """
+    A read only view of a repository as of a single commit.  Snapshots are
+    gotten from :meth:`Churro.snapshot`.  A snapshot is not part of any
+    transaction and never changes, so it, and the objects loaded from it, may
+    be shared by any number of threads.  Attempting to change an object loaded
+    from a snapshot raises `TypeError`.  Snapshots share the decoded object
+    cache of the `Churro` instance they were gotten from, if it has one.
+
+    The `commit` attribute is the id of the commit the snapshot is of.
+    """
+
+    def __init__(self, fs, cache, codec, factory):
+        self.commit = fs.commit
+        self.session = _SnapshotSession(fs, cache, codec)
+        self._root = self.session.get_root(factory)
+
+    def root(self):
+        """
+        Gets the root folder of the repository as of the snapshot's commit.
+        """
+        return self._root
+
+    def traverse(self, path):
+        """
+        Gets the object at `path`, an absolute path such as `/a/b/c`.  See
+        :meth:`Churro.traverse`.
+        """
+        return self._root.resolve(path)
+
+    def close(self):
+        """
+        Stops the Git process used to read from the repository.  A snapshot
+        is closed automatically once it is no longer referenced.
+        """
+        self.session.close()
+
+    def __del__(self):
+        self.close()
+
+
+class ObjectCache(object):
+    """
+    A least recently used cache of decoded objects, keyed by the id of the Git
+    blob each object was decoded from.  Folder listings are also cached, keyed
+    by the id of the folder's Git tree.  Since a Git id identifies its content,
+    cached objects never need to be invalidated, only evicted.  The cache only
+    ever hands out copies of the objects it holds, so objects loaded from the
+    cache may be mutated freely.
+
+    ``max_objects``
+
+       The maximum number of objects to keep.  `0` or `None` means no limit.
+
+    ``max_bytes``
+
+       The maximum combined size of the serialized data for the objects kept.
+       `None` means no limit.
+
+    The `hits` and `misses` attributes count lookups which have been satisfied
+    or not by the cache.
+    """
+    hits = 0
+    misses = 0
+    total_bytes = 0
+
+    def __init__(self, max_objects=0, max_bytes=None):
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, oid):
+        """
+        Returns a copy of the object cached for the given blob id, or `None` if
+        there isn't one.
+        """
+        with self.lock:
+            entry = self.data.pop(oid, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data[oid] = entry
+        # Cached objects are never mutated, so can be copied without the lock.
+        return _clone_value(entry[0])
+
+    def put(self, oid, obj, size):
+        """
+        Caches a copy of `obj` as the decoded state of the blob with id `oid`,
+        whose serialized size is `size` bytes.
+        """
+        max_bytes = self.max_bytes
+        if max_bytes is not None and size > max_bytes:
+            return
+        entry = (_clone_value(obj), size)
+        with self.lock:
+            data = self.data
+            prev = data.pop(oid, None)
+            if prev is not None:
+                self.total_bytes -= prev[1]
+            data[oid] = entry
+            self.total_bytes += size
+
+            max_objects = self.max_objects
+            while ((max_objects and len(data) > max_objects) or
+                   (max_bytes is not None and
+                    self.total_bytes > max_bytes)):
+                oid, (obj, size) = data.popitem(last=False)
+                self.total_bytes -= size
+
+    def clear(self):
+        """
+        Removes all objects from the cache.
+        """
+        with self.lock:
+            self.data.clear()
+            self.total_bytes = 0
+
 
 _marker = object()
-_removed = object()
 
 
 class reify(object):
@@ -109,48 +438,280 @@ class reify(object):
 class JsonCodec(object):
     """
     Encodes/decodes Python objects as JSON.
+
+    ``indent``
+
+       The number of spaces to indent nested structures by.  The default is
+       `4`.  If `None`, compact JSON is written, with no whitespace at all.
     """
+    header = b''
+
+    def __init__(self, indent=4):
+        self.indent = indent
+        if indent is None:
+            self.separators = (',', ':')
+        else:
+            self.separators = None
+
     @staticmethod
     def encode_hook(obj):
+        if obj.__class__ is _Deferred:
+            # Never decoded, so can be written back out just as it was read.
+            return obj.data
         if not isinstance(obj, Persistent):
             return obj
 
-        cls = type(obj)
-        dotted_name = '%s.%s' % (cls.__module__, cls.__name__)
+        plan = type(obj)._churro_plan
+        state = obj.__dict__
         data = {}
-        for member in cls.mro():
-            for name, prop in member.__dict__.items():
-                if not isinstance(prop, PersistentProperty):
-                    continue
-                if name not in data:
-                    data[name] = prop.to_json(prop.__get__(obj))
+        for name, attr, default, get, to_json in plan.encoders:
+            if get is None:
+                value = state.get(attr, default)
+            else:
+                value = get(obj)
+            if to_json is not None:
+                value = to_json(value)
+            data[name] = value
         return {
-            '__churro_class__': dotted_name,
+            '__churro_class__': plan.type_name,
             '__churro_data__': data}
 
     def encode(self, obj, stream):
-        json.dump(obj, stream, default=self.encode_hook, indent=4)
+        json.dump(obj, stream, default=self.encode_hook, indent=self.indent,
+                  separators=self.separators)
+
+    def dumps(self, obj):
+        """
+        Returns the encoded form of `obj` as bytes.
+        """
+        data = json.dumps(obj, default=self.encode_hook, indent=self.indent,
+                          separators=self.separators)
+        if not isinstance(data, bytes): # pragma NO COVER
+            data = data.encode('ascii')
+        return data
 
     @staticmethod
-    def decode_hook(data):
+    def decode_hook(data, copy=True):
+        # Unless `copy` is false, because `data` has just been parsed and has
+        # no deferred objects nested in it, structures are copied, so that
+        # data shared by deferred objects is never handed out.
         if '__churro_class__' not in data:
             return data
 
-        cls = _resolve_dotted_name(data['__churro_class__'])
+        cls = _resolve_class(data['__churro_class__'])
+        decoders = cls._churro_plan.decoders
         obj = cls.__new__(cls)
+        state = obj.__dict__
         for name, value in data['__churro_data__'].items():
-            prop = getattr(cls, name)
-            prop.__set__(obj, prop.from_json(value), False)
+            decoder = decoders.get(name)
+            if decoder is None:
+                # Let unknown names fail as they would on the class
+                prop = getattr(cls, name)
+                if copy:
+                    value = _undefer(value)
+                prop.__set__(obj, prop.from_json(value), False)
+                continue
+
+            attr, from_json, set = decoder
+            value_type = value.__class__
+            if copy and (value_type is list or value_type is dict):
+                value = _undefer(value)
+            elif value_type is _Deferred and (from_json or set):
+                value = value.materialize()
+            if from_json is not None:
+                value = from_json(value)
+            if set is not None:
+                set(obj, value, False)
+                continue
+            if isinstance(value, Persistent):
+                value.__setinstance__(obj)
+            state[attr] = value
 
         return obj
 
     def decode(self, stream):
-        return json.load(stream, object_hook=self.decode_hook)
+        hook = _DeferHook()
+        return hook.decode(json.load(stream, object_hook=hook))
+
+    def loads(self, data):
+        """
+        Decodes an object from bytes.
+        """
+        if not isinstance(data, str): # pragma NO COVER
+            data = data.decode('utf8')
+        hook = _DeferHook()
+        return hook.decode(json.loads(data, object_hook=hook))
+
+    def accepts(self, data):
+        """
+        Returns boolean indicating whether `data` is in this codec's format.
+        """
+        return data[:1] != b'\x00'
+
+
+class FastJsonCodec(JsonCodec):
+    """
+    Encodes/decodes Python objects as compact JSON, using `orjson
+    <http://pypi.python.org/pypi/orjson>`_ if it is installed, otherwise
+    falling back to the standard library.  Data written by this codec can be
+    read by :class:`~churro.JsonCodec` and vice versa.
+    """
+
+    def __init__(self):
+        super(FastJsonCodec, self).__init__(indent=None)
+
+    def dumps(self, obj):
+        if orjson is None: # pragma NO COVER
+            return super(FastJsonCodec, self).dumps(obj)
+        return orjson.dumps(obj, default=self.encode_hook,
+                            option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        if orjson is None: # pragma NO COVER
+            return super(FastJsonCodec, self).loads(data)
+        if not isinstance(data, bytes): # pragma NO COVER
+            data = data.encode('utf8')
+        value = orjson.loads(data)
+        # orjson has no object hook, so the parsed data is only walked to find
+        # persistent objects if it has any but the top level object.  Any
+        # other string equal to the tag only makes the walk happen anyway.
+        tags = data.count(b'"__churro_class__"')
+        if not tags:
+            return value
+        if (tags == 1 and value.__class__ is dict and
+                '__churro_class__' in value):
+            return JsonCodec.decode_hook(value, False)
+        hook = _DeferHook()
+        return hook.decode(_apply_hook(value, hook))
+
+
+class MsgpackCodec(JsonCodec):
+    """
+    Encodes/decodes Python objects in the binary `MessagePack
+    <http://msgpack.org/>`_ format, which is smaller and faster to read and
+    write than JSON, but is not human readable.  Requires the `msgpack
+    <http://pypi.python.org/pypi/msgpack>`_ package.  Data written by this
+    codec begins with a header identifying the format.
+    """
+    header = b'\x00churro-msgpack\n'
+
+    def __init__(self):
+        if msgpack is None: # pragma NO COVER
+            raise ImportError("MsgpackCodec requires the msgpack package.")
+
+    def encode(self, obj, stream):
+        stream.write(self.dumps(obj))
+
+    def dumps(self, obj):
+        return self.header + msgpack.packb(
+            obj, default=self.encode_hook, use_bin_type=True)
+
+    def decode(self, stream):
+        return self.loads(stream.read())
+
+    def loads(self, data):
+        hook = _DeferHook()
+        return hook.decode(msgpack.unpackb(
+            data[len(self.header):], object_hook=hook, raw=False,
+            strict_map_key=False))
+
+    def accepts(self, data):
+        return data.startswith(self.header)
+
+
+def _apply_hook(value, hook):
+    """
+    Applies a decode hook to each dict in a decoded structure, innermost
+    first, for parsers which don't take an object hook.
+    """
+    if isinstance(value, dict):
+        return hook(dict(
+            (key, _apply_hook(item, hook)) for key, item in value.items()))
+    if isinstance(value, list):
+        return [_apply_hook(item, hook) for item in value]
+    return value
+
+
+class _Deferred(object):
+    """
+    Stands in for a persistent object nested in the data of another persistent
+    object.  Nested objects are only decoded when the property holding them is
+    first accessed, so that large embedded structures cost nothing to load
+    unless they are used.  If the containing object is saved before that
+    happens, the nested object is written back out as it was read.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def materialize(self):
+        return JsonCodec.decode_hook(self.data)
+
+
+class _DeferHook(object):
+    """
+    The object hook used to parse data, which defers decoding persistent
+    objects and counts them.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, data):
+        if '__churro_class__' not in data:
+            return data
+        self.count += 1
+        return _Deferred(data)
+
+    def decode(self, value):
+        """
+        Decodes a structure parsed with the hook.  It is only copied to decode
+        the deferred objects in it if there are any other than the top level
+        object.
+        """
+        if not self.count:
+            return value
+        if self.count == 1 and value.__class__ is _Deferred:
+            return JsonCodec.decode_hook(value.data, False)
+        return _undefer(value)
+
+
+def _undefer(value):
+    """
+    Copies a decoded structure, decoding any deferred objects in it.  Copying
+    means a structure shared by deferred objects, or by the object cache, is
+    never mutated in place.
+    """
+    value_type = value.__class__
+    if value_type is _Deferred:
+        return value.materialize()
+    if value_type is list:
+        return [_undefer(item) for item in value]
+    if value_type is dict:
+        return dict((key, _undefer(item)) for key, item in value.items())
+    return value
+
+
+def _codec_for(data):
+    """
+    Finds a codec which can decode `data`.
+    """
+    if codec.accepts(data):
+        return codec
+    if data.startswith(MsgpackCodec.header):
+        return MsgpackCodec()
+    raise ValueError("Unknown serialization format.")
 
 
 codec = JsonCodec()
 
 
+# Maps the names of the indexes declared by any persistent class to the
+# property first declared with each.
+_declared_indexes = {}
+
+
 class PersistentType(type):
 
     def __init__(cls, name, bases, members):
@@ -158,9 +719,76 @@ class PersistentType(type):
         for name, prop in members.items():
             if isinstance(prop, PersistentProperty):
                 prop.set_name(name)
+        cls._churro_plan = plan = _SerializationPlan(cls)
+        for index_name, prop_name, prop, index_type in plan.indexes:
+            _declared_indexes.setdefault(index_name, prop)
+        tag = members.get('__churro_tag__')
+        if tag:
+            _register_tag(tag, cls)
+            plan.type_name = tag
 
 
-PersistentBase = PersistentType('PersistentBase', (object,), {})
+class _SerializationPlan(object):
+    """
+    Everything the codec needs to know in order to encode and decode instances
+    of a persistent class, worked out once when the class is created.
+
+    `type_name` is what is written to identify the class in stored data, which
+    is the class's type tag if it has one, or its dotted name.  `encoders` is a
+    list of `(name, attr, default, get, to_json)` tuples and
+    `decoders` maps property names to `(attr, from_json, set)` tuples.  `get`,
+    `set`, `to_json` and `from_json` are `None` where the property doesn't
+    override the base behavior, in which case the codec can work directly with
+    the instance's `__dict__`.  Values read from a repository are trusted and
+    are not passed through `validate`.  `indexes` is a list of
+    `(index_name, name, prop, index_type)` tuples for the indexes that folders
+    keep of the class's property values.
+    """
+
+    def __init__(self, cls):
+        self.dotted_name = self.type_name = '%s.%s' % (
+            cls.__module__, cls.__name__)
+        self.properties = []
+        self.encoders = []
+        self.decoders = {}
+        self.indexes = []
+        for member in cls.mro():
+            for name, prop in member.__dict__.items():
+                if name in self.decoders:
+                    continue
+                if not isinstance(prop, PersistentProperty):
+                    continue
+                self.properties.append((name, prop))
+                self.encoders.append((
+                    name, prop.attr, prop.default,
+                    _overridden(prop, '__get__'),
+                    _overridden(prop, 'to_json')))
+                self.decoders[name] = (
+                    prop.attr,
+                    _overridden(prop, 'from_json'),
+                    _overridden(prop, '__set__'))
+                if prop.indexed:
+                    self.indexes.append((
+                        _EqualityIndex.index_name(name), name, prop,
+                        _EqualityIndex))
+                if prop.ordered:
+                    self.indexes.append((
+                        _RangeIndex.index_name(name), name, prop,
+                        _RangeIndex))
+                if prop.searchable:
+                    self.indexes.append((
+                        _TextIndex.index_name(name), name, prop,
+                        _TextIndex))
+
+
+def _overridden(prop, name):
+    """
+    Returns the bound method `name` of `prop` if its class overrides the
+    `PersistentProperty` implementation, otherwise `None`.
+    """
+    if getattr(type(prop), name) == getattr(PersistentProperty, name):
+        return None
+    return getattr(prop, name)
 
 
 class PersistentProperty(object):
@@ -169,8 +797,37 @@ class PersistentProperty(object):
     any data type as a value that is serializable natively to JSON.  Other types
     are implemented by extending this class and overriding the `from_json`,
     `to_json`, and `validate` methods.
+
+    ``indexed``
+
+       If `True`, each folder keeps an index of the values of this property for
+       those of its children which have it, so that children can be looked up
+       by value with :meth:`~churro.PersistentFolder.find` without reading
+       the rest of the children.  The default is `False`.
+
+    ``ordered``
+
+       If `True`, each folder keeps its children sorted by the value of this
+       property, so that children with values in a given range can be found,
+       in order, with :meth:`~churro.PersistentFolder.range`.  This is meant
+       for numbers, strings, dates and datetimes.  The default is `False`.
+
+    ``searchable``
+
+       If `True`, each folder keeps a full text index of the words in the
+       values of this property for its children, which can be searched with
+       :meth:`~churro.PersistentFolder.search`.  This is meant for strings or
+       lists of strings.  The default is `False`.
     """
     default = None
+    indexed = False
+    ordered = False
+    searchable = False
+
+    def __init__(self, indexed=False, ordered=False, searchable=False):
+        self.indexed = indexed
+        self.ordered = ordered
+        self.searchable = searchable
 
     def set_name(self, name):
         self.attr = '.' + name
@@ -178,7 +835,12 @@ class PersistentProperty(object):
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self
-        return getattr(obj, self.attr, self.default)
+        value = getattr(obj, self.attr, self.default)
+        if value.__class__ is _Deferred:
+            value = value.materialize()
+            value.__setinstance__(obj.__instance__)
+            setattr(obj, self.attr, value)
+        return value
 
     def __set__(self, obj, value, set_dirty=True):
         if set_dirty:
@@ -208,6 +870,29 @@ class PersistentProperty(object):
         or coercion that has been performed."""
         return value
 
+    def index_key(self, value):
+        """
+        Converts a value to the number or string it is sorted by in an ordered
+        index.  Strings must sort in the same order as the values they
+        represent.
+        """
+        return value
+
+    def index_terms(self, value):
+        """
+        Returns the list of words under which a value is indexed in a full
+        text index.  By default, strings are split into lower case words, and
+        the strings in lists are each split into words.
+        """
+        if isinstance(value, string_types):
+            return _tokenize(value)
+        if isinstance(value, (list, tuple)):
+            terms = []
+            for item in value:
+                terms.extend(self.index_terms(item))
+            return terms
+        return []
+
 
 class PersistentDate(PersistentProperty):
     """
@@ -229,6 +914,9 @@ class PersistentDate(PersistentProperty):
             raise ValueError("%s is not an instance of datetime.date")
         return value
 
+    def index_key(self, value):
+        return value.isoformat()
+
 
 class PersistentDatetime(PersistentProperty):
     """
@@ -255,17 +943,35 @@ class PersistentDatetime(PersistentProperty):
             raise ValueError("%s is not an instance of datetime.datetime")
         return value
 
+    def index_key(self, value):
+        return self.to_json(value)
+
+
+PersistentBase = PersistentType('PersistentBase', (object,), {})
+
 
 class Persistent(PersistentBase):
     """
     This is the base class from which all persistent classes for `Churro` must
     be derived.  Only objects which are instances of a class derived from
     `Persistent` may be stored in a `Churro` repository.
+
+    By default, stored objects identify their class by its full dotted name.
+    A class may instead declare a short type tag to be stored in its place, by
+    setting `__churro_tag__` in the class definition.  Type tags must be unique
+    and must not contain a '.'.  Objects stored before a tag was declared can
+    still be read, as long as the class can still be found by its dotted name.
+    The tag applies only to the class which declares it, not to subclasses.
+    Since a tag, unlike a dotted name, doesn't say where the class is defined,
+    the module defining a tagged class must be imported before objects of that
+    class are read.
     """
     _dirty = True
+    _subtree_dirty = False
     __name__ = None
     __parent__ = None
     _fs = None
+    _session = None
 
     def __new__(cls, *args, **kw):
         obj = super(Persistent, cls).__new__(cls)
@@ -285,10 +991,7 @@ class Persistent(PersistentBase):
         that are not themselves `Persistent` as values of persistent properties,
         as `Churro` has no way of detecting mutations to those structures.
         """
-        node = self.__instance__
-        while node is not None:
-            node._dirty = True
-            node = getattr(node, '__parent__', None)
+        _set_dirty(self.__instance__)
 
     def deactivate(self):
         """
@@ -307,14 +1010,58 @@ class Persistent(PersistentBase):
             # Can't really deatch root, just silently ignore
             return
 
-        type = 'folder' if isinstance(instance, PersistentFolder) else 'object'
-        if instance._dirty:
+        if _is_ghost(instance):
+            type = instance._ghost_type
+        elif isinstance(instance, PersistentFolder):
+            type = 'folder'
+        else:
+            type = 'object'
+        session = instance._session
+        if session is not None:
+            # An instance which has never been saved can only be written along
+            # with its topmost unsaved ancestor.
             node = instance
-            while node._fs is None:
+            while node.__parent__._fs is None:
                 node = node.__parent__
-            folder._save(node._fs)
+            if instance._dirty or instance._subtree_dirty:
+                session.flush(node)
+                if node._dirty and _is_attached(node, session.root):
+                    # Added in bulk, so only written along with its folder.
+                    node._save(session)
         folder._contents[instance.__name__] = (type, None)
 
+    def _save(self, session):
+        """
+        Writes this object to the repository, if it is dirty.
+        """
+        if not self._dirty:
+            return
+        fs = session.fs
+        session.write(resource_path(self) + CHURRO_EXT, self)
+        session.changed(self.__parent__, self.__name__)
+        self._dirty = False
+        self._fs = fs
+        self._session = session
+
+    @classmethod
+    def _resolve_conflict(cls, old, ours, theirs):
+        """
+        Called when an object has been changed by two transactions at once, and
+        the transaction committing second can't simply write its version.
+        `old` is the object as both transactions first read it, `ours` is the
+        version being committed and `theirs` is the version already committed
+        by the other transaction.  `old` is `None` if both transactions
+        created the object.  The objects are detached copies, without their
+        children.  Returns the object to be written in place of both, or
+        `None` if the changes can't be reconciled.
+
+        The default returns `None`.  The changes are then merged line by line,
+        as AcidFS would merge them, if possible, and otherwise the transaction
+        fails with `ConflictError`.  Override this for objects which many
+        transactions update, such as counters, to reconcile their changes.
+        """
+        return None
+
 
 class PersistentFolder(Persistent):
     """
@@ -325,114 +1072,712 @@ class PersistentFolder(Persistent):
     underlying filesystem, in which child objects are stored.  Instances of
     `PersistentFolder` are dict-like and are interacted with in the same way as
     standard Python dictionaries.
+
+    Lookups, membership tests and counting children are constant time
+    operations once a folder's listing has been read.  Adding or removing
+    children while iterating over a folder is not supported.
+
+    A subclass may set `projected_fields` to a sequence of property names of
+    its children which should be kept together in a single file, so that
+    listing views can read them for every child at once.  See
+    :meth:`~churro.PersistentFolder.project`.
+
+    A subclass may also set `counted` to `True`, to keep a count of its
+    children, which is then used by `len` rather than reading the folder's
+    listing, and may set `aggregated_fields` to a sequence of names of numeric
+    properties of its children for which a count, sum, minimum and maximum are
+    kept, which implies `counted`.  See
+    :meth:`~churro.PersistentFolder.aggregate`.
     """
+    projected_fields = ()
+    counted = False
+    aggregated_fields = ()
+
     @reify
     def _contents(self):
-        contents = {}
-        fs = self._fs
-        if fs is None:
+        if self._fs is None:
+            return {}
+        with _locked(self):
+            contents = self.__dict__.get('_contents')
+            if contents is not None:
+                # Read by another thread sharing a snapshot.
+                return contents
+            listing = self._session.list_folder(resource_path(self))
+            contents = dict((name, (type, None))
+                            for name, type in listing.items())
+            for name, objref in self.__dict__.pop('_resolved', {}).items():
+                if name in contents:
+                    contents[name] = objref
+            self.__dict__['_contents'] = contents
             return contents
-        path = resource_path(self)
-        with fs.cd(path):
-            for fname in fs.listdir():
-                if fname == CHURRO_FOLDER:
-                    continue
-                if fs.isdir(fname):
-                    folder_data = '%s/%s' % (fname, CHURRO_FOLDER)
-                    if fs.exists(folder_data):
-                        contents[fname] = ('folder', None)
-                elif fname.endswith(CHURRO_EXT):
-                    contents[fname[:-7]] = ('object', None)
-        return contents
 
-    @property
-    def _filtered_contents(self):
-        return dict([(name, (type, obj)) for name, (type, obj)
-                in self._contents.items() if obj is not _removed])
+    @reify
+    def _sorted_names(self):
+        return sorted(self._contents.keys())
 
-    def keys(self):
+    def keys(self, start_after=None, prefix=None, limit=None, cursor=None):
         """
-        Returns the names of child objects.
+        Returns a list of the names of child objects.
+
+        If any of the arguments are given, returns instead a single page of
+        names, in sorted order, as a list with an additional `cursor`
+        attribute.  Only names which come after `start_after` and which begin
+        with `prefix` are returned, at most `limit` of them.  If there may be
+        more names, `cursor` is an opaque string which may be passed as
+        `cursor`, along with the same `prefix` and `limit`, to get the next
+        page.  Otherwise `cursor` is `None`.  Once a folder's names have been
+        sorted, each page only costs as much as its size.  With a cache, see
+        :class:`~churro.Churro`, sorted names are kept from one transaction to
+        the next, until the folder changes.
         """
-        return self._filtered_contents.keys()
+        if (start_after is None and prefix is None and limit is None and
+                cursor is None):
+            return list(self._contents.keys())
+        return self._page(start_after, prefix, limit, cursor)
 
-    def values(self):
+    def values(self, prefetch=None):
         """
-        Returns an iterator over child objects.
+        Returns an iterator over child objects.  See
+        :meth:`~churro.PersistentFolder.items` for the meaning of `prefetch`.
         """
-        for name, value in self.items():
+        for name, value in self.items(prefetch):
             yield value
 
     def __iter__(self):
         """
         Returns an iterator over child names.
         """
-        return iter(self._filtered_contents.keys())
+        return iter(self._contents)
 
-    def items(self):
+    def items(self, prefetch=None, start_after=None, prefix=None, limit=None,
+              cursor=None):
         """
         Returns an iterator over (child object's name, child object) tuples.
+
+        Children which haven't been loaded yet are returned as ghosts, which
+        are not read from the repository until one of their attributes is
+        accessed, so that iterating over a folder only to look at names and
+        a few of the children is cheap.  A ghost becomes an instance of the
+        child's real class when it is loaded.
+
+        If `prefetch` is given, children are instead loaded ahead of time, in
+        batches of `prefetch` children at a time, using
+        :meth:`~churro.PersistentFolder.load_many`.  Use this when most of the
+        children will be needed.
+
+        If any of `start_after`, `prefix`, `limit` or `cursor` is given,
+        returns a single page of tuples instead, in the same way as
+        :meth:`~churro.PersistentFolder.keys`.  If `prefetch` is also given,
+        the page's children are loaded together.
         """
-        contents = self._filtered_contents
-        for name, (type, obj) in contents.items():
-            if obj is None:
-                obj = self._load(name, type)
-            yield name, obj
+        if (start_after is None and prefix is None and limit is None and
+                cursor is None):
+            return self._iter_items(prefetch)
+        page = self._page(start_after, prefix, limit, cursor)
+        if prefetch:
+            objs = self.load_many(page)
+        else:
+            objs = [_resolve_child(self, name) for name in page]
+        return _Page(zip(page, objs), page.cursor)
 
-    def __len__(self):
+    def _iter_items(self, prefetch):
+        if not prefetch:
+            for name, (type, obj) in self._contents.items():
+                if obj is None:
+                    obj = self._ghost(name, type)
+                yield name, obj
+            return
+
+        batch = []
+        for name in list(self._contents.keys()):
+            batch.append(name)
+            if len(batch) == prefetch:
+                for item in zip(batch, self.load_many(batch)):
+                    yield item
+                batch = []
+        if batch:
+            for item in zip(batch, self.load_many(batch)):
+                yield item
+
+    def load_many(self, names):
         """
-        Returns the number of children.
+        Returns a list of the children with the given names, in the same
+        order.  Any of the children which haven't been loaded yet are read
+        from the repository together, in a single batch, which is much faster
+        than loading them one at a time.  Raises `KeyError` if any of the
+        children is not found.
         """
-        return len(self._filtered_contents)
+        names = list(names)
+        with _locked(self):
+            if '_contents' not in self.__dict__ and self._fs is not None:
+                return self._load_resolved(names)
+            contents = self._contents
+            objs = []
+            pending = {}
+            for name in names:
+                type, obj = contents[name]
+                if obj is None or _is_ghost(obj):
+                    pending[name] = (type, obj)
+                objs.append(obj)
 
-    def __nonzero__(self):
+            if pending:
+                batch = list(pending.keys())
+                paths = [self._child_path(name, pending[name][0])
+                         for name in batch]
+                loaded = {}
+                for name, obj in zip(batch, self._session.load_many(paths)):
+                    type, ghost = pending[name]
+                    self._adopt(name, obj)
+                    if ghost is None:
+                        contents[name] = (type, obj)
+                    else:
+                        ghost._activate(obj)
+                        obj = ghost
+                    loaded[name] = obj
+                objs = [loaded.get(name, obj)
+                        for name, obj in zip(names, objs)]
+
+            return objs
+
+    def _load_resolved(self, names):
+        # Looks up only the named children, rather than reading the folder's
+        # listing, so that loading a page of a large folder costs as much as
+        # the page.
+        objs = []
+        pending = {}
+        for name in names:
+            obj = _resolve_child(self, name)
+            if obj is None:
+                raise KeyError(name)
+            if _is_ghost(obj):
+                pending[name] = obj
+            objs.append(obj)
+
+        if pending:
+            batch = list(pending.keys())
+            paths = [self._child_path(name, pending[name]._ghost_type)
+                     for name in batch]
+            for name, obj in zip(batch, self._session.load_many(paths)):
+                self._adopt(name, obj)
+                pending[name]._activate(obj)
+
+        return objs
+
+    def _names_in_order(self):
         """
-        Returns boolean indicating whether folder has any children.
+        Returns a sorted sequence of the names of the children.  If the
+        repository has a cache and the folder hasn't changed in this
+        transaction, the sequence is cached by the id of the folder's Git tree,
+        so that each version of a folder is only listed and sorted once.
+        Otherwise the folder keeps a sorted list, which it updates as children
+        are added and removed.
         """
-        return bool(self._filtered_contents)
+        names = self.__dict__.get('_sorted_names')
+        if names is not None:
+            return names
+        session = self._session
+        cache = session.cache if session is not None else None
+        if cache is not None and self._fs is not None:
+            session.flush()
+            node = _tree(session.fs, resource_path(self))
+            if node is not None and not node.dirty:
+                key = node.oid + b':sorted'
+                names = cache.get(key)
+                if names is None:
+                    names = tuple(sorted(self._contents.keys()))
+                    cache.put(key, names, sum(len(name) for name in names) +
+                              len(names) * _LISTING_ENTRY_SIZE)
+                return names
+        return self._sorted_names
 
-    def __getitem__(self, name):
+    def _page(self, start_after, prefix, limit, cursor):
+        names = self._names_in_order()
+        if cursor is not None:
+            start_after = _decode_cursor(cursor)
+        start = 0
+        if start_after is not None:
+            start = bisect.bisect_right(names, start_after)
+        if prefix:
+            start = max(start, bisect.bisect_left(names, prefix))
+        end = len(names) if limit is None else min(start + limit, len(names))
+        page = list(names[start:end])
+        if prefix and page and not page[-1].startswith(prefix):
+            # Names with the prefix are contiguous, so this is the last page.
+            page = [name for name in page if name.startswith(prefix)]
+            end = len(names)
+        more = end < len(names) and (
+            not prefix or names[end].startswith(prefix))
+        return _Page(page, _encode_cursor(page[-1]) if more and page else None)
+
+    def resolve(self, path):
         """
-        Retreives the child object of the given name.  Raises `KeyError` if the
-        child is not found.
+        Gets the object at `path`, relative to this folder, such as `a/b/c`.
+        Equivalent to `folder['a']['b']['c']` but finds the object by looking
+        it up directly in the Git trees, without reading the listings of the
+        folders along the way.  Folders along the way which haven't been
+        loaded yet are left as ghosts, which are only read from the repository
+        if they're used.  Raises `KeyError` if there is no object at `path`.
         """
-        obj = self.get(name, _marker)
-        if obj is _marker:
-            raise KeyError(name)
+        names = [name for name in path.split('/') if name]
+        obj = self
+        for name in names:
+            if _is_ghost(obj):
+                if obj._ghost_type != 'folder':
+                    raise KeyError(path)
+            elif not isinstance(obj, PersistentFolder):
+                raise KeyError(path)
+            obj = _resolve_child(obj, name)
+            if obj is None:
+                raise KeyError(path)
+        if _is_ghost(obj):
+            obj._activate()
         return obj
 
-    def get(self, name, default=None):
+    def prefetch(self, names=None):
         """
-        Returns the child object of the given name.  Returns `default` if the
-        child is not found.
+        Loads the children with the given names, or all of the children if
+        `names` is omitted, in a single batch, so that later access to them
+        doesn't need to read from the repository.
         """
-        contents = self._filtered_contents
-        objref = contents.get(name)
-        if not objref:
-            return default
-        type, obj = objref
-        if obj is None:
-            obj = self._load(name, type)
-        return obj
+        if names is None:
+            names = list(self._contents.keys())
+        self.load_many(names)
 
-    def __contains__(self, name):
+    def find(self, **criteria):
         """
-        Returns boolean indicating whether a child with the given name exists
-        in the folder.
+        Returns an iterator over the children whose indexed properties have
+        the given values, for example `folder.find(email='fred@example.com')`.
+        Only properties declared with `indexed=True` may be used.  Matching
+        children are found using the folder's indexes, without reading any
+        other children, and are returned in order by name as ghosts which are
+        only read from the repository when they are used.  Raises
+        `ValueError` if no class declares one of the properties as indexed.
+
+        If the folder doesn't have an index for a property yet, one is built
+        in memory for the rest of the transaction, which requires reading all
+        of the children.  It's stored the next time the folder's children
+        change, or by :meth:`~churro.PersistentFolder.reindex`, so that
+        reading never writes to the repository.
         """
-        return name in self.keys()
+        for prop_name in criteria:
+            _check_declared(_EqualityIndex.index_name(prop_name), 'indexed')
+        names = None
+        for prop_name, value in criteria.items():
+            index = self._get_index(_EqualityIndex.index_name(prop_name))
+            matches = index.lookup(value)
+            names = matches if names is None else names & matches
+            if not names:
+                return
+        for name in sorted(names or ()):
+            child = self._lazy_child(name)
+            if child is not None:
+                yield child
 
-    def __setitem__(self, name, other):
+    def range(self, name, lo=None, hi=None, limit=None, reverse=False):
         """
-        Adds a child to the folder with the given name.  If there is already
+        Returns an iterator over the children whose value for the property
+        `name`, which must be declared with `ordered=True`, is greater than or
+        equal to `lo` and less than `hi`, in order by that value.  Either bound
+        may be omitted.  If `reverse` is `True`, children are returned in
+        descending order.  At most `limit` children are returned, if given.
+        Children are found using the folder's index, reading only as much of
+        it as is needed, and are returned as ghosts which are only read from
+        the repository when they are used.
+        """
+        _check_declared(_RangeIndex.index_name(name), 'ordered')
+        index = self._get_index(_RangeIndex.index_name(name))
+        count = 0
+        for child_name in index.scan(lo, hi, reverse):
+            if limit is not None and count >= limit:
+                break
+            child = self._lazy_child(child_name)
+            if child is not None:
+                count += 1
+                yield child
+
+    def search(self, text, fields=None, limit=None):
+        """
+        Returns an iterator over the children matching a full text search, in
+        order by relevance.  `text` is split into words, each of which matches
+        any word beginning with it, and children must match all of the words
+        to be returned.  Searches all of the properties declared with
+        `searchable=True`, unless `fields`, a list of property names, is
+        given.  At most `limit` children are returned, if given.  Children are
+        returned as ghosts which are only read from the repository when they
+        are used.
+        """
+        kind = '.' + _TextIndex.kind
+        if fields is None:
+            index_names = sorted(index_name for index_name in
+                                 self._index_names()
+                                 if index_name.endswith(kind))
+        else:
+            index_names = [_TextIndex.index_name(field) for field in fields]
+            for index_name in index_names:
+                _check_declared(index_name, 'searchable')
+        indexes = [self._get_index(index_name) for index_name in index_names]
+
+        scores = None
+        for prefix in set(_tokenize(text)):
+            matches = {}
+            for index in indexes:
+                for name, score in index.match(prefix).items():
+                    matches[name] = matches.get(name, 0) + score
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((name, score + matches[name])
+                              for name, score in scores.items()
+                              if name in matches)
+            if not scores:
+                return
+
+        ranked = sorted((scores or {}).items(),
+                        key=lambda item: (-item[1], item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        for name, score in ranked:
+            child = self._lazy_child(name)
+            if child is not None:
+                yield child
+
+    def query(self):
+        """
+        Returns a new :class:`~churro.Query` for searching this folder's
+        children.
+        """
+        return Query(self)
+
+    def project(self, fields=None, columns=False):
+        """
+        Returns the values of properties of all of the children, read from the
+        folder's projection, a single file which is kept up to date as
+        children are changed, rather than from the children themselves.
+        Only properties named in the folder's `projected_fields` may be used,
+        and all of them are returned unless `fields`, a list of property names,
+        is given.
+
+        By default returns a list of dicts, one per child in order by name,
+        each mapping `__name__` to the child's name and each property name to
+        the child's value.  If `columns` is `True`, returns a single dict
+        mapping `__name__` and each property name to a list of values instead,
+        in the same order.  Values must be natively JSON serializable, or be
+        dates or datetimes stored with the corresponding property types.
+        """
+        declared = list(self.projected_fields)
+        if fields is None:
+            fields = declared
+        else:
+            fields = list(fields)
+            for field in fields:
+                if field not in declared:
+                    raise ValueError("Not a projected field: %s" % field)
+        index = self._get_index(_ProjectionIndex.index_name('projection'))
+        names = list(index.file(_ProjectionIndex.fname).get('names', ()))
+        values = [index.column(field) for field in fields]
+        if columns:
+            result = dict(zip(fields, values))
+            result['__name__'] = names
+            return result
+        rows = []
+        for i, name in enumerate(names):
+            row = dict((field, column[i])
+                       for field, column in zip(fields, values))
+            row['__name__'] = name
+            rows.append(row)
+        return rows
+
+    def aggregate(self, name):
+        """
+        Returns a dict of statistics of the values of the property `name` for
+        the folder's children, which must be named in the folder's
+        `aggregated_fields`.  The dict has keys `count`, the number of
+        children with a numeric value for the property, `sum`, `min` and
+        `max`.  `min` and `max` are `None` if no children have a value.  The
+        statistics are kept up to date as children are changed, so reading them
+        doesn't require reading any of the children.
+        """
+        if name not in self.aggregated_fields:
+            raise ValueError("Not an aggregated field: %s" % name)
+        index = self._get_index(_AggregateIndex.index_name('stats'))
+        return index.aggregate(name)
+
+    def reindex(self):
+        """
+        Rebuilds all of the folder's indexes from scratch.  This is only
+        necessary if an index is added to a property of a class after children
+        of that class have already been stored in a folder which has an index
+        for a different property.
+        """
+        session = self._session
+        session.flush()
+        indexes = {}
+
+        def add(index_name):
+            index = indexes[index_name] = session.index(self, index_name)
+            index.clear()
+
+        node = _tree(session.fs, resource_path(self, CHURRO_INDEX))
+        if node is not None:
+            for index_name in node.contents:
+                add(index_name)
+        for index_name in self._folder_index_names():
+            if index_name not in indexes:
+                add(index_name)
+        for batch in self._scan():
+            # An index first declared partway through can't be missing any
+            # earlier children, since they don't have the property.
+            for name, obj in batch:
+                for index in type(obj)._churro_plan.indexes:
+                    if index[0] not in indexes:
+                        add(index[0])
+            for index in indexes.values():
+                index.update_children(batch)
+        for index in indexes.values():
+            index.save()
+
+    def _folder_index_names(self):
+        """
+        Returns the names of the indexes declared by the folder's class, rather
+        than by its children's classes.
+        """
+        index_names = []
+        if self.projected_fields:
+            index_names.append(_ProjectionIndex.index_name('projection'))
+        if self.counted or self.aggregated_fields:
+            index_names.append(_AggregateIndex.index_name('stats'))
+        return index_names
+
+    def _index_names(self):
+        session = self._session
+        if session is not None:
+            session.flush()
+        if self._fs is None:
+            raise ValueError("Folder must be stored in a repository to use "
+                             "its indexes.")
+        return self._stored_index_names() | self._built_index_names()
+
+    def _stored_index_names(self):
+        node = _tree(self._session.fs, resource_path(self, CHURRO_INDEX))
+        if node is None:
+            return set()
+        return set(node.contents)
+
+    def _built_index_names(self):
+        """
+        Returns the names of indexes built in memory in this transaction,
+        which haven't been stored yet.
+        """
+        return set(index.name for index in self._session.indexes.values()
+                   if index.folder is self and index.built)
+
+    def _lazy_child(self, name):
+        objref = self._contents.get(name)
+        if objref is None:
+            return None
+        type, obj = objref
+        if obj is None:
+            obj = self._ghost(name, type)
+        return obj
+
+    def _get_index(self, index_name):
+        session = self._session
+        if session is not None:
+            # Make sure indexes reflect any changes made in this transaction.
+            session.flush()
+        if self._fs is None:
+            raise ValueError("Folder must be stored in a repository to use "
+                             "its indexes.")
+        with _locked(self):
+            index = session.index(self, index_name)
+            if not index.built and (not index.exists() or index.stale()):
+                # Only built in memory, so that reading doesn't write to the
+                # repository.  It's stored when the folder's children next
+                # change or by reindex.
+                self._build_indexes([index], save=False)
+            return index
+
+    def _scan(self, batch_size=100):
+        """
+        Iterates over all of the children in batches of `(name, obj)` tuples.
+        Children which weren't already loaded are let go of afterwards, so that
+        scanning a large folder doesn't keep all of its children in memory.
+        """
+        contents = self._contents
+        names = list(contents.keys())
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i + batch_size]
+            unloaded = [name for name in batch if contents[name][1] is None]
+            yield list(zip(batch, self.load_many(batch)))
+            for name in unloaded:
+                type, obj = contents[name]
+                if obj is not None and not obj._dirty:
+                    contents[name] = (type, None)
+
+    def _build_indexes(self, indexes, save=True):
+        for index in indexes:
+            index.clear()
+        for batch in self._scan():
+            for index in indexes:
+                index.update_children(batch)
+        for index in indexes:
+            index.built = True
+            if save:
+                index.save()
+
+    def _update_indexes(self, names):
+        """
+        Called at the end of a flush with the names of children which were
+        written or removed, to bring the folder's indexes up to date.
+        """
+        session = self._session
+        existing = self._stored_index_names() | self._built_index_names()
+        contents = self._contents
+        children = []
+        declared = set(self._folder_index_names())
+        for name in names:
+            objref = contents.get(name)
+            obj = objref[1] if objref else None
+            if objref and (obj is None or _is_ghost(obj)):
+                obj = self.load_many([name])[0]
+            children.append((name, obj))
+            if obj is not None:
+                for index in type(obj)._churro_plan.indexes:
+                    declared.add(index[0])
+
+        new = [session.index(self, index_name)
+               for index_name in declared - existing]
+        for index_name in existing:
+            index = session.index(self, index_name)
+            if index.stale():
+                new.append(index)
+            else:
+                index.update_children(children)
+                index.save()
+
+        if new:
+            self._build_indexes(new)
+
+    def __len__(self):
+        """
+        Returns the number of children.
+        """
+        if ('_contents' not in self.__dict__ and self._fs is not None and
+                (self.counted or self.aggregated_fields)):
+            # Children can't have been added or removed without reading the
+            # listing, so the stored count is current.
+            index = self._session.index(
+                self, _AggregateIndex.index_name('stats'))
+            if index.exists() and not index.stale():
+                return index.file(_AggregateIndex.fname)['count']
+        return len(self._contents)
+
+    def __nonzero__(self):
+        """
+        Returns boolean indicating whether folder has any children.
+        """
+        return len(self) > 0
+
+    __bool__ = __nonzero__
+
+    def __getitem__(self, name):
+        """
+        Retreives the child object of the given name.  Raises `KeyError` if the
+        child is not found.
+        """
+        obj = self.get(name, _marker)
+        if obj is _marker:
+            raise KeyError(name)
+        return obj
+
+    def get(self, name, default=None):
+        """
+        Returns the child object of the given name.  Returns `default` if the
+        child is not found.
+        """
+        objref = self._contents.get(name)
+        if not objref:
+            return default
+        type, obj = objref
+        if obj is None:
+            obj = self._load(name, type)
+        elif _is_ghost(obj):
+            obj._activate()
+        return obj
+
+    def __contains__(self, name):
+        """
+        Returns boolean indicating whether a child with the given name exists
+        in the folder.
+        """
+        return name in self._contents
+
+    def __setitem__(self, name, other):
+        """
+        Adds a child to the folder with the given name.  If there is already
         another child with the same name in the folder, that child is
         overwritten.
         """
+        _check_writable(self)
+        if _is_ghost(other):
+            other._activate()
         type = 'folder' if isinstance(other, PersistentFolder) else 'object'
-        self._contents[name] = (type, other)
+        contents = self._contents
+        if name not in contents:
+            self._name_added(name)
+        contents[name] = (type, other)
         other.__parent__ = self
         other.__name__ = name
-        _set_dirty(other)
+        other._session = self._session
+        other._dirty = True
+        _register(other)
+
+    def bulk_update(self, children):
+        """
+        Adds many children to the folder at once.  `children` is either a
+        dict or a sequence of `(name, child)` tuples.  This is equivalent to
+        adding each child individually but is much faster for large numbers of
+        children, since bookkeeping is done once for the whole batch and the
+        children are written to the repository together at commit time.
+        """
+        _check_writable(self)
+        if hasattr(children, 'items'):
+            children = children.items()
+        contents = self._contents
+        bulk = self.__dict__.setdefault('_bulk', {})
+        session = self._session
+        for name, other in children:
+            if _is_ghost(other):
+                other._activate()
+            if isinstance(other, PersistentFolder):
+                # Folders need to be visited individually at flush time.
+                self[name] = other
+                continue
+            if name not in contents:
+                self._name_added(name)
+            contents[name] = ('object', other)
+            other.__parent__ = self
+            other.__name__ = name
+            other._session = session
+            other._dirty = True
+            bulk[name] = other
+        _register(self)
+
+    def bulk_delete(self, names):
+        """
+        Removes the children with the given names from the folder.  Children
+        which haven't been loaded are not read from the repository.  Unlike
+        `del`, names which aren't in the folder are ignored.
+        """
+        _check_writable(self)
+        contents = self._contents
+        removals = self.__dict__.setdefault('_removals', {})
+        for name in names:
+            objref = contents.pop(name, None)
+            if objref:
+                removals.setdefault(name, objref[0])
+                self._name_removed(name)
+        _register(self)
 
     def __delitem__(self, name):
         """
@@ -452,64 +1797,417 @@ class PersistentFolder(Persistent):
             return default
 
         type, obj = objref
-        if obj:
-            return obj
-        return self._load(name, type, False)
+        if obj is None:
+            return self._load(name, type, False)
+        if _is_ghost(obj):
+            # Must be loaded before the removal is written.
+            obj._activate()
+        return obj
 
     def _remove(self, name):
-        contents = self._contents
-        objref = contents.get(name)
+        _check_writable(self)
+        objref = self._contents.pop(name, None)
         if objref:
-            type, obj = objref
-            if obj is _removed:
-                return None
-            contents[name] = (type, _removed)
-            _set_dirty(self)
+            self._name_removed(name)
+            removals = self.__dict__.setdefault('_removals', {})
+            removals.setdefault(name, objref[0])
+            _register(self)
         return objref
 
+    def _name_added(self, name):
+        names = self.__dict__.get('_sorted_names')
+        if names is not None:
+            bisect.insort(names, name)
+
+    def _name_removed(self, name):
+        names = self.__dict__.get('_sorted_names')
+        if names is not None:
+            del names[bisect.bisect_left(names, name)]
+
     def _load(self, name, type, cache=True):
+        obj = self._session.load(self._child_path(name, type))
+        self._adopt(name, obj)
+        if cache:
+            self._contents[name] = (type, obj)
+        return obj
+
+    def _child_path(self, name, type):
+        child = self._child_segment(name)
         if type == 'folder':
-            fspath = resource_path(self, name, CHURRO_FOLDER)
-        else:
-            fspath = resource_path(self, name) + CHURRO_EXT
-        obj = codec.decode(self._fs.open(fspath, DECODE_MODE))
+            return resource_path(self, child, CHURRO_FOLDER)
+        return resource_path(self, child) + CHURRO_EXT
+
+    def _adopt(self, name, obj):
         obj.__parent__ = self
         obj.__name__ = name
         obj._fs = self._fs
+        obj._session = self._session
         obj._dirty = False
-        if cache:
-            self._contents[name] = (type, obj)
-        return obj
 
-    def _save(self, fs):
-        self._fs = fs
+    def _ghost(self, name, type):
+        with _locked(self):
+            contents = self._contents
+            obj = contents[name][1]
+            if obj is None:
+                # Not made by another thread sharing a snapshot.
+                obj = _make_ghost(self, name, type)
+                contents[name] = (type, obj)
+            return obj
+
+    def _save(self, session):
+        """
+        Writes pending removals and, if dirty, this folder's own properties to
+        the repository.  A folder which has never been saved also writes all
+        of its children, since they have nowhere else to be written from.
+        Otherwise, dirty children are written by the session individually.
+        """
+        fs = session.fs
         path = resource_path(self)
-        if not fs.exists(path):
+        new = self._fs is None
+        if new and not fs.exists(path):
             fs.mkdir(path)
-        for name, (type, obj) in self._contents.items():
-            if obj is None:
-                continue
-            if type == 'folder':
-                if obj is _removed:
-                    fs.rmtree(resource_path(self, name))
-                else:
-                    obj._save(fs)
-            else:
-                fspath = resource_path(self, name) + CHURRO_EXT
-                if obj is _removed:
-                    fs.rm(fspath)
-                else:
-                    codec.encode(obj, fs.open(fspath, ENCODE_MODE))
-                    obj._dirty = False
-                    obj._fs = fs
-        fspath = '%s/%s' % (path, CHURRO_FOLDER)
-        codec.encode(self, fs.open(fspath, ENCODE_MODE))
-        self._dirty = False
+
+        removals = self.__dict__.pop('_removals', None)
+        if removals:
+            nodes = {}
+            for name, type in removals.items():
+                fname = self._child_segment(name)
+                if type != 'folder':
+                    fname += CHURRO_EXT
+                # Work on Git trees directly, looking each one up only once.
+                dirname, _, fname = fname.rpartition('/')
+                node = nodes.get(dirname, _marker)
+                if node is _marker:
+                    node = nodes[dirname] = _tree(
+                        fs, resource_path(self, dirname) if dirname else path)
+                if node is not None and fname in node.contents:
+                    node.remove(fname)
+                session.changed(self, name)
+
+        bulk = self.__dict__.pop('_bulk', None)
+        if bulk:
+            contents = self._contents
+            writes = []
+            for name, obj in bulk.items():
+                objref = contents.get(name)
+                if objref and objref[1] is obj and obj._dirty:
+                    fspath = resource_path(
+                        self, self._child_segment(name)) + CHURRO_EXT
+                    writes.append((fspath, obj))
+            session.write_many(writes)
+            for fspath, obj in writes:
+                session.changed(self, obj.__name__)
+                obj._dirty = False
+                obj._fs = fs
+                obj._session = session
+
+        if new and '_contents' in self.__dict__:
+            for name, (type, obj) in self._contents.items():
+                if obj is not None:
+                    obj._save(session)
+
+        self._fs = fs
+        self._session = session
+        if self._dirty:
+            session.write(resource_path(self, CHURRO_FOLDER), self)
+            session.changed(self.__parent__, self.__name__)
+            self._dirty = False
+
+    def _child_segment(self, name):
+        """
+        Returns the path, relative to this folder, at which the child with the
+        given name is stored.
+        """
+        return name
 
     #def __repr__(self):
     #    pass
 
 
+class PersistentShardedFolder(PersistentFolder):
+    """
+    A `PersistentShardedFolder` has the same dict-like API as
+    :class:`~churro.PersistentFolder` but is meant to hold a very large number
+    of children.  Rather than storing all of its children in a single folder in
+    the underlying filesystem, children are spread among a fixed number of
+    subfolders, or buckets, by a hash of the child's name.  Adding or changing
+    a child only rewrites the Git tree for that child's bucket, and looking up
+    a child by name only reads the listing for that bucket.  Operations which
+    need every child, such as `len` or iteration, read all of the buckets.
+
+    The number of buckets is `16 ** shard_chars`.  The default of 256 buckets
+    may be changed by overriding `shard_chars` in a subclass, but must not be
+    changed once a folder of that class has been stored in a repository.
+    """
+    shard_chars = 2
+
+    @reify
+    def _contents(self):
+        return _ShardedContents(self)
+
+    def __setitem__(self, name, other):
+        super(PersistentShardedFolder, self).__setitem__(name, other)
+        if self._contents.new_buckets:
+            # Need to visit this folder at flush time to create the bucket.
+            _register(self)
+
+    def _child_segment(self, name):
+        return '%s/%s' % (self._bucket(name), name)
+
+    def _bucket(self, name):
+        return _hash_bucket(name, self.shard_chars)
+
+    def _save(self, session):
+        if '_contents' in self.__dict__:
+            contents = self._contents
+            for bucket in contents.new_buckets:
+                session.fs.mkdirs(resource_path(self, bucket))
+            contents.existing.update(contents.new_buckets)
+            contents.new_buckets.clear()
+        super(PersistentShardedFolder, self)._save(session)
+
+
+class _Page(list):
+    """
+    A page of results, with a cursor for getting the next page.
+    """
+
+    def __init__(self, items, cursor):
+        super(_Page, self).__init__(items)
+        self.cursor = cursor
+
+
+def _encode_cursor(name):
+    return base64.urlsafe_b64encode(name.encode('utf8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % (cursor,))
+
+
+class _ShardedContents(object):
+    """
+    Stands in for the `_contents` dict of a sharded folder, reading the listing
+    for each bucket only when a name in that bucket is needed.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.buckets = {}
+        self.existing = set()
+        self.new_buckets = set()
+
+    def bucket(self, bucket):
+        contents = self.buckets.get(bucket)
+        if contents is None:
+            contents = self.buckets[bucket] = {}
+            folder = self.folder
+            if folder._fs is not None:
+                path = resource_path(folder, bucket)
+                if _tree(folder._fs, path) is not None:
+                    self.existing.add(bucket)
+                    listing = folder._session.list_folder(path)
+                    for name, type in listing.items():
+                        contents[name] = (type, None)
+                    resolved = folder.__dict__.get('_resolved', {})
+                    for name in list(resolved):
+                        if name in contents:
+                            contents[name] = resolved.pop(name)
+        return contents
+
+    def all_buckets(self):
+        folder = self.folder
+        if folder._fs is not None:
+            node = _tree(folder._fs, resource_path(folder))
+            if node is not None:
+                for name, (type, oid, obj) in list(node.contents.items()):
+                    if type == b'tree' and len(name) == folder.shard_chars:
+                        self.bucket(name)
+        return list(self.buckets.values())
+
+    def get(self, name, default=None):
+        return self.bucket(self.folder._bucket(name)).get(name, default)
+
+    def __getitem__(self, name):
+        return self.bucket(self.folder._bucket(name))[name]
+
+    def __setitem__(self, name, objref):
+        bucket = self.folder._bucket(name)
+        self.bucket(bucket)[name] = objref
+        if bucket not in self.existing:
+            self.new_buckets.add(bucket)
+
+    def __contains__(self, name):
+        return name in self.bucket(self.folder._bucket(name))
+
+    def pop(self, name, default=None):
+        return self.bucket(self.folder._bucket(name)).pop(name, default)
+
+    def __len__(self):
+        return sum(len(contents) for contents in self.all_buckets())
+
+    def __nonzero__(self):
+        for contents in self.all_buckets():
+            if contents:
+                return True
+        return False
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        for contents in self.all_buckets():
+            for name in contents:
+                yield name
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        for contents in self.all_buckets():
+            for item in list(contents.items()):
+                yield item
+
+
+# Sets an object's class, bypassing the `__class__` property of ghosts.
+_set_class = object.__dict__['__class__'].__set__
+
+
+class _Ghost(Persistent):
+    """
+    Stands in for a child of a folder which hasn't been loaded yet.  Accessing
+    any attribute other than the bookkeeping attributes `Churro` itself uses
+    loads the child, after which the ghost's class is changed to the child's
+    real class and it behaves exactly as if it had been loaded to begin with.
+    Because the ghost becomes the child, references to it remain valid.
+    """
+    _dirty = False
+    _ghost_attrs = frozenset((
+        '__instance__', '__parent__', '__name__', '_fs', '_session', '_dirty',
+        '_subtree_dirty', '_ghost_type'))
+
+    @property
+    def __class__(self):
+        # Asked for by isinstance, so that a ghost is an instance of its
+        # child's class.  isinstance ignores the class if it is the ghost's
+        # type by the time it's returned, so the child is loaded here but the
+        # ghost only becomes the child when it's next used.
+        state = self.__dict__
+        obj = state.get('_ghost_obj')
+        if obj is None:
+            obj = state['_ghost_obj'] = self.__parent__._load(
+                self.__name__, state['_ghost_type'], False)
+        return obj.__class__
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the ghost itself.
+        if name == '_ghost_type':
+            raise AttributeError(name)
+        self._activate()
+        return getattr(self, name)
+
+    def __setattr__(self, name, value):
+        if name not in self._ghost_attrs:
+            self._activate()
+        object.__setattr__(self, name, value)
+
+    def __setinstance__(self, instance):
+        self._activate()
+        self.__setinstance__(instance)
+
+    def _activate(self, obj=None):
+        lock = self._session.lock
+        if lock is None:
+            return self._become(obj)
+        # A ghost from a snapshot may be activated by more than one thread.
+        with lock:
+            if '_ghost_type' in self.__dict__:
+                self._become(obj)
+
+    def _become(self, obj):
+        state = self.__dict__
+        type = state['_ghost_type']
+        loaded = state.pop('_ghost_obj', None)
+        if obj is None:
+            obj = loaded
+        if obj is None:
+            obj = self.__parent__._load(self.__name__, type, False)
+        for attr, value in obj.__dict__.items():
+            if attr.startswith('.'):
+                if isinstance(value, Persistent):
+                    value.__setinstance__(self)
+                state[attr] = value
+        # The class is changed last, so the ghost is never seen as the real
+        # thing without its state.
+        _set_class(self, obj.__class__)
+        del state['_ghost_type']
+        state.pop('_ghost_segments', None)
+
+    # A ghost folder knows where to find the children found in it by
+    # PersistentFolder.resolve, so that they can be loaded without loading it.
+    def _child_segment(self, name):
+        segments = self.__dict__.get('_ghost_segments', {})
+        if name in segments:
+            return segments[name]
+        self._activate()
+        return self._child_segment(name)
+
+    def _load(self, name, type, cache=True):
+        if cache or name not in self.__dict__.get('_ghost_segments', {}):
+            self._activate()
+            return self._load(name, type, cache)
+        return PersistentFolder.__dict__['_load'](self, name, type, False)
+
+    def _child_path(self, name, type):
+        return PersistentFolder.__dict__['_child_path'](self, name, type)
+
+    def _adopt(self, name, obj):
+        return PersistentFolder.__dict__['_adopt'](self, name, obj)
+
+    # Special methods are looked up on the class, bypassing __getattr__.
+    def __len__(self):
+        self._activate()
+        return len(self)
+
+    def __nonzero__(self):
+        self._activate()
+        return bool(self)
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        self._activate()
+        return iter(self)
+
+    def __contains__(self, key):
+        self._activate()
+        return key in self
+
+    def __getitem__(self, key):
+        self._activate()
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self._activate()
+        self[key] = value
+
+    def __delitem__(self, key):
+        self._activate()
+        del self[key]
+
+    def __eq__(self, other):
+        self._activate()
+        return self == other
+
+    def __ne__(self, other):
+        self._activate()
+        return self != other
+
+    __hash__ = object.__hash__
+
+
 class PersistentDict(DictWrapper, Persistent):
     """
     A `PersistentDict` is a Python `dict` work alike that marks its parent
@@ -549,72 +2247,1514 @@ class PersistentList(ListWrapper, Persistent):
                 obj.__setinstance__(self.__instance__)
 
 
-class _Session(object):
-    closed = False
-    root = None
+class Query(object):
+    """
+    A query over the children of a folder, returned by
+    :meth:`~churro.PersistentFolder.query` and built up by chaining calls to
+    :meth:`where`, :meth:`order_by` and :meth:`limit`::
 
-    def __init__(self, fs):
-        self.fs = fs
-        transaction.get().join(self)
+        query = (contacts.query()
+                 .where(city='Paris')
+                 .where('born', '>=', date(1980, 1, 1))
+                 .where('name', 'startswith', 'Fr')
+                 .order_by('born', reverse=True)
+                 .limit(20))
+        for contact in query:
+            print(contact.name)
 
-    def abort(self, tx):
-        """
-        Part of datamanager API.
-        """
-        self.close()
+    Iterating over a query runs it.  Queries are planned using the folder's
+    indexes.  Matching names are found by intersecting the entries of
+    equality indexes and are checked against ordered indexes without reading
+    any children.  A query with no equality conditions is driven by an
+    ordered index instead, in order, if one can be used.  Only conditions on
+    properties with no suitable index require children to be read and
+    checked one by one.  Results are generated as they are found, so that
+    large result sets needn't be held in memory, except when sorting by a
+    property which has no ordered index, which requires all matching
+    children to be read and sorted first.
+    """
+    operators = ('==', '!=', '<', '<=', '>', '>=', 'in', 'startswith')
 
-    tpc_abort = abort
+    def __init__(self, folder):
+        self.folder = folder
+        self.conditions = []
+        self.ordering = None
+        self.max_results = None
 
-    def tpc_begin(self, tx):
+    def where(self, *condition, **criteria):
         """
-        Part of datamanager API.
+        Adds conditions which children must meet.  A condition may be given as
+        a `(name, operator, value)` triple, where `operator` is one of `==`,
+        `!=`, `<`, `<=`, `>`, `>=`, `in` or `startswith`, or as keyword
+        arguments, which test for equality.  Returns the query.
         """
+        if condition:
+            name, op, value = condition
+            if op not in self.operators:
+                raise ValueError("Unknown operator: %s" % op)
+            self.conditions.append((name, op, value))
+        for name, value in sorted(criteria.items()):
+            self.conditions.append((name, '==', value))
+        return self
 
-    def commit(self, tx):
+    def order_by(self, name, reverse=False):
         """
-        Part of datamanager API.
+        Sorts results by the value of property `name`.  Children with no value
+        come last.  Without an ordering, results are sorted by name, unless
+        the query is driven by an ordered index, in which case they are in
+        order by that index's property.  Returns the query.
         """
+        self.ordering = (name, reverse)
+        return self
 
-    def tpc_vote(self, tx):
+    def limit(self, max_results):
         """
-        Part of datamanager API.
+        Returns no more than `max_results` results.  Returns the query.
         """
-        self.flush()
-
-    def flush(self):
-        root = self.root
-        if root is None or not root._dirty:
-            # Nothing to do
-            return
+        self.max_results = max_results
+        return self
 
-        root._save(self.fs)
+    def __iter__(self):
+        count = 0
+        limit = self.max_results
+        for name, obj in self._run():
+            if limit is not None and count >= limit:
+                break
+            if obj is None:
+                obj = self.folder._lazy_child(name)
+                if obj is None:
+                    continue
+            count += 1
+            yield obj
 
-    def tpc_finish(self, tx):
+    def _run(self):
         """
-        Part of datamanager API.
+        Generates `(name, obj)` tuples for matching children, where `obj` is
+        `None` if the child hasn't had to be read.
         """
+        folder = self.folder
+        available = folder._index_names()
+        equal = []
+        ranges = {}
+        unindexed = []
+        for name, op, value in self.conditions:
+            # Values which can't be keyed, such as `None`, which is never
+            # indexed, are checked against the children instead.
+            if (op in ('==', 'in') and
+                    _EqualityIndex.index_name(name) in available):
+                index = folder._get_index(_EqualityIndex.index_name(name))
+                values = value if op == 'in' else [value]
+                if _index_keys(index, values) is not None:
+                    equal.append((index, values))
+                    continue
+            if (op in ('==', '<', '<=', '>', '>=', 'startswith') and
+                    _RangeIndex.index_name(name) in available):
+                index = folder._get_index(_RangeIndex.index_name(name))
+                if op == 'startswith':
+                    keys = ([[1, value]] if isinstance(value, string_types)
+                            else None)
+                else:
+                    keys = _index_keys(index, [value])
+                if keys is not None:
+                    ranges.setdefault(name, (index, []))[1].append(
+                        (op, keys[0]))
+                    continue
+            unindexed.append((name, op, value))
 
-    def sortKey(self):
-        return 'Churro'
+        order_name, reverse = self.ordering or (None, False)
+        order_index = None
+        if (order_name is not None and
+                _RangeIndex.index_name(order_name) in available):
+            order_index = folder._get_index(_RangeIndex.index_name(order_name))
+
+        candidates = None
+        for index, values in equal:
+            matches = set()
+            for value in values:
+                matches |= index.lookup(value)
+            if candidates is None:
+                candidates = matches
+            else:
+                candidates &= matches
+
+        if candidates is not None:
+            names = candidates
+            for index, bounds in ranges.values():
+                keys = index.keys_for(names)
+                names = set(name for name in names
+                            if _matches_bounds(keys[name], bounds))
+            if order_index is not None:
+                names = _sort_by_keys(names, order_index.keys_for(names),
+                                      reverse)
+            else:
+                names = sorted(names)
+            ordered = order_name is None or order_index is not None
+
+        elif ranges or order_index is not None:
+            if order_index is not None:
+                driver = order_name
+                index = order_index
+                bounds = ranges.pop(order_name, (None, []))[1]
+            else:
+                driver = sorted(ranges)[0]
+                index, bounds = ranges.pop(driver)
+            if bounds:
+                names = self._scan_index(index, bounds, reverse, ranges)
+            else:
+                names = self._scan_all(index, reverse, ranges)
+            ordered = order_name is None or driver == order_name
+
+        else:
+            names = sorted(folder.keys())
+            ordered = order_name is None
+
+        results = self._check(names, unindexed)
+        if not ordered:
+            results = self._sort(results, order_name, reverse)
+        return results
+
+    def _scan_index(self, index, bounds, reverse, ranges):
+        lo = hi = None
+        lo_inclusive = hi_inclusive = True
+        for op, key in bounds:
+            if op == 'startswith':
+                bounds_for_op = (('>=', key), ('<=', [1, key[1] + u'\uffff']))
+            else:
+                bounds_for_op = ((op, key),)
+            for op, key in bounds_for_op:
+                if op in ('>', '>=', '==') and (
+                        lo is None or key > lo or (key == lo and op == '>')):
+                    lo, lo_inclusive = key, op != '>'
+                if op in ('<', '<=', '==') and (
+                        hi is None or key < hi or (key == hi and op == '<')):
+                    hi, hi_inclusive = key, op != '<'
+
+        for entry in index.scan_entries(lo, hi, reverse, lo_inclusive,
+                                        hi_inclusive):
+            key, name = entry[:2], entry[2]
+            if not _matches_bounds(key, bounds):
+                continue
+            for other, other_bounds in ranges.values():
+                if not _matches_bounds(other.keys_for([name])[name],
+                                       other_bounds):
+                    break
+            else:
+                yield name
+
+    def _scan_all(self, index, reverse, ranges):
+        """
+        Generates the names of all children in order by an index, followed by
+        the children which aren't in the index because they have no value for
+        its property, in order by name.
+        """
+        seen = set()
+        for name in self._scan_index(index, [], reverse, ranges):
+            seen.add(name)
+            yield name
+        missing = sorted(name for name in self.folder.keys()
+                         if name not in seen)
+        for other, other_bounds in ranges.values():
+            keys = other.keys_for(missing)
+            missing = [name for name in missing
+                       if _matches_bounds(keys[name], other_bounds)]
+        for name in missing:
+            yield name
+
+    def _check(self, names, conditions, batch_size=100):
+        if not conditions:
+            for name in names:
+                yield name, None
+            return
+
+        batch = []
+        for name in names:
+            batch.append(name)
+            if len(batch) == batch_size:
+                for item in self._check_batch(batch, conditions):
+                    yield item
+                batch = []
+        for item in self._check_batch(batch, conditions):
+            yield item
+
+    def _check_batch(self, names, conditions):
+        folder = self.folder
+        names = [name for name in names if name in folder]
+        for name, obj in zip(names, folder.load_many(names)):
+            for prop_name, op, value in conditions:
+                if not _matches(getattr(obj, prop_name, None), op, value):
+                    break
+            else:
+                yield name, obj
+
+    def _sort(self, results, prop_name, reverse):
+        folder = self.folder
+        present = []
+        missing = []
+        for name, obj in results:
+            if obj is None:
+                obj = folder[name]
+            value = getattr(obj, prop_name, None)
+            if value is None:
+                missing.append((name, obj))
+            else:
+                present.append((value, name, obj))
+        present.sort(key=lambda item: item[:2], reverse=reverse)
+        return [(name, obj) for value, name, obj in present] + missing
+
+
+def _matches(value, op, other):
+    """
+    Tests a property value against a query condition.
+    """
+    try:
+        if op == '==':
+            return value == other
+        if op == '!=':
+            return value != other
+        if op == 'in':
+            return value in other
+        if value is None:
+            return False
+        if op == '<':
+            return value < other
+        if op == '<=':
+            return value <= other
+        if op == '>':
+            return value > other
+        if op == '>=':
+            return value >= other
+        if op == 'startswith':
+            return value.startswith(other)
+    except (TypeError, AttributeError):
+        return False
+
+
+def _index_keys(index, values):
+    """
+    Converts query values to keys in an index, returning `None` if any of them
+    can't be looked up in the index.
+    """
+    keys = []
+    for value in values:
+        try:
+            key = index.key(index.prop, value)
+        except (TypeError, ValueError, AttributeError):
+            return None
+        if key is None:
+            return None
+        keys.append(key)
+    return keys
+
+
+def _matches_bounds(key, bounds):
+    """
+    Tests a key from an ordered index against query conditions, which have
+    been converted to keys.  Keys of different types never match.
+    """
+    if key is None:
+        return False
+    for op, bound in bounds:
+        if key[0] != bound[0]:
+            return False
+        if op == 'startswith':
+            if not key[1].startswith(bound[1]):
+                return False
+        elif not _matches(key, op, bound):
+            return False
+    return True
+
+
+def _sort_by_keys(names, keys, reverse):
+    present = [name for name in names if keys[name] is not None]
+    present.sort(key=lambda name: (keys[name], name), reverse=reverse)
+    return present + sorted(name for name in names if keys[name] is None)
+
+
+class _Index(object):
+    """
+    Base class for the indexes a folder keeps of its children's property
+    values.  An index is stored in its own subfolder of the folder's
+    `__index__` folder, so that it is versioned along with the data it
+    indexes, as a number of small JSON files.  Files are only read when they
+    are needed and only files which have changed are written.
+    """
+    kind = None
+    built = False
+
+    @classmethod
+    def index_name(cls, name):
+        return '%s.%s' % (name, cls.kind)
+
+    def __init__(self, session, path, name, folder=None):
+        self.session = session
+        self.path = path
+        self.name = name
+        self.folder = folder
+        self.files = {}
+        self.changed = set()
+
+    def exists(self):
+        return _tree(self.session.fs, self.path) is not None
+
+    def load(self, fnames):
+        """
+        Reads, in a single batch, any of the named files not already read.
+        """
+        fnames = [fname for fname in set(fnames) if fname not in self.files]
+        if fnames:
+            paths = ['%s/%s' % (self.path, fname) for fname in fnames]
+            for fname, data in zip(
+                    fnames, self.session.read_data_many(paths)):
+                self.files[fname] = data if data is not None else {}
+
+    def file(self, fname):
+        data = self.files.get(fname)
+        if data is None:
+            self.load([fname])
+            data = self.files[fname]
+        return data
+
+    def keys_for(self, names):
+        """
+        Returns a dict mapping each of `names` to its key in the index, or to
+        `None` if it isn't in the index, using the reverse files.
+        """
+        reverse_file = self.reverse_file
+        self.load([reverse_file(name) for name in names])
+        return dict((name, self.file(reverse_file(name)).get(name))
+                    for name in names)
+
+    def clear(self):
+        """
+        Empties the index.
+        """
+        node = _tree(self.session.fs, self.path)
+        if node is not None:
+            for fname in node.contents:
+                self.files[fname] = {}
+                self.changed.add(fname)
+        for fname in self.files:
+            self.files[fname] = {}
+            self.changed.add(fname)
+        self.__dict__.pop('prop', None)
+
+    def save(self):
+        session = self.session
+        fs = session.fs
+        if not fs.exists(self.path):
+            fs.mkdirs(self.path)
+        meta = self.file('meta.json')
+        if not meta:
+            meta['property'] = self.name.rsplit('.', 1)[0]
+            self.changed.add('meta.json')
+        for fname in self.changed:
+            data = self.files[fname]
+            path = '%s/%s' % (self.path, fname)
+            if data:
+                session.write_data(path, data)
+            elif fs.exists(path):
+                fs.rm(path)
+        self.changed.clear()
+
+    @reify
+    def prop(self):
+        """
+        The property which is indexed, as declared by a class of the indexed
+        objects, which is needed to convert query values in the same way as
+        indexed values.  Until a child has been indexed, the property of any
+        class which declares the index is used.
+        """
+        meta = self.file('meta.json')
+        if meta.get('class'):
+            plan = _resolve_class(meta['class'])._churro_plan
+            return dict(plan.properties)[meta['property']]
+        return _declared_indexes.get(self.name) or PersistentProperty()
+
+    def update_children(self, children):
+        """
+        Updates the index for the given `(name, obj)` pairs.  `obj` is `None`
+        for children which have been removed.
+        """
+        entries = []
+        for name, obj in children:
+            value = None
+            if obj is not None:
+                for index_name, prop_name, prop, index_type in \
+                        type(obj)._churro_plan.indexes:
+                    if index_name == self.name:
+                        value = self.key(prop, prop.__get__(obj))
+                        self.declare(obj, prop_name)
+                        break
+            entries.append((name, value))
+        self.update_many(entries)
+
+    def stale(self):
+        """
+        Returns `True` if the index must be rebuilt, rather than updated,
+        because its declaration has changed.
+        """
+        return False
+
+    def declare(self, obj, prop_name):
+        meta = self.file('meta.json')
+        if 'class' not in meta:
+            meta['class'] = type(obj)._churro_plan.type_name
+            meta['property'] = prop_name
+            self.changed.add('meta.json')
+
+    def reverse_file(self, name):
+        return 'r%s.json' % _hash_bucket(name, 2)
+
+    @classmethod
+    def merge_file(cls, fname, base, ours, theirs):
+        """
+        Merges two versions of one of the index's files, changed by concurrent
+        transactions, given the data of each version, or `None` for a file
+        which doesn't exist.  Returns the merged data, or `NotImplemented` if
+        the file should be merged line by line instead.  Raises
+        `_MergeConflict` if the versions can't be merged.  Reverse files are
+        merged name by name and the meta file key by key.
+        """
+        if fname.startswith('r') or fname == 'meta.json':
+            return _merge_items(base or {}, ours or {}, theirs or {})
+        return NotImplemented
+
+
+class _EqualityIndex(_Index):
+    """
+    An index of exact property values.  Values are keyed by their JSON
+    representation.  Forward files map keys to sorted lists of names and
+    reverse files map names to keys, so that a child's old entry can be
+    removed without reading the child's old state.  Both are spread over a
+    fixed number of files by hash.
+    """
+    kind = 'eq'
+
+    def key(self, prop, value):
+        if value is None:
+            return None
+        return json.dumps(prop.to_json(value), sort_keys=True,
+                          separators=(',', ':'))
+
+    def forward_file(self, key):
+        return 'f%s.json' % _hash_bucket(key, 2)
+
+    def update_many(self, entries):
+        self.load([self.reverse_file(name) for name, key in entries])
+        fnames = []
+        for name, key in entries:
+            old = self.file(self.reverse_file(name)).get(name)
+            for k in (old, key):
+                if k is not None:
+                    fnames.append(self.forward_file(k))
+        self.load(fnames)
+
+        for name, key in entries:
+            fname = self.reverse_file(name)
+            reverse = self.file(fname)
+            old = reverse.get(name)
+            if old == key:
+                continue
+            if old is not None:
+                _remove_posting(self, self.forward_file(old), old, name)
+                del reverse[name]
+            if key is not None:
+                _add_posting(self, self.forward_file(key), key, name)
+                reverse[name] = key
+            self.changed.add(fname)
+
+    @classmethod
+    def merge_file(cls, fname, base, ours, theirs):
+        """
+        Forward files are merged key by key, keeping the names added and
+        removed by both transactions.
+        """
+        if fname.startswith('f'):
+            return _merge_items(base or {}, ours or {}, theirs or {},
+                                _merge_sets)
+        return super(_EqualityIndex, cls).merge_file(
+            fname, base, ours, theirs)
+
+    def lookup(self, value):
+        """
+        Returns the set of names of children with the given value.
+        """
+        key = self.key(self.prop, value)
+        if key is None:
+            return set()
+        return set(self.file(self.forward_file(key)).get(key, ()))
+
+
+class _RangeIndex(_Index):
+    """
+    An index of children sorted by property value.  Entries are
+    `[rank, key, name]` lists, where `rank` keeps keys of different types from
+    being compared to each other.  Entries are kept in sorted pages of
+    limited size, which are split when they get too big, and a directory
+    file lists the first entry of each page, so that a range can be found by
+    reading the directory and then only the pages the range covers.  Reverse
+    files map names to keys, as for equality indexes.
+    """
+    kind = 'range'
+    page_size = 256
+
+    def key(self, prop, value):
+        if value is None:
+            return None
+        key = prop.index_key(value)
+        if isinstance(key, (int, float)):
+            return [0, key]
+        if isinstance(key, string_types):
+            return [1, key]
+        return [2, json.dumps(key, sort_keys=True)]
+
+    def page_file(self, page_id):
+        return 'p%d.json' % page_id
+
+    def update_many(self, entries):
+        self.load([self.reverse_file(name) for name, key in entries])
+        for name, key in entries:
+            fname = self.reverse_file(name)
+            reverse = self.file(fname)
+            old = reverse.get(name)
+            if old == key:
+                continue
+            if old is not None:
+                self.remove(old + [name])
+                del reverse[name]
+            if key is not None:
+                self.insert(key + [name])
+                reverse[name] = key
+            self.changed.add(fname)
+
+    def insert(self, entry):
+        # The directory is only rewritten if it changes, so that concurrent
+        # transactions changing different pages can be merged.
+        directory = self.file('dir.json')
+        pages = directory.setdefault('pages', [])
+        if not pages:
+            page_id = self.new_page(directory, [entry])
+            pages.append([entry, page_id])
+            self.changed.add('dir.json')
+            return
+
+        i = max(bisect.bisect_right([page[0] for page in pages], entry) - 1, 0)
+        page_id = pages[i][1]
+        fname = self.page_file(page_id)
+        entries = self.file(fname).setdefault('entries', [])
+        bisect.insort(entries, entry)
+        if pages[i][0] != entries[0]:
+            pages[i][0] = entries[0]
+            self.changed.add('dir.json')
+        self.changed.add(fname)
+        if len(entries) > self.page_size:
+            half = len(entries) // 2
+            moved = entries[half:]
+            del entries[half:]
+            pages.insert(i + 1, [moved[0], self.new_page(directory, moved)])
+            self.changed.add('dir.json')
+
+    def new_page(self, directory, entries):
+        page_id = directory.get('next', 0)
+        directory['next'] = page_id + 1
+        fname = self.page_file(page_id)
+        self.files[fname] = {'entries': entries}
+        self.changed.add(fname)
+        return page_id
+
+    def remove(self, entry):
+        directory = self.file('dir.json')
+        pages = directory.get('pages')
+        if not pages:
+            return
+        i = bisect.bisect_right([page[0] for page in pages], entry) - 1
+        if i < 0:
+            return
+        fname = self.page_file(pages[i][1])
+        entries = self.file(fname).get('entries', [])
+        j = bisect.bisect_left(entries, entry)
+        if j == len(entries) or entries[j] != entry:
+            return
+        del entries[j]
+        if not entries:
+            del pages[i]
+            self.files[fname] = {}
+            self.changed.add('dir.json')
+        elif pages[i][0] != entries[0]:
+            pages[i][0] = entries[0]
+            self.changed.add('dir.json')
+        self.changed.add(fname)
+
+    @classmethod
+    def merge_file(cls, fname, base, ours, theirs):
+        """
+        Pages are merged entry by entry, and the directory page by page.  A
+        page can't be merged if one transaction split it, or removed its
+        last entries, while the other added entries past the end of what was
+        left, since those entries may belong in another page.  Nor can it be
+        merged if its first entry wouldn't match the merged directory.  Pages
+        created by both transactions always conflict.
+        """
+        if fname.startswith('p'):
+            if base is None or ours is None or theirs is None:
+                raise _MergeConflict()
+            base, ours, theirs = [data.get('entries', [])
+                                  for data in (base, ours, theirs)]
+            _check_page(base, ours, theirs)
+            _check_page(base, theirs, ours)
+            entries = _merge_sets(base, ours, theirs)
+            if not entries or entries[0] != _merge_first(
+                    *[page[0] if page else None
+                      for page in (base, ours, theirs)]):
+                raise _MergeConflict()
+            return {'entries': entries}
+
+        if fname == 'dir.json':
+            if base is None or ours is None or theirs is None:
+                raise _MergeConflict()
+            pages = [dict((page_id, first) for first, page_id in
+                          data.pop('pages', []))
+                     for data in (base, ours, theirs)]
+            merged = _merge_items(base, ours, theirs)
+            firsts = _merge_items(pages[0], pages[1], pages[2], _merge_first)
+            merged['pages'] = sorted(
+                [first, page_id] for page_id, first in firsts.items())
+            return merged
+
+        return super(_RangeIndex, cls).merge_file(fname, base, ours, theirs)
+
+    def scan(self, lo=None, hi=None, reverse=False):
+        """
+        Generates the names of children with values from `lo`, inclusive, to
+        `hi`, exclusive.
+        """
+        prop = self.prop
+        for entry in self.scan_entries(
+                self.key(prop, lo), self.key(prop, hi), reverse):
+            yield entry[2]
+
+    def scan_entries(self, lo=None, hi=None, reverse=False, lo_inclusive=True,
+                     hi_inclusive=False):
+        """
+        Generates the entries with keys between `lo` and `hi`, reading pages
+        one at a time as they are needed.  A range with only one bound is
+        limited to keys of the same type as that bound.
+        """
+        if lo is not None and hi is None:
+            hi, hi_inclusive = [lo[0] + 1], False
+        elif hi is not None and lo is None:
+            lo, lo_inclusive = [hi[0]], True
+
+        def above_lo(key):
+            return lo is None or key > lo or (lo_inclusive and key == lo)
+
+        def below_hi(key):
+            return hi is None or key < hi or (hi_inclusive and key == hi)
+
+        pages = self.file('dir.json').get('pages', [])
+        first_keys = [page[0][:2] for page in pages]
+        if not reverse:
+            start = 0
+            if lo is not None:
+                start = max(bisect.bisect_left(first_keys, lo) - 1, 0)
+            for first, page_id in pages[start:]:
+                entries = self.file(self.page_file(page_id)).get('entries', [])
+                i = 0 if lo is None else bisect.bisect_left(entries, lo)
+                for entry in entries[i:]:
+                    key = entry[:2]
+                    if not below_hi(key):
+                        return
+                    if above_lo(key):
+                        yield entry
+        else:
+            stop = len(pages)
+            if hi is not None:
+                if hi_inclusive:
+                    stop = bisect.bisect_right(first_keys, hi)
+                else:
+                    stop = bisect.bisect_left(first_keys, hi)
+            for first, page_id in reversed(pages[:stop]):
+                entries = self.file(self.page_file(page_id)).get('entries', [])
+                for entry in reversed(entries):
+                    key = entry[:2]
+                    if not above_lo(key):
+                        return
+                    if below_hi(key):
+                        yield entry
+
+
+class _TextIndex(_RangeIndex):
+    """
+    A full text index.  This is an ordered index of `[1, term, name, count]`
+    entries, one for each distinct term in each child's value, so that all of
+    the terms beginning with a prefix can be found by reading a range of
+    pages.  The directory also records the number of children indexed, for
+    ranking.  Reverse files map names to `{term: count}` dicts.
+    """
+    kind = 'text'
+
+    def key(self, prop, value):
+        if value is None:
+            return None
+        counts = {}
+        for term in prop.index_terms(value):
+            counts[term] = counts.get(term, 0) + 1
+        return counts or None
+
+    def update_many(self, entries):
+        self.load([self.reverse_file(name) for name, terms in entries])
+        directory = self.file('dir.json')
+        for name, terms in entries:
+            fname = self.reverse_file(name)
+            reverse = self.file(fname)
+            old = reverse.get(name)
+            if old == terms:
+                continue
+            if old is not None:
+                for term, count in old.items():
+                    self.remove([1, term, name, count])
+                del reverse[name]
+                directory['docs'] -= 1
+            if terms is not None:
+                for term, count in terms.items():
+                    self.insert([1, term, name, count])
+                reverse[name] = terms
+                directory['docs'] = directory.get('docs', 0) + 1
+            self.changed.add(fname)
+            self.changed.add('dir.json')
+
+    @classmethod
+    def merge_file(cls, fname, base, ours, theirs):
+        """
+        The counts of indexed children in the directory are added together.
+        """
+        if fname == 'dir.json' and None not in (base, ours, theirs):
+            docs = [data.pop('docs', 0) for data in (base, ours, theirs)]
+            merged = super(_TextIndex, cls).merge_file(
+                fname, base, ours, theirs)
+            merged['docs'] = docs[1] + docs[2] - docs[0]
+            return merged
+        return super(_TextIndex, cls).merge_file(fname, base, ours, theirs)
+
+    def match(self, prefix):
+        """
+        Returns a dict mapping the names of children with a term beginning
+        with `prefix` to a relevance score.  Rare terms and repeated terms
+        score higher, and a whole word match scores higher than a match on
+        only the beginning of a word.
+        """
+        docs = self.file('dir.json').get('docs', 0)
+        postings = {}
+        for entry in self.scan_entries([1, prefix], [1, prefix + u'\uffff'],
+                                       hi_inclusive=True):
+            if entry[1].startswith(prefix):
+                postings.setdefault(entry[1], []).append(entry[2:])
+
+        scores = {}
+        for term, matches in postings.items():
+            weight = math.log(1.0 + float(docs) / len(matches))
+            if term == prefix:
+                weight *= 2
+            for name, count in matches:
+                scores[name] = max(scores.get(name, 0), count * weight)
+        return scores
+
+
+def _check_declared(index_name, flag):
+    if index_name not in _declared_indexes:
+        raise ValueError("Not declared with %s=True by any class: %s" % (
+            flag, index_name.rsplit('.', 1)[0]))
+
+
+def _tokenize(text):
+    """
+    Splits text into lower case words for full text indexing.
+    """
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+def _add_posting(index, fname, key, name):
+    postings = index.file(fname).setdefault(key, [])
+    i = bisect.bisect_left(postings, name)
+    if i == len(postings) or postings[i] != name:
+        postings.insert(i, name)
+        index.changed.add(fname)
+
+
+def _remove_posting(index, fname, key, name):
+    data = index.file(fname)
+    postings = data.get(key)
+    if postings:
+        i = bisect.bisect_left(postings, name)
+        if i < len(postings) and postings[i] == name:
+            del postings[i]
+            if not postings:
+                del data[key]
+            index.changed.add(fname)
+
+
+class _ProjectionIndex(_Index):
+    """
+    Not an index as such, but a columnar copy of the values of the properties
+    named by a folder's `projected_fields` for each of its children, kept in
+    a single file so that all of them can be read at once.  The file holds the
+    sorted list of child names and, for each property, a list of JSON values
+    in the same order.  A child which doesn't have one of the properties has
+    `None` for it.
+    """
+    kind = 'columns'
+    fname = 'columns.json'
+
+    def stale(self):
+        data = self.file(self.fname)
+        return bool(data) and data['fields'] != list(
+            self.folder.projected_fields)
+
+    def update_children(self, children):
+        fields = list(self.folder.projected_fields)
+        data = self.file(self.fname)
+        if not data:
+            data.update({'fields': fields, 'names': [], 'types': {},
+                         'columns': dict((field, []) for field in fields)})
+        names = data['names']
+        columns = data['columns']
+        types = data['types']
+        plans = {}
+        for name, obj in children:
+            i = bisect.bisect_left(names, name)
+            present = i < len(names) and names[i] == name
+            if obj is None:
+                if present:
+                    del names[i]
+                    for column in columns.values():
+                        del column[i]
+                continue
+
+            cls = type(obj)
+            props = plans.get(cls)
+            if props is None:
+                props = plans[cls] = dict(cls._churro_plan.properties)
+            if not present:
+                names.insert(i, name)
+            for field in fields:
+                prop = props.get(field)
+                value = None
+                if prop is not None:
+                    value = prop.to_json(prop.__get__(obj))
+                    if field not in types:
+                        types[field] = cls._churro_plan.type_name
+                if present:
+                    columns[field][i] = value
+                else:
+                    columns[field].insert(i, value)
+        self.changed.add(self.fname)
+
+    def column(self, field):
+        """
+        Returns a list of the values of `field`, converted from JSON by the
+        property of the first class found to declare it.
+        """
+        data = self.file(self.fname)
+        # Nothing is written until the folder has children.
+        values = data.get('columns', {}).get(field, [])
+        type_name = data.get('types', {}).get(field)
+        if type_name is not None:
+            prop = dict(_resolve_class(type_name)._churro_plan.properties)[
+                field]
+            from_json = _overridden(prop, 'from_json')
+            if from_json is not None:
+                return [from_json(value) if value is not None else None
+                        for value in values]
+        return list(values)
+
+
+class _AggregateIndex(_Index):
+    """
+    The number of children in a folder and, for each of the properties named
+    by the folder's `aggregated_fields`, the count, sum, minimum and maximum
+    of the children's numeric values, kept in a single file.  Reverse files
+    map each child's name to its values, so that a child's old values can be
+    subtracted when it changes.  Removing a child holding the minimum or
+    maximum value marks the minimum and maximum as stale, to be recomputed
+    from the reverse files the next time they're needed.
+    """
+    kind = 'aggregate'
+    fname = 'stats.json'
+
+    def fields(self):
+        return list(self.folder.aggregated_fields)
+
+    def stale(self):
+        data = self.file(self.fname)
+        return bool(data) and data['fields'] != self.fields()
+
+    def update_children(self, children):
+        fields = self.fields()
+        data = self.file(self.fname)
+        if not data:
+            data.update({'fields': fields, 'count': 0, 'aggregates': dict(
+                (field, {'count': 0, 'sum': 0, 'min': None, 'max': None})
+                for field in fields)})
+        aggregates = data['aggregates']
+        reverse_file = self.reverse_file
+        self.load([reverse_file(name) for name, obj in children])
+        plans = {}
+        for name, obj in children:
+            fname = reverse_file(name)
+            reverse = self.file(fname)
+            old = reverse.pop(name, None)
+            if old is not None:
+                data['count'] -= 1
+                for field, value in old.items():
+                    stats = aggregates[field]
+                    stats['count'] -= 1
+                    stats['sum'] -= value
+                    if value in (stats['min'], stats['max']):
+                        stats['stale'] = True
+            if obj is not None:
+                cls = type(obj)
+                props = plans.get(cls)
+                if props is None:
+                    props = plans[cls] = dict(cls._churro_plan.properties)
+                values = {}
+                for field in fields:
+                    prop = props.get(field)
+                    if prop is not None:
+                        value = prop.__get__(obj)
+                        if _is_number(value):
+                            values[field] = value
+                data['count'] += 1
+                for field, value in values.items():
+                    stats = aggregates[field]
+                    stats['count'] += 1
+                    stats['sum'] += value
+                    if stats['min'] is None or value < stats['min']:
+                        stats['min'] = value
+                    if stats['max'] is None or value > stats['max']:
+                        stats['max'] = value
+                reverse[name] = values
+            self.changed.add(fname)
+        self.changed.add(self.fname)
+
+    def aggregate(self, field):
+        data = self.file(self.fname)
+        stats = data.get('aggregates', {}).get(field)
+        if stats is None:
+            # Nothing is written until the folder has children.
+            return {'count': 0, 'sum': 0, 'min': None, 'max': None}
+        if stats.get('stale'):
+            node = _tree(self.session.fs, self.path)
+            fnames = [fname for fname in node.contents
+                      if fname.startswith('r')]
+            self.load(fnames)
+            values = [values[field] for fname in fnames
+                      for values in self.file(fname).values()
+                      if field in values]
+            stats['min'] = min(values) if values else None
+            stats['max'] = max(values) if values else None
+            del stats['stale']
+            # Written along with the next change to the folder.
+            self.changed.add(self.fname)
+        return dict(stats)
+
+
+def _is_number(value):
+    return isinstance(value, number_types) and not isinstance(value, bool)
+
+
+_index_types = dict((index_type.kind, index_type)
+                    for index_type in (_EqualityIndex, _RangeIndex,
+                                       _TextIndex, _ProjectionIndex,
+                                       _AggregateIndex))
+
+
+def _dump_data(data):
+    """
+    Encodes `data`, a dict, as written by `_Session.write_data`.
+    """
+    def dumps(value):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    lines = []
+    for key in sorted(data):
+        value = data[key]
+        if isinstance(value, list) and value:
+            value = '[\n%s\n]' % ',\n'.join(dumps(item) for item in value)
+        elif isinstance(value, dict) and value:
+            value = '{\n%s\n}' % ',\n'.join(
+                '%s:%s' % (dumps(k), dumps(v))
+                for k, v in sorted(value.items()))
+        else:
+            value = dumps(value)
+        lines.append('%s:%s' % (dumps(key), value))
+    return ('{\n%s\n}\n' % ',\n'.join(lines)).encode('utf8')
+
+
+def _hash_bucket(name, chars):
+    if not isinstance(name, bytes):
+        name = name.encode('utf8')
+    return hashlib.md5(name).hexdigest()[:chars]
+
+
+class _Session(object):
+    closed = False
+    root = None
+    read_only = False
+    lock = None
+    grouped = None
+
+    def __init__(self, fs, cache=None, codec=None, blobs=None, release=None,
+                 join=True, group=None):
+        self.fs = fs
+        self.group = group
+        self.blobs = blobs
+        self.release = release
+        self.cache = cache
+        if codec is None:
+            codec = JsonCodec()
+        self.codec = codec
+        self.dirty = {}
+        self.changes = {}
+        self.indexes = {}
+        if join:
+            transaction.get().join(self)
+
+    def register(self, obj):
+        """
+        Records a top level persistent object as needing to be visited at
+        flush time.
+        """
+        self.dirty[id(obj)] = obj
+
+    def changed(self, folder, name):
+        """
+        Records that the child of `folder` with the given name has been written
+        or removed, so that the folder's indexes can be brought up to date at
+        the end of the flush.
+        """
+        if folder is None:
+            return
+        entry = self.changes.get(id(folder))
+        if entry is None:
+            entry = self.changes[id(folder)] = (folder, set())
+        entry[1].add(name)
+
+    def abort(self, tx):
+        """
+        Part of datamanager API.
+        """
+        self.close()
+
+    tpc_abort = abort
+
+    def tpc_begin(self, tx):
+        """
+        Part of datamanager API.
+        """
+
+    def commit(self, tx):
+        """
+        Part of datamanager API.
+        """
+        group = self.group
+        if group is not None:
+            # In group commit mode this session votes after AcidFS, so must
+            # hand AcidFS's changes to the group, or flush, before then.
+            self.flush()
+            self.grouped = group.prepare(self.fs)
+            if self.grouped is None:
+                self.lock_for_commit(tx)
+
+    def tpc_vote(self, tx):
+        """
+        Part of datamanager API.
+        """
+        if self.group is not None:
+            if self.grouped:
+                self.group.commit(self.grouped, tx.description)
+            return
+        self.flush()
+        self.lock_for_commit(tx)
+
+    def lock_for_commit(self, tx):
+        """
+        Keeps other threads from committing to the repository until AcidFS
+        has committed this session's changes, if there are any.
+        """
+        fs_session = self.fs.session
+        if (fs_session is None or fs_session.closed or
+                not fs_session.tree.dirty):
+            # Nothing for AcidFS to commit.
+            return
+        # AcidFS locks the repository while committing, but its lock only
+        # excludes other processes, so threads are excluded here until AcidFS
+        # is done, which is after the rest of the transaction.  The lock is
+        # reentrant, since more than one session in a transaction may be
+        # committing to the same repository.
+        lock = _commit_lock(self.fs.db)
+        lock.acquire()
+        tx.addAfterCommitHook(_release_lock, (lock,))
+        self.rebase(fs_session)
+
+    def rebase(self, fs_session):
+        """
+        If the head has moved since this transaction began, applies the
+        transaction's changes to the current head, so that AcidFS only has to
+        fast forward.  Files changed by both this transaction and another are
+        merged by `_merge_objects`.  Raises `ConflictError` if they can't be.
+        """
+        base = fs_session.prev_commit
+        if not base:
+            return
+        db = self.fs.db
+        ref = fs_session.head
+        if ref != 'HEAD':
+            ref = 'refs/heads/' + ref
+        current = _rev_parse(db, ref)
+        if current is None or current.encode('ascii') == base:
+            return
+
+        tree = fs_session.tree
+        changes = _diff_trees(db, tree.committed_oid, tree.save())
+        paths = [path for path, old, new in changes]
+        updates = []
+        for (path, old, new), theirs in zip(
+                changes, _blob_ids(db, current, paths)):
+            if theirs != old:
+                new = _merge_objects(db, self.codec, path, old, new, theirs)
+                if new is None:
+                    raise acidfs.ConflictError()
+            updates.append((path, new))
+
+        tree = acidfs._TreeNode.read(
+            db, _write_tree(db, current, updates).encode('ascii'),
+            fs_session.path_encoding)
+        tree.committed_oid = _git(db, 'rev-parse', current + '^{tree}').encode(
+            'ascii')
+        tree.dirty = True
+        fs_session.tree = tree
+        fs_session.prev_commit = current.encode('ascii')
+
+    def flush(self, top=None):
+        """
+        Writes dirty objects to the filesystem.  If `top` is given, only `top`
+        and its descendants are written.
+        """
+        dirty = self.dirty
+        if not dirty:
+            # Nothing to do
+            return
+
+        if top is None:
+            pending = list(dirty.values())
+            dirty.clear()
+        else:
+            pending = [obj for obj in dirty.values() if _is_inside(obj, top)]
+            for obj in pending:
+                del dirty[id(obj)]
+
+        # Parents are saved before their children so that folders exist before
+        # anything is written to them.
+        pending.sort(key=_depth)
+        for obj in pending:
+            if _is_attached(obj, self.root):
+                obj._save(self)
+
+        # Ancestors outside of `top` may still have other dirty descendants, so
+        # are left marked.
+        for obj in pending:
+            node = obj
+            node._subtree_dirty = False
+            while node is not top:
+                node = node.__parent__
+                if node is None or not node._subtree_dirty:
+                    break
+                node._subtree_dirty = False
+
+        if self.changes:
+            self.update_indexes()
+
+    def update_indexes(self):
+        """
+        Brings the indexes of folders whose children have been written or
+        removed up to date.
+        """
+        changes, self.changes = self.changes, {}
+        for folder, names in changes.values():
+            if _is_attached(folder, self.root):
+                folder._update_indexes(names)
+
+    def tpc_finish(self, tx):
+        """
+        Part of datamanager API.
+        """
+        fs_session = self.fs.session
+        if (fs_session is not None and not fs_session.closed and
+                not fs_session.tree.dirty):
+            # AcidFS leaves its session open when it has nothing to commit,
+            # and the next transaction would then reuse it without it taking
+            # part in that transaction, losing its changes.
+            fs_session.close()
+        self.close()
+
+    def sortKey(self):
+        if self.group is not None:
+            # Votes last, so the group's commit is only made once every other
+            # resource in the transaction has voted to commit.
+            return '~Churro'
+        return 'Churro'
 
     def close(self):
         self.closed = True
+        blobs, self.blobs = self.blobs, None
+        if self.release is not None:
+            self.release(self.fs, blobs)
+        elif blobs is not None:
+            blobs.close()
+
+    def get_root(self, factory):
+        if self.root is not None: # is not None
+            return self.root
+
+        fs = self.fs
+        path = '/' + CHURRO_FOLDER
+        if fs.exists(path):
+            root = self.load(path)
+            root._dirty = False
+        else:
+            root = factory()
+            self.register(root)
+        root._fs = fs
+        root._session = self
+        root.__name__ = root.__parent__ = None
+        self.root = root
+        return root
+
+    def load(self, path):
+        """
+        Decodes the object stored at `path`, using the cache if there is one.
+        """
+        return self.load_many([path])[0]
+
+    def load_many(self, paths):
+        """
+        Decodes the objects stored at `paths`, using the cache if there is one.
+        Objects which aren't cached are read from Git in a single batch.
+        """
+        fs = self.fs
+        cache = self.cache
+        oids = [fs.hash(path) for path in paths]
+        if cache is None:
+            objs = [None] * len(oids)
+        else:
+            objs = [cache.get(oid) for oid in oids]
+
+        missing = [i for i, obj in enumerate(objs) if obj is None]
+        if missing:
+            blobs = self.read_blobs([oids[i] for i in missing])
+            for i, data in zip(missing, blobs):
+                objs[i] = obj = self.decode(data)
+                if cache is not None:
+                    cache.put(oids[i], obj, len(data))
+        return objs
+
+    def read(self, path):
+        with self.fs.open(path, 'rb') as stream:
+            return stream.read()
+
+    def read_blobs(self, oids):
+        if self.blobs is None or self.blobs.closed:
+            self.blobs = _BlobReader(self.fs.db)
+        return self.blobs.read(oids)
+
+    def read_data_many(self, paths):
+        """
+        Reads the JSON files at `paths`, which aren't persistent objects, in a
+        single batch.  `None` is returned for any files which don't exist.
+        """
+        fs = self.fs
+        session = fs._session()
+        cache = self.cache
+        oids = []
+        for path in paths:
+            node = session.find(fs._mkpath(path))
+            oids.append(node.hash() if isinstance(node, acidfs._Blob) else None)
+
+        results = [None] * len(oids)
+        missing = []
+        for i, oid in enumerate(oids):
+            if oid is None:
+                continue
+            if cache is not None:
+                results[i] = cache.get(oid)
+            if results[i] is None:
+                missing.append(i)
+
+        if missing:
+            blobs = self.read_blobs([oids[i] for i in missing])
+            for i, data in zip(missing, blobs):
+                results[i] = value = json.loads(data.decode('utf8'))
+                if cache is not None:
+                    cache.put(oids[i], value, len(data))
+        return results
+
+    def write_data(self, path, data):
+        """
+        Writes `data`, a dict, to `path` as compact JSON, with each of its
+        items, and each item of a list or dict directly inside of it, on a
+        line of its own.  AcidFS merges concurrent transactions line by line,
+        so this lets changes to different entries of the same file be merged.
+        """
+        with self.fs.open(path, 'wb') as stream:
+            stream.write(_dump_data(data))
+
+    def index(self, folder, index_name):
+        """
+        Returns the index with the given name for `folder`.  The same instance
+        is used for the rest of the transaction, so files already read by the
+        index are not read again.
+        """
+        path = resource_path(folder, CHURRO_INDEX, index_name)
+        index = self.indexes.get(path)
+        if index is None:
+            index_type = _index_types[index_name.rsplit('.', 1)[1]]
+            index = self.indexes[path] = index_type(
+                self, path, index_name, folder)
+        return index
 
-    def get_root(self, factory):
-        if self.root is not None: # is not None
-            return self.root
+    def decode(self, data):
+        """
+        Decodes `data`, using whichever codec it was written with.
+        """
+        codec = self.codec
+        if not codec.accepts(data):
+            codec = _codec_for(data)
+        return codec.loads(data)
+
+    def write(self, path, obj):
+        """
+        Encodes `obj` with the repository's codec and writes it to `path`.
+        """
+        with self.fs.open(path, 'wb') as stream:
+            stream.write(self.codec.dumps(obj))
 
+    def write_many(self, items):
+        """
+        Encodes and writes each of the `(path, obj)` tuples in `items`.  The
+        blobs are all written to Git by a single process and are then added
+        directly to the trees of the folders they belong in, which must
+        already exist.
+        """
+        if not items:
+            return
         fs = self.fs
-        path = '/' + CHURRO_FOLDER
-        if fs.exists(path):
-            root = codec.decode(fs.open(path, DECODE_MODE))
-            root._dirty = False
-        else:
-            root = factory()
-        root._fs = fs
-        root.__name__ = root.__parent__ = None
-        self.root = root
-        return root
+        dumps = self.codec.dumps
+        oids = _hash_objects(fs.db, [dumps(obj) for path, obj in items])
+        nodes = {}
+        for (path, obj), oid in zip(items, oids):
+            dirname, _, fname = path.rpartition('/')
+            node = nodes.get(dirname)
+            if node is None:
+                node = nodes[dirname] = _tree(fs, dirname or '/')
+            node.set(fname, (b'blob', oid, None))
+
+    def reencode(self, path='/'):
+        """
+        Rewrites any objects in the folder at `path` and its subfolders whose
+        stored form differs from what the repository's codec would write.
+        """
+        count = 0
+        node = _tree(self.fs, path)
+        for name, (type, oid, obj) in list(node.contents.items()):
+            fspath = '%s/%s' % (path.rstrip('/'), name)
+            if type == b'tree':
+                count += self.reencode(fspath)
+            elif name.endswith(CHURRO_EXT):
+                data = self.read(fspath)
+                encoded = self.codec.dumps(self.decode(data))
+                if encoded != data:
+                    with self.fs.open(fspath, 'wb') as stream:
+                        stream.write(encoded)
+                    count += 1
+        return count
+
+    def list_folder(self, path):
+        """
+        Returns a dict mapping the names of the children of the folder at
+        `path` to their types, either 'object' or 'folder'.  The listing is
+        built from the folder's Git tree, which is read once, rather than by
+        probing the filesystem for each entry.  Subtrees are folders if they
+        contain folder data, which for subtrees not modified in this
+        transaction is checked with a single batched query to Git.
+        """
+        node = _tree(self.fs, path)
+        if node is None:
+            return {}
+
+        cache = self.cache
+        oid = None if node.dirty else node.oid
+        if cache is not None and oid is not None:
+            listing = cache.get(oid)
+            if listing is not None:
+                return listing
+
+        listing = {}
+        subtrees = []
+        for fname, (type, entry_oid, obj) in node.contents.items():
+            if fname == CHURRO_INDEX:
+                continue
+            if type == b'blob':
+                if fname.endswith(CHURRO_EXT) and fname != CHURRO_FOLDER:
+                    listing[fname[:-len(CHURRO_EXT)]] = 'object'
+            elif obj is not None:
+                if CHURRO_FOLDER in obj.contents:
+                    listing[fname] = 'folder'
+            else:
+                subtrees.append((fname, entry_oid))
+
+        if subtrees:
+            paths = [oid + b':' + CHURRO_FOLDER.encode('ascii')
+                     for fname, oid in subtrees]
+            for (fname, entry_oid), found in zip(
+                    subtrees, _batch_check(self.fs.db, paths)):
+                if found:
+                    listing[fname] = 'folder'
+
+        if cache is not None and oid is not None:
+            cache.put(oid, listing, sum(len(name) for name in listing) +
+                      len(listing) * _LISTING_ENTRY_SIZE)
+        return listing
+
+
+_class_registry = {}
+
+
+def _register_tag(tag, cls):
+    if '.' in tag:
+        raise ValueError("Type tag must not contain '.': %s" % tag)
+    other = _class_registry.get(tag)
+    if other is not None and (other._churro_plan.dotted_name !=
+                              cls._churro_plan.dotted_name):
+        raise ValueError("Type tag %s is already used by %s" % (
+            tag, other._churro_plan.dotted_name))
+    _class_registry[tag] = cls
+
+
+def _resolve_class(name):
+    """
+    Returns the class identified in stored data by `name`, which is either a
+    type tag or a dotted name.  Classes are only imported the first time they
+    are needed.
+    """
+    cls = _class_registry.get(name)
+    if cls is None:
+        if '.' not in name:
+            raise ValueError(
+                "Unknown type tag: %s.  The module defining the class with "
+                "this tag must be imported before objects of the class are "
+                "read." % name)
+        cls = _class_registry[name] = _resolve_dotted_name(name)
+    return cls
 
 
 def _resolve_dotted_name(name):
@@ -632,11 +3772,807 @@ def _resolve_dotted_name(name):
     return target
 
 
+def _tree(fs, path):
+    """
+    Returns AcidFS's in memory node for the Git tree at `path`, or `None` if
+    there isn't a folder at that path.
+    """
+    node = fs._session().find(fs._mkpath(path))
+    if isinstance(node, acidfs._TreeNode):
+        return node
+
+
+class _NoLock(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, tb):
+        pass
+
+
+_no_lock = _NoLock()
+
+
+def _locked(obj):
+    """
+    Returns the lock which serializes changes to the bookkeeping of objects
+    shared by threads using the same snapshot, or, for any other object, a
+    lock which does nothing.
+    """
+    session = obj._session
+    lock = session.lock if session is not None else None
+    return _no_lock if lock is None else lock
+
+
+def _is_ghost(obj):
+    """
+    Tells whether `obj` is a ghost, without loading it.
+    """
+    return type(obj) is _Ghost
+
+
+def _make_ghost(folder, name, type):
+    ghost = _Ghost()
+    ghost.__parent__ = folder
+    ghost.__name__ = name
+    ghost._fs = folder._fs
+    ghost._session = folder._session
+    ghost._ghost_type = type
+    ghost._dirty = False
+    return ghost
+
+
+def _resolve_child(folder, name):
+    """
+    Returns the child `name` of `folder`, which may be a ghost, or `None` if
+    there is no such child.  Unless the folder's listing has already been
+    read, the child is looked up in the Git trees and a ghost is made for it,
+    which the folder adopts if its listing is read later.
+    """
+    state = folder.__dict__
+    if '_contents' in state or folder._fs is None:
+        return folder._lazy_child(name)
+    resolved = state.setdefault('_resolved', {})
+    objref = resolved.get(name)
+    if objref is not None:
+        return objref[1]
+    if name in (CHURRO_INDEX, CHURRO_FOLDER[:-len(CHURRO_EXT)]):
+        return None
+
+    fs = folder._fs
+    if _is_ghost(folder):
+        # Don't know the folder's class, so whether it is sharded, but bucket
+        # subfolders, unlike child folders, don't have folder data.
+        path = resource_path(folder)
+        segment = name
+        type = _child_type(fs, path, name)
+        node = _tree(fs, path) if type is None else None
+        if node is not None:
+            lengths = set(len(fname) for fname, entry in node.contents.items()
+                          if entry[0] == b'tree')
+            for length in lengths:
+                bucket = _hash_bucket(name, length)
+                bucket_path = '%s/%s' % (path.rstrip('/'), bucket)
+                if (bucket in node.contents and
+                        not fs.exists(bucket_path + '/' + CHURRO_FOLDER)):
+                    type = _child_type(fs, bucket_path, name)
+                    if type is not None:
+                        segment = '%s/%s' % (bucket, name)
+                        break
+        if type is None:
+            return None
+        state.setdefault('_ghost_segments', {})[name] = segment
+    else:
+        segment = folder._child_segment(name)
+        path = resource_path(folder, *segment.split('/')[:-1])
+        type = _child_type(fs, path, name)
+        if type is None:
+            return None
+
+    ghost = _make_ghost(folder, name, type)
+    resolved[name] = (type, ghost)
+    return ghost
+
+
+def _child_type(fs, path, name):
+    """
+    Returns 'object' or 'folder' if the folder at `path` in the filesystem
+    directly contains a child called `name`, or `None`.
+    """
+    node = _tree(fs, path)
+    if node is None:
+        return None
+    entry = node.contents.get(name + CHURRO_EXT)
+    if entry is not None and entry[0] == b'blob':
+        return 'object'
+    entry = node.contents.get(name)
+    if entry is not None and entry[0] == b'tree':
+        if fs.exists('%s/%s/%s' % (path.rstrip('/'), name, CHURRO_FOLDER)):
+            return 'folder'
+    return None
+
+
+def _batch_check(db, objects):
+    """
+    Returns a list of booleans indicating which of the given objects, named in
+    any way understood by `git cat-file`, exist in the Git database.
+    """
+    proc = subprocess.Popen(['git', 'cat-file', '--batch-check'], cwd=db,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, err = proc.communicate(b''.join(obj + b'\n' for obj in objects))
+    if proc.returncode != 0: # pragma no cover
+        raise subprocess.CalledProcessError(proc.returncode,
+                                            'git cat-file --batch-check')
+    return [not line.endswith(b' missing') for line in out.splitlines()]
+
+
+def _hash_objects(db, blobs, chunk_size=1000):
+    """
+    Writes blobs to the Git database, returning their oids.  Each blob is
+    written to a temporary file so that a whole chunk of them can be handed to
+    a single `git hash-object` process.
+    """
+    oids = []
+    tmp = tempfile.mkdtemp('.churro')
+    try:
+        for i in range(0, len(blobs), chunk_size):
+            paths = []
+            for j, data in enumerate(blobs[i:i + chunk_size]):
+                fspath = os.path.join(tmp, str(j))
+                with open(fspath, 'wb') as f:
+                    f.write(data)
+                paths.append(fspath)
+            proc = subprocess.Popen(
+                ['git', 'hash-object', '-w', '--no-filters', '--stdin-paths'],
+                cwd=db, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            out, err = proc.communicate(
+                ''.join(fspath + '\n' for fspath in paths).encode('utf8'))
+            if proc.returncode != 0: # pragma no cover
+                raise subprocess.CalledProcessError(
+                    proc.returncode, 'git hash-object')
+            oids.extend(out.split())
+    finally:
+        shutil.rmtree(tmp)
+    return oids
+
+
+class _BlobReader(object):
+    """
+    Reads blobs from the Git database through a single long running
+    `git cat-file --batch` process, rather than starting a new process for
+    each blob read.
+    """
+    # Requests are written in chunks small enough that they can't fill up the
+    # pipe while git is blocked writing responses we haven't read yet.
+    chunk_size = 64
+
+    def __init__(self, db):
+        self.proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'], cwd=db,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, oids):
+        """
+        Returns a list of the contents of the blobs with the given oids.
+        """
+        proc = self.proc
+        blobs = []
+        chunk_size = self.chunk_size
+        try:
+            for i in range(0, len(oids), chunk_size):
+                chunk = oids[i:i + chunk_size]
+                proc.stdin.write(b''.join(oid + b'\n' for oid in chunk))
+                proc.stdin.flush()
+                for oid in chunk:
+                    header = proc.stdout.readline().split()
+                    if len(header) != 3: # pragma no cover
+                        raise IOError("Unable to read blob %s" % oid)
+                    size = int(header[2])
+                    blobs.append(proc.stdout.read(size))
+                    proc.stdout.read(1)  # newline
+        except: # pragma no cover
+            # Output from git may be left unread, so can't be used again.
+            self.close()
+            raise
+        return blobs
+
+    @property
+    def closed(self):
+        # The pipes may also have been closed by the garbage collector, which
+        # finalizes a reader kept for reuse along with the rest of an ended
+        # thread's data, before the reader is rescued by `_Lease.__del__`.
+        return self.proc.stdin.closed or self.proc.stdout.closed
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+_commit_locks = {}
+_commit_locks_lock = threading.Lock()
+
+
+def _commit_lock(db):
+    """
+    Returns the lock used to keep threads in this process from committing to
+    the repository at `db` at the same time.
+    """
+    db = os.path.realpath(db)
+    with _commit_locks_lock:
+        lock = _commit_locks.get(db)
+        if lock is None:
+            lock = _commit_locks[db] = threading.RLock()
+        return lock
+
+
+def _release_lock(status, lock):
+    lock.release()
+
+
+class _CommitGroup(object):
+    """
+    Writes the changes of sessions which commit at about the same time as a
+    single Git commit.  The first session to commit leads a group: it waits
+    for up to `window` seconds for other sessions to join, or until there are
+    `size` of them, then commits for all of them while they wait.  A session
+    which arrives while a group is being committed waits to lead, or be part
+    of, the next group.
+
+    Each session's changes are a list of `(path, old, new)` tuples, giving the
+    ids of the blob at `path` before and after the session's changes, `None`
+    standing for no blob.  A change is applied if the file is unchanged since
+    the session read it.  Otherwise the two versions are merged by
+    `_merge_objects`, and if they can't be merged the session fails with
+    `ConflictError` without affecting the rest of the group.
+    """
+
+    def __init__(self, db, wd, head, codec, window, size):
+        self.db = db
+        self.wd = wd
+        self.head = head
+        self.codec = codec
+        self.window = window
+        self.size = size
+        self.cond = threading.Condition()
+        self.pending = []
+        self.leading = False
+
+    def prepare(self, fs):
+        """
+        Takes the changes made in the current AcidFS session of `fs`, so that
+        they can be committed by the group rather than by AcidFS.  Returns
+        `None` if there are no changes, or if AcidFS must commit them itself,
+        as it must for the first commit to a branch.
+        """
+        session = fs.session
+        if (session is None or session.closed or not session.tree.dirty or
+                not session.prev_commit):
+            return None
+        tree = session.tree
+        changes = _diff_trees(self.db, tree.committed_oid, tree.save())
+        # Leave AcidFS with nothing to do.
+        tree.dirty = False
+        session.close()
+        return changes
+
+    def commit(self, changes, description):
+        """
+        Commits `changes` as part of a group, returning once the group's
+        commit has been written and the head updated.
+        """
+        entry = _GroupEntry(changes, description)
+        with self.cond:
+            self.pending.append(entry)
+            if self.leading:
+                self.cond.notify_all()
+                while not (entry.done or entry.lead):
+                    self.cond.wait()
+            else:
+                self.leading = entry.lead = True
+        if not entry.done:
+            self.lead()
+        if entry.error is not None:
+            raise entry.error
+
+    def lead(self):
+        deadline = time.time() + self.window
+        with self.cond:
+            while len(self.pending) < self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = self.pending[:self.size]
+            del self.pending[:self.size]
+        try:
+            self.write(batch)
+        except Exception as e:
+            for entry in batch:
+                if entry.error is None:
+                    entry.error = e
+        finally:
+            with self.cond:
+                for entry in batch:
+                    entry.done = True
+                if self.pending:
+                    self.pending[0].lead = True
+                else:
+                    self.leading = False
+                self.cond.notify_all()
+
+    def write(self, batch):
+        db = self.db
+        with _commit_lock(db):
+            # Excludes AcidFS in other processes, as AcidFS would.
+            fd = os.open(os.path.join(db, 'acidfs.lock'),
+                         os.O_WRONLY | os.O_CREAT)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                self.write_locked(batch)
+            finally:
+                os.close(fd)
+
+    def write_locked(self, batch):
+        db = self.db
+        ref = self.head
+        if ref != 'HEAD':
+            ref = 'refs/heads/' + ref
+            if _symbolic_ref(db) == ref:
+                ref = 'HEAD'
+        current = _rev_parse(db, ref)
+        paths = sorted(set(
+            path for entry in batch for path, old, new in entry.changes))
+        committed = dict(zip(paths, _blob_ids(db, current, paths)))
+        state = dict(committed)
+        descriptions = []
+        for entry in batch:
+            updates = {}
+            for path, old, new in entry.changes:
+                oid = state[path]
+                if oid != old:
+                    new = _merge_objects(db, self.codec, path, old, new, oid)
+                    if new is None:
+                        entry.error = acidfs.ConflictError()
+                        break
+                updates[path] = new
+            else:
+                state.update(updates)
+                if entry.description:
+                    descriptions.append(entry.description)
+
+        updates = [(path, oid) for path, oid in sorted(state.items())
+                   if oid != committed[path]]
+        if not updates:
+            return
+        tree = _write_tree(db, current, updates)
+        message = '\n\n'.join(descriptions) or 'AcidFS transaction'
+        commit = _git(db, 'commit-tree', tree, '-p', current, '-m', message)
+        if ref == 'HEAD' and self.wd:
+            _git(self.wd, 'reset', '--hard', commit)
+        else:
+            _git(db, 'update-ref', ref, commit, current)
+
+
+class _GroupEntry(object):
+    lead = False
+    done = False
+    error = None
+
+    def __init__(self, changes, description):
+        self.changes = changes
+        self.description = description
+
+
+_null_oid = b'0' * 40
+
+
+def _git(cwd, *args, **kw):
+    """
+    Runs a Git command, returning its output, stripped, as a native string.
+    """
+    output = subprocess.check_output(('git',) + args, cwd=cwd, **kw)
+    return output.strip().decode('ascii')
+
+
+def _symbolic_ref(db):
+    proc = subprocess.Popen(['git', 'symbolic-ref', '-q', 'HEAD'], cwd=db,
+                            stdout=subprocess.PIPE)
+    out, err = proc.communicate()
+    return out.strip().decode('utf8')
+
+
+def _diff_trees(db, old, new):
+    """
+    Returns a list of `(path, old, new)` tuples for the files which differ
+    between two trees, with the ids of the blobs in each tree, or `None`.
+    """
+    output = subprocess.check_output(
+        ['git', 'diff-tree', '-r', '-z', '--no-renames', old, new], cwd=db)
+    fields = output.split(b'\0')
+    changes = []
+    for i in range(0, len(fields) - 1, 2):
+        meta = fields[i].split()
+        old_oid, new_oid = meta[2], meta[3]
+        changes.append((fields[i + 1],
+                        None if old_oid == _null_oid else old_oid,
+                        None if new_oid == _null_oid else new_oid))
+    return changes
+
+
+def _blob_ids(db, commit, paths):
+    """
+    Returns the ids of the objects at `paths` in `commit`, or `None` for paths
+    with nothing there.
+    """
+    commit = commit.encode('ascii')
+    proc = subprocess.Popen(['git', 'cat-file', '--batch-check'], cwd=db,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, err = proc.communicate(
+        b''.join(commit + b':' + path + b'\n' for path in paths))
+    if proc.returncode != 0: # pragma no cover
+        raise subprocess.CalledProcessError(proc.returncode,
+                                            'git cat-file --batch-check')
+    return [None if line.endswith(b' missing') else line.split()[0]
+            for line in out.splitlines()]
+
+
+def _merge_objects(db, codec, path, base, ours, theirs):
+    """
+    Merges two versions of a file changed by concurrent transactions,
+    returning the id of the merged blob, or `None` if they can't be merged.
+    Persistent objects are first offered to their class's `_resolve_conflict`
+    method, and index files to their index type's `merge_file` method.
+    Otherwise files are merged line by line.
+    """
+    index_type = _index_type_for(path)
+    if index_type is not None:
+        data = [None if oid is None else json.loads(subprocess.check_output(
+                    ['git', 'cat-file', 'blob', oid], cwd=db).decode('utf8'))
+                for oid in (base, ours, theirs)]
+        try:
+            merged = index_type.merge_file(
+                path.rsplit(b'/', 1)[1].decode('utf8'), *data)
+        except _MergeConflict:
+            return None
+        if merged is not NotImplemented:
+            # An empty file would have to be removed, which can't be told
+            # apart from a conflict.
+            if not merged:
+                return None
+            return _hash_objects(db, [_dump_data(merged)])[0]
+
+    if (path.endswith(CHURRO_EXT.encode('ascii')) and ours is not None and
+            theirs is not None):
+        objs = []
+        for oid in (base, ours, theirs):
+            if oid is None:
+                objs.append(None)
+                continue
+            data = subprocess.check_output(['git', 'cat-file', 'blob', oid],
+                                           cwd=db)
+            decoder = codec if codec.accepts(data) else _codec_for(data)
+            objs.append(decoder.loads(data))
+        resolved = type(objs[1])._resolve_conflict(*objs)
+        if resolved is not None:
+            return _hash_objects(db, [codec.dumps(resolved)])[0]
+    return _merge_blobs(db, base, ours, theirs)
+
+
+def _index_type_for(path):
+    """
+    Returns the index type of the index file at `path`, or `None` if it isn't
+    in an index.
+    """
+    parts = path.decode('utf8').split('/')
+    if len(parts) < 3 or parts[-3] != CHURRO_INDEX:
+        return None
+    return _index_types.get(parts[-2].rsplit('.', 1)[-1])
+
+
+class _MergeConflict(Exception):
+    """
+    Raised when two versions of an index file can't be merged.
+    """
+
+
+def _merge_value(base, ours, theirs):
+    """
+    Merges a value changed by either of two transactions, `None` standing for
+    no value.
+    """
+    if ours == base:
+        return theirs
+    if theirs == base or theirs == ours:
+        return ours
+    raise _MergeConflict()
+
+
+def _merge_items(base, ours, theirs, merge=_merge_value):
+    """
+    Merges dicts key by key, using `merge` to merge the values of each key.
+    Keys merged to `None` are left out.
+    """
+    merged = {}
+    for key in set(base) | set(ours) | set(theirs):
+        value = merge(base.get(key), ours.get(key), theirs.get(key))
+        if value is not None:
+            merged[key] = value
+    return merged
+
+
+def _entry_set(entries):
+    return dict((json.dumps(entry, sort_keys=True), entry)
+                for entry in entries or ())
+
+
+def _merge_sets(base, ours, theirs):
+    """
+    Merges sorted lists, keeping the items added and removed by either
+    transaction.  Returns `None` if the merged list is empty.
+    """
+    base, ours, theirs = map(_entry_set, (base, ours, theirs))
+    merged = dict(base)
+    for side in (ours, theirs):
+        for key in set(base) - set(side):
+            merged.pop(key, None)
+        for key in set(side) - set(base):
+            merged[key] = side[key]
+    return sorted(merged.values()) or None
+
+
+def _merge_first(base, ours, theirs):
+    """
+    Merges the first entry of a range index page.  If both transactions
+    changed it, the page's first entry is the lower of the two, as long as
+    neither removed the page.
+    """
+    try:
+        return _merge_value(base, ours, theirs)
+    except _MergeConflict:
+        if None in (base, ours, theirs):
+            raise
+        return min(ours, theirs)
+
+
+def _check_page(base, side, other):
+    """
+    Raises `_MergeConflict` if `side` removed entries from a range index page
+    while `other` added entries after the last one left by `side`.
+    """
+    base_set, side_set = _entry_set(base), _entry_set(side)
+    if set(base_set) - set(side_set):
+        added = [entry for key, entry in _entry_set(other).items()
+                 if key not in base_set]
+        if added and (not side or max(added) > side[-1]):
+            raise _MergeConflict()
+
+
+def _merge_blobs(db, base, ours, theirs):
+    """
+    Merges two versions of a file line by line, returning the id of the
+    merged blob, or `None` if they can't be merged.
+    """
+    if base is None or ours is None or theirs is None:
+        return None
+    tmp = tempfile.mkdtemp('.churro')
+    try:
+        paths = []
+        for i, oid in enumerate((ours, base, theirs)):
+            path = os.path.join(tmp, str(i))
+            with open(path, 'wb') as f:
+                f.write(subprocess.check_output(
+                    ['git', 'cat-file', 'blob', oid], cwd=db))
+            paths.append(path)
+        proc = subprocess.Popen(['git', 'merge-file', '-p'] + paths, cwd=db,
+                                stdout=subprocess.PIPE)
+        merged, err = proc.communicate()
+        if proc.returncode != 0:
+            return None
+        return _hash_objects(db, [merged])[0]
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _write_tree(db, commit, updates):
+    """
+    Writes the tree of `commit` with the given `(path, oid)` updates applied,
+    returning its id.  An oid of `None` removes the file at that path.
+    """
+    tmp = tempfile.mkdtemp('.churro')
+    try:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, 'index'))
+        _git(db, 'read-tree', commit, env=env)
+        proc = subprocess.Popen(['git', 'update-index', '--index-info'],
+                                cwd=db, env=env, stdin=subprocess.PIPE)
+        proc.communicate(b''.join(
+            b'0 ' + _null_oid + b'\t' + path + b'\n' if oid is None else
+            b'100644 ' + oid + b'\t' + path + b'\n'
+            for path, oid in updates))
+        if proc.returncode != 0: # pragma no cover
+            raise subprocess.CalledProcessError(proc.returncode,
+                                                'git update-index')
+        return _git(db, 'write-tree', env=env)
+    finally:
+        shutil.rmtree(tmp)
+
+
+class _SnapshotSession(_Session):
+    """
+    The session used by a `Snapshot`.  It isn't joined to any transaction and
+    refuses to record changes.  Reads are serialized by a lock, so the session
+    may be used by more than one thread at a time.
+    """
+    read_only = True
+
+    def __init__(self, fs, cache, codec):
+        super(_SnapshotSession, self).__init__(fs, cache, codec, join=False)
+        self.lock = fs.lock
+
+    def register(self, obj):
+        raise TypeError("Objects in a snapshot can't be changed.")
+
+    def read_blobs(self, oids):
+        with self.lock:
+            return super(_SnapshotSession, self).read_blobs(oids)
+
+
+class _SnapshotFS(object):
+    """
+    Stands in for `AcidFS` in a `Snapshot`, reading the Git trees of a single
+    commit.  Only the parts of the `AcidFS` API that `Churro` uses to read are
+    provided.
+    """
+
+    def __init__(self, db, commit, path_encoding):
+        self.db = db
+        self.commit = commit
+        self.lock = threading.RLock()
+        tree = _rev_parse(db, commit + '^{tree}').encode('ascii')
+        self.tree = acidfs._TreeNode.read(db, tree, path_encoding)
+
+    def _session(self):
+        return self
+
+    def _mkpath(self, path):
+        return [name for name in path.split('/') if name]
+
+    def find(self, path):
+        with self.lock:
+            return self.tree.find(path)
+
+    def exists(self, path):
+        return bool(self.find(self._mkpath(path)))
+
+    def hash(self, path):
+        obj = self.find(self._mkpath(path))
+        if not obj:
+            raise IOError("No such file or directory: %s" % path)
+        return obj.hash()
+
+    def open(self, path, mode='rb'):
+        if mode != 'rb':
+            raise TypeError("Snapshots are read only.")
+        obj = self.find(self._mkpath(path))
+        if not isinstance(obj, acidfs._Blob):
+            raise IOError("No such file: %s" % path)
+        return obj.open()
+
+
+def _rev_parse(db, name):
+    """
+    Returns the id of the Git object named by `name`, or `None` if there
+    isn't one.
+    """
+    proc = subprocess.Popen(['git', 'rev-parse', '--verify', '--quiet', name],
+                            cwd=db, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return out.strip().decode('ascii')
+
+
+class _HandlePool(object):
+    """
+    Keeps idle `AcidFS` instances for a repository, each with the blob reader
+    used with it, if any, so that they can be reused by new threads rather
+    than opened again.  Each instance is only used by one thread at a time.
+    New instances are opened when none are idle and at most `size` idle
+    instances are kept.
+    """
+
+    def __init__(self, open_fs, size):
+        self.open_fs = open_fs
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns an `(fs, blobs)` tuple, where `blobs` may be `None`.
+        """
+        with self.lock:
+            idle = self.idle
+            for i in range(len(idle) - 1, -1, -1):
+                # Skip any handle still in the middle of a transaction.
+                session = idle[i][0].session
+                if session is None or session.closed:
+                    return idle.pop(i)
+        return self.open_fs(), None
+
+    def put(self, fs, blobs):
+        if blobs is not None and blobs.closed:
+            blobs = None
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((fs, blobs))
+                return
+        if blobs is not None:
+            blobs.close()
+
+
+class _Lease(object):
+    """
+    A handle from a `_HandlePool` held by one thread, which is returned to the
+    pool when the thread's local data is discarded as the thread ends.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.fs, self.blobs = pool.get()
+
+    def release(self, fs, blobs):
+        """
+        Called by a session as it closes, to keep its blob reader for the
+        thread's next session.
+        """
+        if blobs is not None and blobs.closed:
+            blobs = None
+        self.blobs = blobs
+
+    def __del__(self):
+        self.pool.put(self.fs, self.blobs)
+
+
+# Rough per entry overhead of a cached folder listing, for sizing the cache.
+_LISTING_ENTRY_SIZE = 48
+
+
+def _clone(obj):
+    """
+    Makes a copy of a decoded persistent object which shares no mutable state
+    with the original.  References to the top level instance are set up in the
+    same way as when decoding.
+    """
+    cls = type(obj)
+    clone = cls.__new__(cls)
+    for attr, value in obj.__dict__.items():
+        if attr.startswith('.'):
+            value = _clone_value(value)
+            if isinstance(value, Persistent):
+                value.__setinstance__(clone)
+            clone.__dict__[attr] = value
+    return clone
+
+
+def _clone_value(value):
+    if isinstance(value, Persistent):
+        return _clone(value)
+    if isinstance(value, list):
+        return [_clone_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _clone_value(item)) for key, item in value.items())
+    return value
+
+
 def resource_path(obj, *elements):
     def _inner(obj, path):
-        if obj.__parent__ is not None:
-            _inner(obj.__parent__, path)
-            path.append(obj.__name__)
+        folder = obj.__parent__
+        if folder is not None:
+            _inner(folder, path)
+            path.append(folder._child_segment(obj.__name__))
         return path
     path = _inner(obj, [])
     if elements:
@@ -645,9 +4581,70 @@ def resource_path(obj, *elements):
 
 
 def _set_dirty(obj):
-    while obj is not None:
+    """
+    Marks an object's own state as needing to be written.
+    """
+    if not obj._dirty:
+        _register(obj)
         obj._dirty = True
+
+
+def _check_writable(obj):
+    """
+    Raises `TypeError` if `obj` was loaded from a snapshot.  Called before a
+    change is made to a folder, which is only registered with its session
+    after the change.
+    """
+    session = obj._session
+    if session is not None and session.read_only:
+        raise TypeError("Objects in a snapshot can't be changed.")
+
+
+def _register(obj):
+    """
+    Records an object with its session so that it will be visited at flush
+    time, and marks its ancestors as having a dirty descendant.  The walk up
+    the tree stops at the first ancestor that is already marked.
+    """
+    session = obj._session
+    if session is not None:
+        session.register(obj)
+    node = obj.__parent__
+    while node is not None and not node._subtree_dirty:
+        node._subtree_dirty = True
+        node = node.__parent__
+
+
+def _depth(obj):
+    depth = 0
+    while obj.__parent__ is not None:
+        depth += 1
         obj = obj.__parent__
+    return depth
 
 
+def _is_inside(obj, top):
+    while obj is not None:
+        if obj is top:
+            return True
+        obj = obj.__parent__
+    return False
+
 
+def _is_attached(obj, root):
+    """
+    Returns boolean indicating whether `obj` is still reachable from `root`,
+    ie, hasn't been removed, replaced or deactivated since being marked dirty.
+    """
+    while obj.__parent__ is not None:
+        folder = obj.__parent__
+        state = folder.__dict__
+        if '_contents' in state:
+            objref = state['_contents'].get(obj.__name__)
+        else:
+            # Found by PersistentFolder.resolve without reading the listing.
+            objref = state.get('_resolved', {}).get(obj.__name__)
+        if objref is None or objref[1] is not obj:
+            return False
+        obj = folder
+    return obj is root
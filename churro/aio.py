@@ -0,0 +1,206 @@
+"""
+An `asyncio` front end for `Churro` repositories.  Requires Python 3.7.
+"""
+import asyncio
+import functools
+import transaction
+
+from concurrent.futures import ThreadPoolExecutor
+
+from churro import Churro
+from churro import PersistentFolder
+
+
+class AsyncChurro(object):
+    """
+    Gives coroutines access to a repository without blocking the event loop.
+    Reading from and writing to Git, and encoding and decoding objects, are
+    done in worker threads.
+
+    ``repo``
+
+       The path to the repository in the real, local filesystem.
+
+    ``max_workers``
+
+       The maximum number of worker threads, which is also the maximum number
+       of transactions that can be open at once.  Coroutines entering a
+       transaction when none are available wait for one to end.  The default
+       is `8`.
+
+    Any other keyword arguments are passed to :class:`~churro.Churro`, which is
+    available as the `churro` attribute.
+
+    Transactions are used as asynchronous context managers::
+
+        repo = AsyncChurro('/path/to/folder')
+
+        async with repo.transaction() as tx:
+            contact = await tx.traverse('/contacts/fred')
+            contact.city = 'Paris'
+
+    The transaction is committed when the block is exited normally, and
+    aborted if an exception is raised.
+    """
+
+    def __init__(self, repo, max_workers=8, **kw):
+        kw.setdefault('pool_size', max_workers)
+        self.churro = Churro(repo, **kw)
+        self.max_workers = max_workers
+        self.idle = []
+        self.slots = None
+
+    def transaction(self):
+        """
+        Returns a new :class:`~churro.aio.AsyncTransaction`, which begins when
+        its `async with` block is entered.
+        """
+        return AsyncTransaction(self)
+
+    async def _acquire(self):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        return ThreadPoolExecutor(1, thread_name_prefix='churro')
+
+    def _release(self, worker):
+        self.idle.append(worker)
+        self.slots.release()
+
+    def close(self):
+        """
+        Stops the worker threads which aren't in use by a transaction.
+        """
+        idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.shutdown()
+
+
+class AsyncTransaction(object):
+    """
+    A transaction, run in a single worker thread from entering its
+    `async with` block until leaving it.  Objects gotten from a transaction
+    may be read and changed by the coroutine which opened it, but anything
+    which might read from the repository, such as iterating over a folder or
+    getting the children of a folder which haven't been loaded yet, should be
+    done in the transaction's thread using :meth:`run`, or with the other
+    awaitable methods.  Objects must not be used once their transaction has
+    ended.
+    """
+    worker = None
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    async def __aenter__(self):
+        self.worker = await self.repo._acquire()
+        try:
+            await self.run(transaction.begin)
+        except:
+            self._end()
+            raise
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        try:
+            if type is None:
+                try:
+                    await self.run(transaction.commit)
+                except:
+                    await self.run(transaction.abort)
+                    raise
+            else:
+                await self.run(transaction.abort)
+        finally:
+            self._end()
+
+    def _end(self):
+        worker, self.worker = self.worker, None
+        self.repo._release(worker)
+
+    async def run(self, fn, *args, **kw):
+        """
+        Calls `fn` with the given arguments in the transaction's thread,
+        returning its result.
+        """
+        if self.worker is None:
+            raise RuntimeError("Transaction is not open.")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.worker, functools.partial(fn, *args, **kw))
+
+    async def root(self):
+        """
+        Gets the root folder of the repository.
+        """
+        return await self.run(self.repo.churro.root)
+
+    async def traverse(self, path):
+        """
+        Gets the object at `path`.  Raises `KeyError` if there is no object at
+        `path`.  See :meth:`churro.Churro.traverse`.
+        """
+        return await self.run(self.repo.churro.traverse, path)
+
+    async def get(self, path, default=None):
+        """
+        Gets the object at `path`, or `default` if there is no object there.
+        """
+        return await self.run(_get, self.repo.churro, path, default)
+
+    async def load_many(self, paths):
+        """
+        Gets the objects at `paths`, in a single trip to the transaction's
+        thread.  `None` is returned for any path with no object.  Objects in
+        the same folder are read together, in a single batch.  See
+        :meth:`churro.PersistentFolder.load_many`.
+        """
+        return await self.run(_load_many, self.repo.churro, paths)
+
+    async def flush(self):
+        """
+        Writes any unsaved changes to the repository without committing.
+        """
+        return await self.run(self.repo.churro.flush)
+
+    async def commit(self):
+        """
+        Commits the changes made so far and begins a new transaction.
+        """
+        return await self.run(transaction.commit)
+
+    async def abort(self):
+        """
+        Discards the changes made so far and begins a new transaction.
+        """
+        return await self.run(transaction.abort)
+
+
+def _get(churro, path, default):
+    try:
+        return churro.traverse(path)
+    except KeyError:
+        return default
+
+
+def _load_many(churro, paths):
+    objs = [None] * len(paths)
+    folders = {}
+    for i, path in enumerate(paths):
+        names = [name for name in path.split('/') if name]
+        if names:
+            folders.setdefault('/'.join(names[:-1]), []).append((i, names[-1]))
+        else:
+            objs[i] = churro.root()
+
+    for path, children in folders.items():
+        folder = _get(churro, path, None)
+        if not isinstance(folder, PersistentFolder):
+            continue
+        children = [(i, name) for i, name in children if name in folder]
+        loaded = folder.load_many([name for i, name in children])
+        for (i, name), obj in zip(children, loaded):
+            objs[i] = obj
+    return objs
@@ -0,0 +1,41 @@
+"""
+Command line utilities for `Churro` repositories.
+"""
+import argparse
+import transaction
+
+from churro import Churro
+from churro import FastJsonCodec
+from churro import JsonCodec
+from churro import MsgpackCodec
+
+codecs = {
+    'json': JsonCodec,
+    'compact': lambda: JsonCodec(indent=None),
+    'fast': FastJsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def reencode(argv=None):
+    """
+    Entry point for the `churro-reencode` command, which rewrites every object
+    in a repository in the given format and commits the result.
+    """
+    parser = argparse.ArgumentParser(
+        description="Rewrite every object in a Churro repository using the "
+                    "given serialization format.")
+    parser.add_argument('repo', help="Path to the repository.")
+    parser.add_argument('--codec', choices=sorted(codecs), default='compact',
+                        help="Format to write.  Default is 'compact'.")
+    parser.add_argument('--head', default='HEAD',
+                        help="Branch to update.  Default is the current head.")
+    args = parser.parse_args(argv)
+
+    repo = Churro(args.repo, head=args.head, create=False,
+                  codec=codecs[args.codec]())
+    count = repo.reencode()
+    tx = transaction.get()
+    tx.note(u'Re-encode repository as %s' % args.codec)
+    tx.commit()
+    print('Rewrote %d objects.' % count)
@@ -4,7 +4,13 @@ try:
 except ImportError:  # pragma no cover
     import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError:  # pragma no cover
+    from io import StringIO
+
 import churro
+import sys
 import transaction
 
 
@@ -139,6 +145,57 @@ class ChurroTests(unittest.TestCase):
         with self.assertRaises(KeyError):
             del root['a']
 
+    def test_listing_ignores_other_files(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestFolder('a', 'b')
+        root['a']['b'] = TestFolder('c', 'd')
+        root['c'] = TestClass('e', 'f')
+        repo.flush()
+        repo.fs.mkdir('/junk')
+        with repo.fs.open('/junk/x.churro', 'w') as f:
+            f.write(u'{}')
+        with repo.fs.open('/notes.txt', 'w') as f:
+            f.write(u'Nothing to see here.')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(sorted(root.keys()), ['a', 'c'])
+        self.assertEqual(root._contents['a'][0], 'folder')
+        self.assertEqual(root._contents['c'][0], 'object')
+        self.assertEqual(list(root['a'].keys()), ['b'])
+
+        root['d'] = TestFolder('g', 'h')
+        repo.flush()
+        del root.__dict__['_contents']
+        self.assertEqual(sorted(root.keys()), ['a', 'c', 'd'])
+
+    def test_delete_and_replace(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestFolder('a', 'b')
+        root['a']['b'] = TestClass('c', 'd')
+        root['c'] = TestClass('e', 'f')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        del root['a']
+        self.assertEqual(len(root), 1)
+        root['a'] = TestFolder('g', 'h')
+        self.assertEqual(len(root), 2)
+        self.assertEqual(len(root['a']), 0)
+        del root['c']
+        self.assertEqual(list(root.keys()), ['a'])
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(list(root.keys()), ['a'])
+        self.assertEqual(root['a'].one, 'g')
+        self.assertNotIn('b', root['a'])
+
     def test_pop(self):
         repo = self.make_one()
         root = repo.root()
@@ -332,6 +389,1493 @@ class ChurroTests(unittest.TestCase):
         obj = root['test']
         self.assertEqual(obj.one[0].two, 'bathsalts')
 
+    def test_flush_only_writes_dirty_objects(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestClass('a', 'b')
+        root['b'] = TestClass('c', 'd')
+        root['f'] = TestFolder('e', 'f')
+        root['f']['c'] = TestClass('g', 'h')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        saved = []
+        for obj in (root, root['a'], root['b'], root['f'], root['f']['c']):
+            obj._save = lambda session, obj=obj: saved.append(obj.__name__)
+        root['f']['c'].two = 'i'
+        self.assertFalse(root['f']._dirty)
+        self.assertTrue(root['f']._subtree_dirty)
+        self.assertTrue(root._subtree_dirty)
+        repo.flush()
+        self.assertEqual(saved, ['c'])
+        self.assertFalse(root['f']._subtree_dirty)
+        self.assertFalse(root._subtree_dirty)
+
+    def test_folder_metadata_not_rewritten_for_child_changes(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['f'] = TestFolder('e', 'f')
+        root['f']['c'] = TestClass('g', 'h')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        folder_hash = repo.fs.hash('/f/__folder__.churro')
+        root_hash = repo.fs.hash('/__folder__.churro')
+        root['f']['c'].two = 'i'
+        root['f']['d'] = TestClass('j', 'k')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(repo.fs.hash('/f/__folder__.churro'), folder_hash)
+        self.assertEqual(repo.fs.hash('/__folder__.churro'), root_hash)
+        self.assertEqual(root['f']['c'].two, 'i')
+        self.assertEqual(root['f']['d'].one, 'j')
+
+    def test_object_cache(self):
+        repo = self.make_one(cache_size=10)
+        root = repo.root()
+        root['a'] = TestClass(churro.PersistentList([1, 2]), 'b')
+        root['b'] = TestClass('c', TestClass('d', 'e'))
+        transaction.commit()
+
+        root = repo.root()
+        a = root['a']
+        self.assertEqual(repo.cache.misses, 3) # root, root listing, a
+        self.assertEqual(repo.cache.hits, 0)
+        a.one.append(3)
+        transaction.commit()
+
+        root = repo.root()
+        self.assertEqual(root['a'].one, [1, 2, 3])
+        self.assertEqual(root['b'].two.one, 'd')
+        self.assertEqual(repo.cache.hits, 1) # root
+        self.assertEqual(repo.cache.misses, 6)
+        root['b'].two.one = 'f'
+        transaction.commit()
+
+        root = repo.root()
+        b = root['b']
+        self.assertEqual(b.two.one, 'f')
+        self.assertIs(b.two.__instance__, b)
+        self.assertEqual(repo.cache.hits, 2)
+
+        transaction.abort()
+        root = repo.root()
+        self.assertEqual(sorted(root.keys()), ['a', 'b'])
+        self.assertEqual(repo.cache.hits, 4) # root, root listing
+
+    def test_object_cache_eviction(self):
+        from churro import ObjectCache
+        cache = ObjectCache(2)
+        cache.put('a', TestClass(1, 2), 10)
+        cache.put('b', TestClass(3, 4), 10)
+        self.assertEqual(cache.get('a').one, 1)
+        cache.put('c', TestClass(5, 6), 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.total_bytes, 20)
+
+        cache = ObjectCache(max_bytes=25)
+        cache.put('a', TestClass(1, 2), 10)
+        cache.put('b', TestClass(3, 4), 10)
+        cache.put('c', TestClass(5, 6), 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), None)
+        cache.put('d', TestClass(7, 8), 30)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_sharded_folder(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['big'] = big = TestShardedFolder('a', 'b')
+        for i in range(20):
+            big['obj%d' % i] = TestClass(i, None)
+        big['sub'] = TestFolder('c', 'd')
+        big['sub']['child'] = TestClass('e', 'f')
+        self.assertEqual(len(big), 21)
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        big = root['big']
+        self.assertEqual(big.one, 'a')
+        self.assertEqual(big['obj7'].one, 7)
+        self.assertEqual(list(big._contents.buckets), [big._bucket('obj7')])
+        self.assertTrue(repo.fs.exists(
+            '/big/%s/obj7.churro' % big._bucket('obj7')))
+        self.assertIn('obj3', big)
+        self.assertNotIn('obj20', big)
+        self.assertEqual(big['sub']['child'].two, 'f')
+        big['obj3'].two = 'changed'
+        del big['obj4']
+        big['new'] = TestClass('g', 'h')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        big = root['big']
+        self.assertEqual(len(big), 21)
+        self.assertEqual(
+            sorted(big.keys()),
+            sorted(['obj%d' % i for i in range(20) if i != 4] + ['sub', 'new']))
+        self.assertEqual(big['obj3'].two, 'changed')
+        self.assertEqual(big['new'].one, 'g')
+        self.assertEqual(dict(big.items())['obj5'].one, 5)
+
+    def test_serialization_plan(self):
+        plan = TestClassWithDateProperties._churro_plan
+        self.assertEqual(plan.dotted_name,
+                         'churro.tests.TestClassWithDateProperties')
+        self.assertEqual(sorted(name for name, prop in plan.properties),
+                         ['four', 'one', 'three', 'two'])
+        attr, from_json, set = plan.decoders['one']
+        self.assertEqual((attr, from_json, set), ('.one', None, None))
+        attr, from_json, set = plan.decoders['three']
+        self.assertEqual(from_json, TestClassWithDateProperties.three.from_json)
+
+        data = churro.JsonCodec.encode_hook(TestClass('a', None))
+        self.assertEqual(data, {
+            '__churro_class__': 'churro.tests.TestClass',
+            '__churro_data__': {'one': 'a', 'two': None}})
+        obj = churro.JsonCodec.decode_hook(data)
+        self.assertIsInstance(obj, TestClass)
+        self.assertEqual(obj.one, 'a')
+
+    def test_type_tags(self):
+        data = churro.JsonCodec.encode_hook(TestTaggedClass('a', 'b'))
+        self.assertEqual(data['__churro_class__'], 'test-tagged')
+        obj = churro.JsonCodec.decode_hook(data)
+        self.assertIsInstance(obj, TestTaggedClass)
+
+        # Data written before the tag was declared can still be read
+        data['__churro_class__'] = 'churro.tests.TestTaggedClass'
+        obj = churro.JsonCodec.decode_hook(data)
+        self.assertIsInstance(obj, TestTaggedClass)
+        self.assertEqual(obj.two, 'b')
+
+        with self.assertRaises(ValueError):
+            class BadTag(churro.Persistent):
+                __churro_tag__ = 'bad.tag'
+        with self.assertRaises(ValueError):
+            class DuplicateTag(churro.Persistent):
+                __churro_tag__ = 'test-tagged'
+
+        class Subclass(TestTaggedClass):
+            pass
+        self.assertEqual(Subclass._churro_plan.type_name,
+                         'churro.tests.Subclass')
+
+        # Tags of classes which haven't been imported aren't mistaken for
+        # module names.
+        data['__churro_class__'] = 'os'
+        with self.assertRaises(ValueError):
+            churro.JsonCodec.decode_hook(data)
+
+    def test_codecs(self):
+        from churro import FastJsonCodec
+        from churro import JsonCodec
+        from churro import MsgpackCodec
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestClass('a', churro.PersistentDict({'b': 1}))
+        transaction.commit()
+
+        for codec in (JsonCodec(indent=None), FastJsonCodec(),
+                      MsgpackCodec(), JsonCodec()):
+            repo = self.make_one(codec=codec)
+            root = repo.root()
+            self.assertEqual(root['a'].two['b'], 1)
+            root['a'].set_dirty()
+            root['b'] = TestClass('c', 'd')
+            transaction.commit()
+
+            repo = self.make_one()
+            with repo.fs.open('/b.churro', 'rb') as f:
+                data = f.read()
+            self.assertTrue(codec.accepts(data))
+            self.assertEqual(codec.loads(data).one, 'c')
+            if codec.header:
+                self.assertTrue(data.startswith(codec.header))
+            root = repo.root()
+            self.assertEqual(root['a'].two['b'], 1)
+            transaction.abort()
+
+        self.assertNotIn(b' ', JsonCodec(indent=None).dumps(TestClass(1, 2)))
+        nested = TestClass([TestClass('x', None), {'y': [1]}], 'z')
+        for codec in (JsonCodec(), FastJsonCodec(), MsgpackCodec()):
+            self.assertEqual(codec.loads(codec.dumps({'a': [1]})), {'a': [1]})
+            obj = codec.loads(codec.dumps(TestClass([1], {'b': 2})))
+            self.assertEqual((obj.one, obj.two), ([1], {'b': 2}))
+            obj = codec.loads(codec.dumps(nested))
+            self.assertEqual(obj.one[0].one, 'x')
+            self.assertEqual(obj.one[1], {'y': [1]})
+            obj = codec.loads(codec.dumps(TestClass('__churro_class__', 1)))
+            self.assertEqual(obj.one, '__churro_class__')
+        with self.assertRaises(ValueError):
+            churro._codec_for(b'\x00nope')
+
+    def test_reencode(self):
+        from churro import MsgpackCodec
+        from churro.scripts import reencode
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestFolder('a', 'b')
+        root['a']['b'] = TestClass('c', 'd')
+        transaction.commit()
+
+        import sys
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            reencode([self.tmp, '--codec', 'msgpack'])
+        finally:
+            sys.stdout = stdout
+
+        repo = self.make_one(codec=MsgpackCodec())
+        for path in ('/__folder__.churro', '/a/__folder__.churro',
+                     '/a/b.churro'):
+            with repo.fs.open(path, 'rb') as f:
+                self.assertTrue(f.read().startswith(MsgpackCodec.header))
+        self.assertEqual(repo.reencode(), 0)
+        self.assertEqual(repo.root()['a']['b'].two, 'd')
+        transaction.abort()
+
+        repo = self.make_one()
+        self.assertEqual(repo.reencode(), 3)
+        transaction.commit()
+        repo = self.make_one()
+        self.assertEqual(repo.root()['a'].one, 'a')
+
+    def test_ghosts(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestClass('foo', 'bar')
+        root['b'] = TestFolder('one', 'two')
+        root['b']['c'] = TestClass('c', 'd')
+        root['d'] = TestClass('e', 'f')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        items = dict(root.items())
+        a, b, d = items['a'], items['b'], items['d']
+        self.assertIs(type(a), churro._Ghost)
+        self.assertEqual(a.__name__, 'a')
+        self.assertIs(type(a), churro._Ghost)
+        self.assertEqual(a.one, 'foo')
+        self.assertIs(type(a), TestClass)
+        self.assertIs(root['a'], a)
+        self.assertFalse(a._dirty)
+
+        # Getting a child by name loads it.
+        self.assertIs(type(b), churro._Ghost)
+        self.assertIs(root.get('b'), b)
+        self.assertIsInstance(b, churro.PersistentFolder)
+        self.assertIs(type(d), churro._Ghost)
+        self.assertIs(root['d'], d)
+        self.assertIs(type(d), TestClass)
+
+        self.assertEqual(len(b), 1)
+        self.assertIsInstance(b, TestFolder)
+        self.assertEqual(b['c'].two, 'd')
+
+        d.two = 'g'
+        self.assertIs(type(d), TestClass)
+        self.assertEqual(d.one, 'e')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(root['d'].two, 'g')
+        a = dict(root.items())['a']
+        self.assertIs(type(a), churro._Ghost)
+        self.assertIsInstance(a, churro.Persistent)
+        self.assertIs(type(a), churro._Ghost)
+
+        # isinstance loads a ghost's child to learn its class.
+        ghosts = dict(root.items())
+        self.assertIsInstance(ghosts['b'], TestFolder)
+        self.assertIsInstance(ghosts['b'], churro.PersistentFolder)
+        self.assertNotIsInstance(a, churro.PersistentFolder)
+        self.assertIsInstance(a, TestClass)
+        self.assertIs(a.__class__, TestClass)
+        self.assertIs(type(a), churro._Ghost)
+        self.assertEqual(a.two, 'bar')
+        self.assertIs(type(a), TestClass)
+        popped = root.pop('a')
+        self.assertIs(popped, a)
+        transaction.commit()
+        self.assertEqual(popped.one, 'foo')
+        self.assertNotIn('a', self.make_one().root())
+
+    def test_nested_objects_decoded_lazily(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestClass(TestClass('foo', 'bar'), [TestClass('x', 'y')])
+        root['b'] = TestClass(
+            churro.PersistentDict({'c': TestClass(1, 2)}), None)
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        obj = root['a']
+        self.assertIs(type(obj.__dict__['.one']), churro._Deferred)
+        self.assertIsInstance(obj.two[0], TestClass)
+        obj.two = 'baz'
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        obj = root['a']
+        self.assertEqual(obj.two, 'baz')
+        self.assertEqual(obj.one.one, 'foo')
+        self.assertIs(obj.one.__instance__, obj)
+        obj.one.two = 'qux'
+        self.assertTrue(obj._dirty)
+        root['b'].one['c'].one = 3
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(root['a'].one.two, 'qux')
+        self.assertEqual(root['b'].one['c'].one, 3)
+
+    def test_load_many(self):
+        repo = self.make_one()
+        root = repo.root()
+        for name in 'abcde':
+            root[name] = TestClass(name, name.upper())
+        root['f'] = TestFolder('f', 'F')
+        root['s'] = TestShardedFolder('s', 'S')
+        root['s']['x'] = TestClass('x', 'X')
+        root['s']['y'] = TestClass('y', 'Y')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        ghost = dict(root.items())['c']
+        a, c, f = root.load_many(['a', 'c', 'f'])
+        self.assertIs(c, ghost)
+        self.assertIs(type(c), TestClass)
+        self.assertEqual(a.one, 'a')
+        self.assertEqual(c.two, 'C')
+        self.assertIsInstance(f, TestFolder)
+        self.assertIs(root['a'], a)
+        self.assertEqual(root.load_many(['a']), [a])
+        self.assertEqual(
+            [obj.one for obj in root['s'].load_many(['y', 'x'])], ['y', 'x'])
+        with self.assertRaises(KeyError):
+            root.load_many(['a', 'nope'])
+        self.assertEqual(
+            [(name, type(obj)) for name, obj in root.items(prefetch=2)],
+            [(name, type(root[name])) for name in root.keys()])
+
+        repo = self.make_one()
+        root = repo.root()
+        root.prefetch()
+        for name, (child_type, obj) in root._contents.items():
+            self.assertIs(type(obj), type(root[name]))
+            self.assertIsNot(type(obj), churro._Ghost)
+        self.assertEqual(sorted(obj.one for obj in root.values(prefetch=3)),
+                         ['a', 'b', 'c', 'd', 'e', 'f', 's'])
+
+    def test_bulk_update_and_delete(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['old'] = TestClass('old', 'old')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        children = dict(
+            ('obj%d' % i, TestClass(i, 'x')) for i in range(50))
+        children['folder'] = TestFolder('f', 'g')
+        children['old'] = TestClass('new', 'new')
+        root.bulk_update(children)
+        root['folder']['child'] = TestClass('c', 'd')
+        root['new'] = folder = TestShardedFolder('s', 't')
+        folder.bulk_update([('a', TestClass('a', 'b')), ('b', TestClass(1, 2))])
+        root['obj1'] = TestClass('replaced', 'x')
+        root['obj2'].deactivate()
+        self.assertIsNone(root._contents['obj2'][1])
+        root['obj3'].two = 'y'
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(len(root), 53)
+        self.assertEqual(root['obj0'].one, 0)
+        self.assertEqual(root['obj1'].one, 'replaced')
+        self.assertEqual(root['obj2'].one, 2)
+        self.assertEqual(root['obj3'].two, 'y')
+        self.assertEqual(root['old'].one, 'new')
+        self.assertEqual(root['folder']['child'].one, 'c')
+        self.assertEqual(root['new']['b'].two, 2)
+        root['obj4'].two = 'z'
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(root['obj4'].two, 'z')
+        root.bulk_delete(['obj%d' % i for i in range(40)] + ['folder', 'nope'])
+        self.assertNotIn('obj0', root)
+        self.assertEqual(len(root), 12)
+        root['new'].bulk_delete(['a'])
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(sorted(root.keys()), sorted(
+            ['obj%d' % i for i in range(40, 50)] + ['old', 'new']))
+        self.assertFalse(repo.fs.exists('folder'))
+        self.assertEqual(list(root['new'].keys()), ['b'])
+
+    def test_find(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['plain'] = TestClass('x', 'y')
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        root['fred'] = TestContact('fred@example.com', 'Paris')
+        root['wilma'] = TestContact('wilma@example.com', 'Paris')
+        root['barney'] = TestContact('barney@example.com', 'Oslo')
+        root['people'] = people = TestShardedFolder('a', 'b')
+        people['betty'] = TestContact('betty@example.com', 'Oslo')
+        transaction.commit()
+
+        self.assertTrue(repo.fs.exists('__index__/city.eq'))
+        self.assertNotIn('__index__', repo.root())
+
+        repo = self.make_one()
+        root = repo.root()
+        found = list(root.find(city='Paris'))
+        self.assertEqual([obj.__name__ for obj in found], ['fred', 'wilma'])
+        self.assertIs(type(found[0]), churro._Ghost)
+        self.assertIsNone(root._contents['barney'][1])
+        self.assertEqual(found[0].email, 'fred@example.com')
+        self.assertEqual(
+            [obj.__name__ for obj in
+             root.find(city='Paris', email='wilma@example.com')], ['wilma'])
+        self.assertEqual(list(root.find(city='Rome')), [])
+        self.assertEqual(
+            [obj.email for obj in root['people'].find(city='Oslo')],
+            ['betty@example.com'])
+
+        root['wilma'].city = 'Rome'
+        del root['fred']
+        root['dino'] = TestContact('dino@example.com', 'Paris')
+        self.assertEqual(
+            [obj.__name__ for obj in root.find(city='Paris')], ['dino'])
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(
+            [obj.__name__ for obj in root.find(city='Rome')], ['wilma'])
+        self.assertEqual(
+            [obj.__name__ for obj in root.find(city='Paris')], ['dino'])
+        self.assertEqual(list(root.find(email='fred@example.com')), [])
+
+        # Indexes are built in memory if missing
+        repo.fs.rmtree('__index__')
+        self.assertEqual(
+            [obj.__name__ for obj in root.find(email='dino@example.com')],
+            ['dino'])
+        self.assertFalse(repo.fs.exists('__index__'))
+        root.reindex()
+        self.assertEqual(len(repo.fs.listdir('__index__/email.eq')), 7)
+        self.assertEqual(
+            [obj.__name__ for obj in root.find(city='Oslo')], ['barney'])
+
+        with self.assertRaises(ValueError):
+            list(TestFolder('a', 'b').find(city='Oslo'))
+        with self.assertRaises(ValueError):
+            list(root.find(emial='dino@example.com'))
+        with self.assertRaises(ValueError):
+            list(root.range('city'))
+        repo.fs.rmtree('__index__')
+        transaction.commit()
+
+        # Reading doesn't write
+        repo = self.make_one()
+        head = repo.fs.get_base()
+        root = repo.root()
+        self.assertEqual(
+            [obj.__name__ for obj in root.find(city='Oslo')], ['barney'])
+        transaction.commit()
+        repo = self.make_one()
+        self.assertEqual(repo.fs.get_base(), head)
+
+    def test_range(self):
+        import datetime
+        page_size = churro._RangeIndex.page_size
+        churro._RangeIndex.page_size = 4
+        try:
+            repo = self.make_one()
+            root = repo.root()
+            start = datetime.date(2012, 1, 25)
+            for i in range(30):
+                root['e%02d' % i] = TestEvent(
+                    start + datetime.timedelta(days=i), (i * 7) % 30)
+            transaction.commit()
+
+            repo = self.make_one()
+            root = repo.root()
+            feb = list(root.range('when', datetime.date(2012, 2, 1),
+                                  datetime.date(2012, 3, 1)))
+            self.assertEqual([obj.__name__ for obj in feb],
+                             ['e%02d' % i for i in range(7, 30)])
+            self.assertIs(type(feb[0]), churro._Ghost)
+            self.assertEqual(
+                [obj.__name__ for obj in root.range(
+                    'when', hi=datetime.date(2012, 1, 28), reverse=True)],
+                ['e02', 'e01', 'e00'])
+            self.assertEqual(
+                [obj.amount for obj in root.range('amount', 10, limit=3)],
+                [10, 11, 12])
+            self.assertEqual(
+                [obj.amount for obj in root.range(
+                    'amount', 10, 14, reverse=True)], [13, 12, 11, 10])
+            self.assertEqual(list(root.range('amount', 100)), [])
+            root['empty'] = churro.PersistentFolder()
+            self.assertEqual(list(root['empty'].range(
+                'when', datetime.date(2012, 2, 1))), [])
+
+            for i in range(0, 30, 2):
+                del root['e%02d' % i]
+            root['e01'].amount = 100
+            root['e03'].when = datetime.date(2011, 1, 1)
+            transaction.commit()
+
+            repo = self.make_one()
+            root = repo.root()
+            self.assertEqual(
+                [obj.amount for obj in root.range('amount')],
+                [1, 3, 5, 9, 11, 13, 15, 17, 19, 21, 23, 25, 27, 29, 100])
+            self.assertEqual(
+                [obj.__name__ for obj in root.range('when', limit=3)],
+                ['e03', 'e01', 'e05'])
+            self.assertEqual(
+                [obj.__name__ for obj in root.range(
+                    'when', reverse=True, limit=2)], ['e29', 'e27'])
+        finally:
+            churro._RangeIndex.page_size = page_size
+
+    def test_query(self):
+        import datetime
+        repo = self.make_one()
+        root = repo.root()
+        people = [
+            ('fred', 'Fred', 'Paris', 1970, 'a'),
+            ('frank', 'Frank', 'Oslo', 1985, 'b'),
+            ('wilma', 'Wilma', 'Paris', 1990, 'a'),
+            ('barney', 'Barney', 'Paris', 1982, None),
+            ('betty', 'Betty', 'Rome', 1975, 'c'),
+            ('frieda', 'Frieda', 'Paris', 1995, 'b')]
+        for key, name, city, year, notes in people:
+            root[key] = TestPerson(
+                name, city, datetime.date(year, 1, 1), notes)
+        root['other'] = TestClass('x', 'y')
+        transaction.commit()
+
+        def names(query):
+            return [obj.__name__ for obj in query]
+
+        repo = self.make_one()
+        root = repo.root()
+        query = root.query().where(city='Paris')
+        self.assertEqual(names(query), ['barney', 'fred', 'frieda', 'wilma'])
+        found = list(root.query().where(city='Paris'))
+        self.assertIs(type(found[0]), churro._Ghost)
+        self.assertEqual(names(root.query()
+                               .where(city='Paris')
+                               .where('born', '>=', datetime.date(1982, 1, 1))
+                               .order_by('born', reverse=True)),
+                         ['frieda', 'wilma', 'barney'])
+        self.assertEqual(names(root.query()
+                               .where('name', 'startswith', 'Fr')
+                               .order_by('name')),
+                         ['frank', 'fred', 'frieda'])
+        self.assertEqual(names(root.query()
+                               .where('name', 'startswith', 'Fr')
+                               .where('born', '<', datetime.date(1990, 1, 1))),
+                         ['fred', 'frank'])
+        self.assertEqual(names(root.query()
+                               .where('born', '<', datetime.date(1990, 1, 1))
+                               .order_by('born', reverse=True)
+                               .limit(2)),
+                         ['frank', 'barney'])
+        self.assertEqual(names(root.query()
+                               .where('city', 'in', ['Oslo', 'Rome'])
+                               .order_by('name')),
+                         ['betty', 'frank'])
+        self.assertEqual(names(root.query()
+                               .where('born', '>', datetime.date(1982, 1, 1))
+                               .where('born', '<=', datetime.date(1990, 1, 1))),
+                         ['frank', 'wilma'])
+        self.assertEqual(names(root.query()
+                               .where(notes='a')
+                               .where('name', '!=', 'Wilma')), ['fred'])
+        self.assertEqual(names(root.query()
+                               .where(city='Paris')
+                               .order_by('notes')),
+                         ['fred', 'wilma', 'frieda', 'barney'])
+        self.assertEqual(names(root.query().where(city='Paris').limit(1)),
+                         ['barney'])
+        self.assertEqual(len(names(root.query())), 7)
+        self.assertEqual(names(root.query().where(city=None)), ['other'])
+        self.assertEqual(names(root.query().where('city', 'in',
+                                                  ['Rome', None])),
+                         ['betty', 'other'])
+        self.assertEqual(names(root.query().where('born', '>', None)), [])
+        self.assertEqual(names(root.query().where('born', '==', None)),
+                         ['other'])
+        with self.assertRaises(ValueError):
+            root.query().where('name', '~', 'x')
+
+    def test_search(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestNote('Fred Flintstone', 'Lives in Bedrock.')
+        root['b'] = TestNote('Freddy', 'Not from Bedrock.')
+        root['c'] = TestNote('Barney Rubble', 'Fred, fred and FRED.')
+        root['d'] = TestNote('Wilma', ['Married to Fred', 'Bedrock'])
+        root['e'] = TestClass('fred', 'fred')
+        transaction.commit()
+
+        def names(results):
+            return [obj.__name__ for obj in results]
+
+        repo = self.make_one()
+        root = repo.root()
+        results = list(root.search('fred'))
+        self.assertIs(type(results[0]), churro._Ghost)
+        self.assertEqual(names(results), ['c', 'a', 'd', 'b'])
+        self.assertEqual(names(root.search('fred', fields=['title'])),
+                         ['a', 'b'])
+        self.assertEqual(sorted(names(root.search('bedr FRE'))),
+                         ['a', 'b', 'd'])
+        self.assertEqual(names(root.search('rubble fred')), ['c'])
+        self.assertEqual(names(root.search('fred', limit=1)), ['c'])
+        self.assertEqual(names(root.search('dino')), [])
+        self.assertEqual(names(root.search('')), [])
+
+        root['c'].body = 'Friend of Fred'
+        del root['a']
+        root['f'] = TestNote('Dino', 'A pet')
+        self.assertEqual(names(root.search('dino')), ['f'])
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        self.assertEqual(names(root.search('fred')), ['c', 'd', 'b'])
+        self.assertEqual(names(root.search('flintstone')), [])
+        self.assertEqual(names(root.search('fri')), ['c'])
+
+    def test_project(self):
+        import datetime
+        repo = self.make_one()
+        root = repo.root()
+        root['people'] = people = TestDirectory()
+        people['fred'] = TestPerson(
+            'Fred', 'Paris', datetime.date(1970, 1, 1), 'a')
+        people['barney'] = TestPerson(
+            'Barney', 'Oslo', datetime.date(1982, 1, 1), 'b')
+        people['other'] = TestClass('x', 'y')
+        transaction.commit()
+
+        repo = self.make_one()
+        people = repo.root()['people']
+        self.assertEqual(people.project(), [
+            {'__name__': 'barney', 'name': 'Barney',
+             'born': datetime.date(1982, 1, 1)},
+            {'__name__': 'fred', 'name': 'Fred',
+             'born': datetime.date(1970, 1, 1)},
+            {'__name__': 'other', 'name': None, 'born': None}])
+        self.assertEqual(people.project(['name'], columns=True), {
+            '__name__': ['barney', 'fred', 'other'],
+            'name': ['Barney', 'Fred', None]})
+        self.assertEqual(people._contents['fred'], ('object', None))
+        with self.assertRaises(ValueError):
+            people.project(['city'])
+
+        people['fred'].name = 'Freddy'
+        del people['barney']
+        people['wilma'] = TestPerson(
+            'Wilma', 'Paris', datetime.date(1990, 1, 1), 'a')
+        transaction.commit()
+
+        repo = self.make_one()
+        people = repo.root()['people']
+        self.assertEqual(people.project(['name'], columns=True), {
+            '__name__': ['fred', 'other', 'wilma'],
+            'name': ['Freddy', None, 'Wilma']})
+
+        # Changing the declared fields rebuilds the projection.
+        TestDirectory.projected_fields = ('city',)
+        try:
+            self.assertEqual(people.project(columns=True), {
+                '__name__': ['fred', 'other', 'wilma'],
+                'city': ['Paris', None, 'Paris']})
+        finally:
+            TestDirectory.projected_fields = ('name', 'born')
+
+        root = repo.root()
+        root['empty'] = TestDirectory()
+        self.assertEqual(root['empty'].project(), [])
+        transaction.commit()
+        empty = self.make_one().root()['empty']
+        self.assertEqual(empty.project(), [])
+        self.assertEqual(empty.project(columns=True), {
+            '__name__': [], 'name': [], 'born': []})
+
+    def test_aggregate(self):
+        import datetime
+        when = datetime.date(2020, 1, 1)
+        repo = self.make_one()
+        root = repo.root()
+        root['ledger'] = ledger = TestLedger()
+        ledger['a'] = TestEvent(when, 10)
+        ledger['b'] = TestEvent(when, 2.5)
+        ledger['c'] = TestEvent(when, 'n/a')
+        ledger['d'] = TestClass('x', 'y')
+        self.assertEqual(len(ledger), 4)
+        transaction.commit()
+
+        repo = self.make_one()
+        ledger = repo.root()['ledger']
+        self.assertEqual(len(ledger), 4)
+        self.assertTrue(ledger)
+        self.assertNotIn('_contents', ledger.__dict__)
+        self.assertEqual(ledger.aggregate('amount'), {
+            'count': 2, 'sum': 12.5, 'min': 2.5, 'max': 10})
+        with self.assertRaises(ValueError):
+            ledger.aggregate('when')
+
+        del ledger['b']
+        ledger['a'].amount = 4
+        ledger['e'] = TestEvent(when, 7)
+        self.assertEqual(len(ledger), 4)
+        self.assertEqual(ledger.aggregate('amount'), {
+            'count': 2, 'sum': 11, 'min': 4, 'max': 7})
+        transaction.commit()
+
+        repo = self.make_one()
+        ledger = repo.root()['ledger']
+        self.assertEqual(len(ledger), 4)
+        self.assertEqual(ledger.aggregate('amount'), {
+            'count': 2, 'sum': 11, 'min': 4, 'max': 7})
+        for name in list(ledger.keys()):
+            del ledger[name]
+        transaction.commit()
+
+        repo = self.make_one()
+        ledger = repo.root()['ledger']
+        self.assertEqual(len(ledger), 0)
+        self.assertFalse(ledger)
+        self.assertEqual(ledger.aggregate('amount'), {
+            'count': 0, 'sum': 0, 'min': None, 'max': None})
+
+        root = repo.root()
+        root['empty'] = TestLedger()
+        self.assertEqual(root['empty'].aggregate('amount'), {
+            'count': 0, 'sum': 0, 'min': None, 'max': None})
+        transaction.commit()
+        empty = self.make_one().root()['empty']
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.aggregate('amount'), {
+            'count': 0, 'sum': 0, 'min': None, 'max': None})
+
+    def test_paged_keys(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['f'] = folder = churro.PersistentShardedFolder()
+        names = ['a%02d' % i for i in range(10)] + ['b%02d' % i for i in
+                                                     range(5)]
+        for name in reversed(names):
+            folder[name] = TestClass(name, None)
+        transaction.commit()
+
+        repo = self.make_one()
+        folder = repo.root()['f']
+        page = folder.keys(limit=4)
+        self.assertEqual(page, names[:4])
+        seen = list(page)
+        while page.cursor:
+            page = folder.keys(limit=4, cursor=page.cursor)
+            seen.extend(page)
+        self.assertEqual(seen, names)
+
+        page = folder.keys(prefix='a', limit=5)
+        self.assertEqual(page, names[:5])
+        page = folder.keys(prefix='a', limit=5, cursor=page.cursor)
+        self.assertEqual(page, names[5:10])
+        self.assertEqual(page.cursor, None)
+        self.assertEqual(folder.keys(prefix='a0', start_after='a05'),
+                         ['a06', 'a07', 'a08', 'a09'])
+        self.assertEqual(folder.keys(prefix='c'), [])
+        self.assertEqual(folder.keys(start_after='b03'), ['b04'])
+        with self.assertRaises(ValueError):
+            folder.keys(cursor='x')
+
+        page = folder.items(prefix='b', limit=2)
+        self.assertEqual([name for name, obj in page], ['b00', 'b01'])
+        self.assertIs(type(page[0][1]), churro._Ghost)
+        self.assertEqual(page[1][1].one, 'b01')
+        page = folder.items(prefix='b', limit=2, cursor=page.cursor,
+                            prefetch=2)
+        self.assertEqual([obj.one for name, obj in page], ['b02', 'b03'])
+
+        del folder['a00']
+        folder['a5'] = TestClass('a5', None)
+        folder.bulk_delete(['b00'])
+        folder.bulk_update({'b0': TestClass('b0', None)})
+        self.assertEqual(folder.keys(limit=3), ['a01', 'a02', 'a03'])
+        self.assertEqual(folder.keys(start_after='a09', limit=3),
+                         ['a5', 'b0', 'b01'])
+        self.assertEqual(sorted(folder.keys()), folder.keys(limit=100))
+
+    def test_paged_keys_cached(self):
+        repo = self.make_one(cache_size=10)
+        root = repo.root()
+        for i in range(10):
+            root['n%d' % i] = TestClass(i, None)
+        transaction.commit()
+
+        root = repo.root()
+        self.assertEqual(root.keys(limit=3), ['n0', 'n1', 'n2'])
+        transaction.commit()
+
+        root = repo.root()
+        page = root.keys(start_after='n2', limit=3)
+        self.assertEqual(page, ['n3', 'n4', 'n5'])
+        self.assertNotIn('_contents', root.__dict__)
+        root['n35'] = TestClass(35, None)
+        self.assertEqual(root.keys(start_after='n2', limit=3),
+                         ['n3', 'n35', 'n4'])
+        transaction.commit()
+
+        root = repo.root()
+        self.assertEqual(root.keys(start_after='n2', limit=3),
+                         ['n3', 'n35', 'n4'])
+        transaction.commit()
+
+        root = repo.root()
+        page = root.items(start_after='n2', limit=2)
+        self.assertEqual([obj.one for name, obj in page], [3, 35])
+        page = root.items(cursor=page.cursor, limit=2, prefetch=2)
+        self.assertEqual([(name, obj.one) for name, obj in page],
+                         [('n4', 4), ('n5', 5)])
+        self.assertNotIn('_contents', root.__dict__)
+        self.assertEqual(root.load_many(['n4']), [page[0][1]])
+        with self.assertRaises(KeyError):
+            root.load_many(['n4', 'nope'])
+
+    def test_traverse(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestFolder('a', None)
+        root['a']['b'] = churro.PersistentShardedFolder()
+        root['a']['b']['c'] = TestFolder('c', None)
+        root['a']['b']['c']['obj'] = TestClass('x', 'y')
+        root['a']['b']['c']['d'] = TestClass('d', None)
+        root['other'] = TestClass('o', None)
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        obj = repo.traverse('/a/b/c/obj')
+        self.assertIs(type(obj), TestClass)
+        self.assertEqual(obj.one, 'x')
+        self.assertNotIn('_contents', root.__dict__)
+        a = obj.__parent__.__parent__.__parent__
+        self.assertIs(type(a), churro._Ghost)
+        self.assertIs(type(obj.__parent__), churro._Ghost)
+        self.assertIs(repo.traverse('a/b/c/obj'), obj)
+        self.assertEqual(root.resolve('a/b/c/d').one, 'd')
+        self.assertIs(type(a), churro._Ghost)
+        self.assertIs(root.resolve('a'), a)
+        self.assertIs(type(a), TestFolder)
+        self.assertIs(a.resolve('b/c/obj'), obj)
+
+        for path in ('/a/b/c/nope', '/nope/b', '/other/x', '/a/b/c/obj/x',
+                     '/a/__index__', '/a/__folder__'):
+            with self.assertRaises(KeyError):
+                repo.traverse(path)
+
+        obj.two = 'z'
+        transaction.commit()
+
+        repo = self.make_one()
+        root = repo.root()
+        obj = repo.traverse('/a/b/c/obj')
+        self.assertEqual(obj.two, 'z')
+        self.assertIs(root['a']['b']['c']['obj'], obj)
+        self.assertEqual(root['a'].one, 'a')
+        self.assertIs(root.resolve('a/b/c/obj'), obj)
+        self.assertIs(repo.traverse('/'), root)
+
+    def test_threads(self):
+        import threading
+        repo = self.make_one(cache_size=10)
+        repo.root()['shared'] = TestClass('s', None)
+        transaction.commit()
+        fs = repo.fs
+        transaction.abort()
+        self.assertIs(repo.fs, fs)
+        transaction.abort()
+
+        sessions = {}
+        errors = []
+
+        def work(n):
+            try:
+                root = repo.root()
+                sessions[n] = repo.session
+                self.assertEqual(root['shared'].one, 's')
+                root['t%d' % n] = TestClass(n, None)
+                transaction.commit()
+            except Exception as e: # pragma no cover
+                errors.append(e)
+                transaction.abort()
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(map(id, sessions.values()))), 8)
+
+        root = self.make_one().root()
+        self.assertEqual(sorted(root['t%d' % n].one for n in range(8)),
+                         list(range(8)))
+
+    def test_two_instances_one_transaction(self):
+        repo = self.make_one()
+        repo.root()['a'] = TestClass('a', None)
+        transaction.commit()
+        self.assertTrue(repo.fs.exists('a.churro'))
+        self.assertIs(repo.session.closed, True)
+
+        reader = self.make_one()
+        writer = self.make_one()
+        self.assertEqual(reader.root()['a'].one, 'a')
+        writer.root()['b'] = TestClass('b', None)
+        transaction.commit()
+
+        root = self.make_one().root()
+        self.assertEqual(root['b'].one, 'b')
+
+    def test_delete_while_iterating_keys(self):
+        repo = self.make_one()
+        root = repo.root()
+        root['a'] = TestClass('a', None)
+        root['b'] = TestClass('b', None)
+        transaction.commit()
+
+        root = self.make_one().root()
+        for name in root.keys():
+            del root[name]
+        self.assertEqual(len(root), 0)
+
+    def test_concurrent_index_changes_merge(self):
+        import datetime
+        import threading
+        start = datetime.date(2020, 1, 1)
+        repo = self.make_one()
+        root = repo.root()
+        for i in range(20):
+            root['e%02d' % i] = TestEvent(
+                start + datetime.timedelta(days=i * 10), i * 10)
+        transaction.commit()
+
+        written = threading.Event()
+        errors = []
+
+        def add(name, days, wait):
+            try:
+                root = repo.root()
+                len(root)
+                root[name] = TestEvent(
+                    start + datetime.timedelta(days=days), days)
+                if wait:
+                    written.wait()
+                transaction.commit()
+            except Exception as e: # pragma no cover
+                errors.append(e)
+                transaction.abort()
+            finally:
+                if not wait:
+                    written.set()
+
+        first = threading.Thread(target=add, args=('x', 15, True))
+        second = threading.Thread(target=add, args=('y', 155, False))
+        first.start()
+        second.start()
+        first.join()
+        second.join()
+        self.assertEqual(errors, [])
+
+        root = self.make_one().root()
+        self.assertEqual([obj.__name__ for obj in root.range('amount', 10, 20)],
+                         ['e01', 'x'])
+        self.assertEqual(
+            [obj.__name__ for obj in root.range('amount', 150, 160)],
+            ['e15', 'y'])
+
+    @unittest.skipIf(sys.version_info < (3, 2), "Requires Python 3")
+    def test_concurrent_index_inserts(self):
+        import datetime
+        import threading
+        repo = self.make_one()
+        root = repo.root()
+        for i in range(20):
+            root['p%02d' % i] = TestPerson(
+                'P%02d' % (i * 5), 'c%d' % (i % 3),
+                datetime.date(1950 + i * 5, 1, 1), None)
+        transaction.commit()
+
+        barrier = threading.Barrier(16)
+        errors = []
+
+        def work(n):
+            barrier.wait()
+            for i in range(5):
+                try:
+                    repo.root()['t%02d%d' % (n, i)] = TestPerson(
+                        'T%02d%d' % (n, i), 'c%d' % ((n + i) % 3),
+                        datetime.date(1950 + n * 5 + i, 1, 1), None)
+                    transaction.commit()
+                except Exception as e: # pragma no cover
+                    errors.append(e)
+                    transaction.abort()
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        root = self.make_one().root()
+        self.assertEqual(len(root), 100)
+        people = sorted(root.values(), key=lambda obj: obj.born)
+        self.assertEqual(list(root.range('born')), people)
+        self.assertEqual(list(root.range('born', reverse=True)),
+                         people[::-1])
+        self.assertEqual(list(root.range('name')),
+                         sorted(people, key=lambda obj: obj.name))
+        for city in ('c0', 'c1', 'c2'):
+            self.assertEqual(
+                set(root.find(city=city)),
+                set(obj for obj in people if obj.city == city))
+
+    def test_merge_index_files(self):
+        merge = churro._RangeIndex.merge_file
+        base = {'entries': [[0, 1, 'a'], [0, 5, 'b']]}
+        self.assertEqual(
+            merge('p0.json', base,
+                  {'entries': [[0, 0, 'c'], [0, 1, 'a'], [0, 5, 'b']]},
+                  {'entries': [[0, 1, 'a'], [0, 3, 'd'], [0, 5, 'b']]}),
+            {'entries': [[0, 0, 'c'], [0, 1, 'a'], [0, 3, 'd'],
+                         [0, 5, 'b']]})
+        # The page was split after 'a', so 'e' may belong to the new page.
+        with self.assertRaises(churro._MergeConflict):
+            merge('p0.json', base, {'entries': [[0, 1, 'a']]},
+                  {'entries': [[0, 1, 'a'], [0, 5, 'b'], [0, 6, 'e']]})
+        # The new first entry of the page would be missing from the
+        # directory.
+        with self.assertRaises(churro._MergeConflict):
+            merge('p0.json', base, {'entries': [[0, 5, 'b']]},
+                  {'entries': [[0, 1, 'a'], [0, 2, 'e'], [0, 5, 'b']]})
+        self.assertEqual(
+            merge('dir.json',
+                  {'next': 2, 'pages': [[[0, 1, 'a'], 0], [[0, 9, 'x'], 1]]},
+                  {'next': 3, 'pages': [[[0, 1, 'a'], 0], [[0, 5, 'b'], 2],
+                                        [[0, 9, 'x'], 1]]},
+                  {'next': 2, 'pages': [[[0, 0, 'c'], 0], [[0, 9, 'x'], 1]]}),
+            {'next': 3, 'pages': [[[0, 0, 'c'], 0], [[0, 5, 'b'], 2],
+                                  [[0, 9, 'x'], 1]]})
+        # One removed a page which the other changed.
+        with self.assertRaises(churro._MergeConflict):
+            merge('dir.json',
+                  {'next': 2, 'pages': [[[0, 1, 'a'], 0], [[0, 9, 'x'], 1]]},
+                  {'next': 2, 'pages': [[[0, 1, 'a'], 0]]},
+                  {'next': 2, 'pages': [[[0, 1, 'a'], 0], [[0, 8, 'y'], 1]]})
+        self.assertEqual(
+            churro._TextIndex.merge_file(
+                'dir.json', {'docs': 2, 'pages': []},
+                {'docs': 3, 'pages': []}, {'docs': 4, 'pages': []}),
+            {'docs': 5, 'pages': []})
+        self.assertEqual(
+            churro._EqualityIndex.merge_file(
+                'f00.json', {'"x"': ['a', 'b']}, {'"x"': ['b', 'c']},
+                {'"x"': ['a', 'b', 'd'], '"y"': ['e']}),
+            {'"x"': ['b', 'c', 'd'], '"y"': ['e']})
+        self.assertEqual(
+            churro._EqualityIndex.merge_file(
+                'r00.json', None, {'a': '"x"'}, {'b': '"y"'}),
+            {'a': '"x"', 'b': '"y"'})
+        with self.assertRaises(churro._MergeConflict):
+            churro._EqualityIndex.merge_file(
+                'r00.json', {'a': '"x"'}, {'a': '"y"'}, {'a': '"z"'})
+        self.assertIs(churro._AggregateIndex.merge_file(
+            'stats.json', {}, {}, {}), NotImplemented)
+
+    def test_query_order_includes_missing_values(self):
+        import datetime
+        repo = self.make_one()
+        root = repo.root()
+        people = [
+            ('a', 'Fred', 'Paris', 1970),
+            ('b', None, 'Paris', 1985),
+            ('c', 'Barney', 'Oslo', None),
+            ('d', None, 'Oslo', 1990),
+            ('e', 'Wilma', 'Paris', 1975)]
+        for key, name, city, year in people:
+            born = datetime.date(year, 1, 1) if year else None
+            root[key] = TestPerson(name, city, born, 'x')
+        transaction.commit()
+
+        root = self.make_one().root()
+
+        def names(query):
+            return [obj.__name__ for obj in query]
+
+        self.assertEqual(names(root.query().order_by('name')),
+                         ['c', 'a', 'e', 'b', 'd'])
+        self.assertEqual(names(root.query().order_by('name', reverse=True)),
+                         ['e', 'a', 'c', 'b', 'd'])
+        self.assertEqual(
+            names(root.query().where('notes', '==', 'x').order_by('name')),
+            ['c', 'a', 'e', 'b', 'd'])
+        self.assertEqual(
+            names(root.query().where('born', '>=', datetime.date(1980, 1, 1))
+                  .order_by('name')),
+            ['b', 'd'])
+        self.assertEqual(
+            names(root.query().where('name', '>=', 'C').order_by('name')),
+            ['a', 'e'])
+        self.assertEqual(names(root.query().order_by('name').limit(2)),
+                         ['c', 'a'])
+
+    def test_snapshot(self):
+        import threading
+        repo = self.make_one(cache_size=10)
+        root = repo.root()
+        root['a'] = TestFolder('a', None)
+        root['a']['obj'] = TestClass('x', 'y')
+        transaction.commit()
+        first = repo.fs.get_base().decode('ascii')
+        transaction.abort()
+
+        snapshot = repo.snapshot()
+        self.assertEqual(snapshot.commit, first)
+        self.assertIs(repo.snapshot(first), snapshot)
+        self.assertIs(repo.session.closed, True)
+        obj = snapshot.traverse('/a/obj')
+        self.assertEqual(obj.one, 'x')
+        with self.assertRaises(TypeError):
+            obj.one = 'z'
+        self.assertEqual(obj.one, 'x')
+        with self.assertRaises(TypeError):
+            snapshot.root()['b'] = TestClass('b', None)
+        with self.assertRaises(TypeError):
+            del snapshot.root()['a']
+        self.assertEqual(list(snapshot.root().keys()), ['a'])
+
+        repo.root()['a']['obj'].one = 'changed'
+        transaction.commit()
+        self.assertEqual(snapshot.traverse('/a/obj').one, 'x')
+        self.assertEqual(repo.snapshot().traverse('/a/obj').one, 'changed')
+        with self.assertRaises(ValueError):
+            repo.snapshot('nope')
+
+        errors = []
+        shared = repo.snapshot(first)
+        self.assertIs(shared, snapshot)
+
+        def work():
+            try:
+                for name in ('a', 'a'):
+                    self.assertEqual(shared.root()[name]['obj'].one, 'x')
+            except Exception as e: # pragma no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        snapshot.close()
+
+    def test_snapshot_threads(self):
+        import threading
+        repo = self.make_one()
+        root = repo.root()
+        root['c'] = folder = churro.PersistentFolder()
+        for i in range(150):
+            folder['p%03d' % i] = TestContact(
+                'e%d' % i, ('Paris', 'Oslo', 'Rome')[i % 3])
+        transaction.commit()
+        # Without a stored index, each snapshot builds one in memory.
+        repo.fs.rmtree('/c/__index__')
+        transaction.commit()
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        errors = []
+
+        def work(snapshot, i):
+            try:
+                folder = snapshot.root()['c']
+                if i % 3 == 0:
+                    self.assertEqual(len(list(folder.find(city='Oslo'))), 50)
+                elif i % 3 == 1:
+                    for name, obj in folder.items(prefetch=20):
+                        self.assertTrue(obj.city)
+                else:
+                    for name, obj in folder.items():
+                        self.assertTrue(obj.city)
+            except Exception as e: # pragma no cover
+                errors.append(e)
+
+        for attempt in range(5):
+            snapshot = repo.snapshot()
+            threads = [threading.Thread(target=work, args=(snapshot, i))
+                       for i in range(9)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            snapshot.close()
+            del snapshot
+        self.assertEqual(errors, [])
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Requires Python 3.7")
+    def test_async(self):
+        import asyncio
+        from churro.aio import AsyncChurro
+        repo = AsyncChurro(self.tmp, max_workers=2)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.addCleanup(repo.close)
+        run = loop.run_until_complete
+
+        tx = repo.transaction()
+        self.assertIs(run(tx.__aenter__()), tx)
+        root = run(tx.root())
+        root['a'] = TestFolder('a', None)
+        root['a']['obj'] = TestClass('x', None)
+        run(tx.__aexit__(None, None, None))
+        self.assertEqual(len(repo.idle), 1)
+
+        first = repo.transaction()
+        second = repo.transaction()
+        run(first.__aenter__())
+        run(second.__aenter__())
+        self.assertIsNot(first.worker, second.worker)
+        obj = run(first.traverse('/a/obj'))
+        self.assertEqual(obj.one, 'x')
+        run(first.root())['b'] = TestClass('y', None)
+        folder = run(second.traverse('/a'))
+        self.assertEqual(run(second.get('/a/nope', 'default')), 'default')
+        self.assertEqual(
+            [o and o.one for o in run(second.load_many(['/a/obj', '/a/x']))],
+            ['x', None])
+        objs = run(second.load_many(['/a/obj', '/', '/a', '/a/obj/x', '/b']))
+        self.assertEqual(objs[0].one, 'x')
+        self.assertIs(objs[1], run(second.root()))
+        self.assertIs(objs[2], folder)
+        self.assertEqual(objs[3:], [None, None])
+        folder['other'] = TestClass('z', None)
+        run(asyncio.gather(
+            loop.create_task(first.__aexit__(None, None, None)),
+            loop.create_task(second.__aexit__(None, None, None))))
+
+        tx = repo.transaction()
+        run(tx.__aenter__())
+        self.assertEqual(run(tx.traverse('/b')).one, 'y')
+        self.assertEqual(run(tx.traverse('/a/other')).one, 'z')
+        run(tx.traverse('/a/obj')).one = 'nope'
+        run(tx.__aexit__(ValueError, ValueError(), None))
+        self.assertEqual(self.make_one().root()['a']['obj'].one, 'x')
+        with self.assertRaises(RuntimeError):
+            run(tx.root())
+
+    @unittest.skipIf(sys.version_info < (3, 2), "Requires Python 3")
+    def test_group_commit(self):
+        import subprocess
+        import threading
+        repo = self.make_one(group_commit=5, group_commit_size=4)
+        repo.root()['shared'] = TestClass(['a', 1, 2, 3], 'b')
+        transaction.commit()
+        self.assertTrue(repo.fs.exists('shared.churro'))
+
+        def count_commits():
+            return int(subprocess.check_output(
+                ['git', 'rev-list', '--count', 'HEAD'], cwd=self.tmp))
+
+        def commit_all(*works):
+            barrier = threading.Barrier(len(works))
+            errors = []
+
+            def run(work):
+                try:
+                    barrier.wait()
+                    work()
+                    transaction.commit()
+                except Exception as e:
+                    errors.append(e)
+                    transaction.abort()
+
+            threads = [threading.Thread(target=run, args=(work,))
+                       for work in works]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return errors
+
+        def add(name):
+            def work():
+                transaction.get().note(name)
+                repo.root()[name] = TestClass(name, None)
+            return work
+
+        def change(attr, value):
+            def work():
+                setattr(repo.root()['shared'], attr, value)
+            return work
+
+        commits = count_commits()
+        errors = commit_all(add('w'), add('x'), add('y'), add('z'))
+        self.assertEqual(errors, [])
+        self.assertEqual(count_commits(), commits + 1)
+        message = subprocess.check_output(
+            ['git', 'log', '-1', '--format=%B'], cwd=self.tmp)
+        self.assertEqual(sorted(message.split()), [b'w', b'x', b'y', b'z'])
+
+        # Changes to different lines of the same file are merged.
+        errors = commit_all(change('one', ['c', 1, 2, 3]),
+                            change('two', 'd'), add('e'), add('f'))
+        self.assertEqual(errors, [])
+        self.assertEqual(count_commits(), commits + 2)
+
+        errors = commit_all(change('two', 'g'), change('two', 'h'),
+                            add('i'), add('j'))
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], churro.acidfs.ConflictError)
+        self.assertEqual(count_commits(), commits + 3)
+
+        root = self.make_one().root()
+        self.assertEqual(sorted(root.keys()),
+                         ['e', 'f', 'i', 'j', 'shared', 'w', 'x', 'y', 'z'])
+        self.assertEqual(root['shared'].one, ['c', 1, 2, 3])
+        self.assertIn(root['shared'].two, ('g', 'h'))
+        status = subprocess.check_output(['git', 'status', '--porcelain'],
+                                         cwd=self.tmp)
+        self.assertEqual(status, b'')
+
+    def test_concurrent_changes_to_one_object(self):
+        import threading
+        repo = self.make_one()
+        root = repo.root()
+        root['counter'] = TestCounter()
+        root['a'] = TestClass('a', None)
+        root['b'] = TestClass('b', None)
+        transaction.commit()
+
+        def concurrently(work):
+            def run():
+                work(repo.root())
+                transaction.commit()
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+
+        # Counters reconcile concurrent changes, even when both transactions
+        # write the same value.
+        def increment(root):
+            root['counter'].count += 1
+        increment(repo.root())
+        concurrently(increment)
+        transaction.commit()
+        self.assertEqual(self.make_one().root()['counter'].count, 2)
+
+        # Other objects changed by another transaction are left alone.
+        repo.root()['a'].one = 'x'
+        concurrently(lambda root: setattr(root['b'], 'one', 'y'))
+        transaction.commit()
+        root = self.make_one().root()
+        self.assertEqual((root['a'].one, root['b'].one), ('x', 'y'))
+
+        repo.root()['a'].one = 'z'
+        concurrently(lambda root: setattr(root['a'], 'one', 'w'))
+        with self.assertRaises(churro.acidfs.ConflictError):
+            transaction.commit()
+        transaction.abort()
+        self.assertEqual(self.make_one().root()['a'].one, 'w')
+
+    def test_run(self):
+        import threading
+        repo = self.make_one()
+        repo.root()['a'] = TestClass('a', None)
+        transaction.commit()
+        calls = []
+
+        def interfere():
+            def run():
+                repo.root()['a'].two = 'other%d' % len(calls)
+                transaction.commit()
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+
+        def work(root):
+            calls.append(root['a'].two)
+            root['a'].two = 'attempt%d' % len(calls)
+            if len(calls) < 3:
+                interfere()
+            return len(calls)
+
+        self.assertEqual(repo.run(work), 3)
+        self.assertEqual(calls, [None, 'other1', 'other2'])
+        self.assertEqual(self.make_one().root()['a'].two, 'attempt3')
+
+        del calls[:]
+        with self.assertRaises(churro.acidfs.ConflictError):
+            repo.run(work, retries=1)
+        self.assertEqual(calls, ['attempt3', 'other1'])
+        self.assertEqual(self.make_one().root()['a'].two, 'other2')
+
+        def fail(root):
+            root['a'].two = 'nope'
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            repo.run(fail)
+        self.assertEqual(self.make_one().root()['a'].two, 'other2')
+
+    def test_commit_after_read_only_transaction(self):
+        repo = self.make_one()
+        repo.root()['a'] = TestClass('a', None)
+        transaction.commit()
+        self.assertEqual(list(repo.root().keys()), ['a'])
+        transaction.commit()
+        repo.root()['b'] = TestClass('b', None)
+        transaction.commit()
+        self.assertEqual(sorted(self.make_one().root().keys()), ['a', 'b'])
+
     def test_deactivate(self):
         repo = self.make_one()
         root = repo.root()
@@ -635,5 +2179,73 @@ class TestFolder(churro.PersistentFolder, TestClass):
     pass
 
 
+class TestTaggedClass(TestClass):
+    __churro_tag__ = 'test-tagged'
+
+
+class TestShardedFolder(churro.PersistentShardedFolder, TestClass):
+    shard_chars = 1
+
+
+class TestCounter(churro.Persistent):
+    count = churro.PersistentProperty()
+
+    def __init__(self):
+        self.count = 0
+
+    @classmethod
+    def _resolve_conflict(cls, old, ours, theirs):
+        ours.count += theirs.count - old.count
+        return ours
+
+
+class TestContact(churro.Persistent):
+    email = churro.PersistentProperty(indexed=True)
+    city = churro.PersistentProperty(indexed=True)
+
+    def __init__(self, email, city):
+        self.email = email
+        self.city = city
+
+
+class TestEvent(churro.Persistent):
+    when = churro.PersistentDate(ordered=True)
+    amount = churro.PersistentProperty(ordered=True)
+
+    def __init__(self, when, amount):
+        self.when = when
+        self.amount = amount
+
+
+class TestPerson(churro.Persistent):
+    name = churro.PersistentProperty(ordered=True)
+    city = churro.PersistentProperty(indexed=True)
+    born = churro.PersistentDate(ordered=True)
+    notes = churro.PersistentProperty()
+
+    def __init__(self, name, city, born, notes):
+        self.name = name
+        self.city = city
+        self.born = born
+        self.notes = notes
+
+
+class TestNote(churro.Persistent):
+    title = churro.PersistentProperty(searchable=True)
+    body = churro.PersistentProperty(searchable=True)
+
+    def __init__(self, title, body):
+        self.title = title
+        self.body = body
+
+
+class TestDirectory(churro.PersistentFolder):
+    projected_fields = ('name', 'born')
+
+
+class TestLedger(churro.PersistentFolder):
+    aggregated_fields = ('amount',)
+
+
 class NotSerializable(object):
     """Nuh uh, no way."""
@@ -13,7 +13,7 @@ tests_require = requires + []
 if sys.version < '2.7':
     tests_require += ['unittest2']
 
-testing_extras = tests_require + ['nose', 'coverage', 'tox']
+testing_extras = tests_require + ['nose', 'coverage', 'tox', 'msgpack']
 doc_extras = ['Sphinx']
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -53,5 +53,12 @@ setup(name='churro',
       extras_require={
           'testing': testing_extras,
           'docs': doc_extras,
+          'msgpack': ['msgpack'],
+          'fast': ['orjson'],
+      },
+      entry_points={
+          'console_scripts': [
+              'churro-reencode = churro.scripts:reencode',
+          ],
       },
       test_suite="churro.tests")